@@ -1,10 +1,27 @@
-from fastapi import FastAPI
+import asyncio
+import logging
+import os
+import time
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
-from .endpoints import health, tfbs, welcome
+from starlette.routing import Match
+from .endpoints import health, metrics, tfbs, welcome
+from .utils import parallel, upstream, warmup
+from .utils.metrics import REQUEST_SECONDS, server_timing, start_profile
+
+# The per-hit and per-motif debug logs are only emitted with TFBS_LOG_LEVEL=DEBUG.
+logging.basicConfig(level=os.environ.get("TFBS_LOG_LEVEL", "INFO"))
+
+PROFILE_HEADER = "X-TFBS-Profile"
 
 app = FastAPI(title="TFSBExplorer", version="0.1.0")
 
+if warmup.WARMUP_MODE == "import":
+    # Before a pre-fork launcher forks the workers, which then share the warm state (see app.utils.warmup).
+    warmup.warm()
+    warmup.freeze()
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -15,10 +32,63 @@ app.add_middleware(
 )
 
 app.include_router(health.router)
+app.include_router(metrics.router)
 app.include_router(tfbs.router)
 app.include_router(welcome.router)
 
 
+def route_path(request: Request):
+    """Return the path template of the route of a request (e.g. /tfbs/jobs/{job_id}), to bound the labels."""
+    for route in app.router.routes:
+        if route.matches(request.scope)[0] == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+async def timed_body(body_iterator, request, start):
+    """Pass the body of a response through, and observe the duration of the request once it is all sent."""
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method, path=route_path(request))
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """Time every request, and add its stage breakdown as a Server-Timing header when it is profiled.
+
+    call_next returns as soon as the headers are ready, so the duration is observed when the body iterator is
+    exhausted: a streamed search is timed up to its last line. The Server-Timing header is sent before the
+    body, its total only covers the time to the headers.
+    """
+    profile = start_profile() if request.headers.get(PROFILE_HEADER) else None
+    start = time.perf_counter()
+    response = await call_next(request)
+    response.body_iterator = timed_body(response.body_iterator, request, start)
+    if profile is not None:
+        profile["total"] = time.perf_counter() - start
+        response.headers["Server-Timing"] = server_timing(profile)
+    return response
+
+
+@app.on_event("startup")
+async def warm_start():
+    if warmup.WARMUP_MODE == "startup":
+        # In the background, /health answers (not ready yet) while it runs.
+        asyncio.get_running_loop().run_in_executor(None, warmup.warm)
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    parallel.shutdown()
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await upstream.close()
+
+
 @app.get("/", include_in_schema=False)
 def redirect_to_docs():
     return RedirectResponse(url="/docs")
@@ -1,8 +1,17 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Response, status
+from app.utils import warmup
 
 router = APIRouter()
 
 
 @router.get("/health", status_code=200)
 def health_check():
-    return {"status": "healthy"}
+    return {"status": "healthy", "ready": warmup.status["ready"], "warmup": warmup.status}
+
+
+@router.get("/health/ready", status_code=200)
+def readiness_check(response: Response):
+    """Readiness probe: 503 until the warm-up of the worker is done (see app.utils.warmup)."""
+    if not warmup.status["ready"]:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"ready": warmup.status["ready"], "phase": warmup.status["phase"]}
@@ -0,0 +1,20 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.utils import metrics
+from app.utils.admission import lane_stats
+from app.utils.background import background_cache
+from app.utils.motif_store import cache_stats as motif_cache_stats
+from app.utils.result_cache import cache_stats as result_cache_stats
+
+router = APIRouter()
+
+metrics.register_collector(lambda: {f"tfbs_{k}": v for k, v in motif_cache_stats().items()})
+metrics.register_collector(lambda: {f"tfbs_{k}": v for k, v in result_cache_stats().items()})
+metrics.register_collector(lambda: {f"tfbs_{k}": v for k, v in background_cache.stats().items()})
+metrics.register_collector(lambda: {f"tfbs_{k}": v for k, v in lane_stats().items()})
+
+
+@router.get("/metrics", response_class=PlainTextResponse, status_code=200)
+def get_metrics():
+    """Export the metrics of the process in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -1,73 +1,452 @@
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import Union, List
-from app.models.models import TFBSRequest, TFBSWindow, TFBSDetail
-from app.utils.pwm import search_luncher
+from app.models.models import TFBSRequest, TFBSBatchRequest, TFBSModuleRequest, TFBSWindow, TFBSJob
+from app.utils import admission, upstream
+from app.utils.background import background_names
+from app.utils.motif_store import prefetch_motifs
+from app.utils.pwm import TFBSSearch, batch_search_luncher
+from app.utils.jobs import get_manager
+from app.utils.metrics import span
+from app.utils.seq_store import get_store
 from app.utils.utils import Entrez
-import traceback
+import asyncio
+import json
+import logging
+import time
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
 
-@router.post("/tfbs", response_model=Union[List[TFBSWindow], dict], status_code=200)
-def get_tfbs(request: TFBSRequest):
+
+def window_to_dict(tf_name, window_id, window):
+    """Convert one window of best_window into the dictionnary of its TFBSWindow, without building the model."""
+    start, end, score, window_info = window
+    return {
+        "window_id": int(window_id),
+        "tf": tf_name,
+        "window_pos": [int(start), int(end)],
+        "window_score": float(score),
+        "details": [
+            {"sequence_id": j, "position": int(window_info[j][0]), "score": float(window_info[j][1])}
+            for j in window_info
+        ],
+    }
+
+
+def windows_to_models(tf_name, wsi):
+    """Convert the windows informations returned by best_window into a list of TFBSWindow."""
+    return [TFBSWindow(**window_to_dict(tf_name, i, wsi[i])) for i in wsi]
+
+
+def make_search(request: TFBSRequest):
+    return TFBSSearch(
+        request.mrna,
+        psw=request.pseudocount,
+        threshold=request.t,
+        len_prom=request.promoter_length,
+        window_size=request.window_size,
+        window_threshlod=request.s,
+        p_value=request.p_value,
+        background=request.background,
+    )
+
+
+def no_result(request: TFBSRequest):
+    return {
+            "message": "No TFBS found with these parameters, please choose different ones",
+            "parameters": {
+                "motif": request.m,
+                "threshold": request.t,
+                "p_value": request.p_value,
+                "background": request.background,
+                "promoter_length": request.promoter_length,
+                "window_size": request.window_size,
+                "window_threshold": request.s,
+                "pseudocount": request.pseudocount,
+                "mrna": request.mrna,
+            },
+        }
+
+
+def run_search(request: TFBSRequest, progress=None):
+    """Run the search of a TFBSRequest and return its windows, or a message when no TFBS is found."""
+    tf_name, wsi = make_search(request).run(request.m, progress)
+
+    if len(wsi) == 0:
+        return no_result(request)
+
+    with span("serialize"):
+        return windows_to_models(tf_name, wsi)
+
+
+def stream_search(request: TFBSRequest):
+    """Run the search of a TFBSRequest and yield one JSON line per window, as soon as it is found.
+
+    A single line with the no result message is sent when no TFBS is found.
+    """
+    found = False
     try:
-        Entrez.email = request.email
+        for tf_name, window_id, window in make_search(request).stream(request.m):
+            found = True
+            yield json.dumps(window_to_dict(tf_name, window_id, window)) + "\n"
+        if not found:
+            yield json.dumps(no_result(request)) + "\n"
+    except Exception:
+        logger.exception("TFBS search failed")
+        yield json.dumps({"error": "An internal error occurred. Please try again later."}) + "\n"
 
-        if not request.m or not request.mrna:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Motif and mRNA parameters are required",
-            )
 
-        tf_name, wsi = search_luncher(
-            request.mrna,
-            request.m,
-            request.promoter_length,
-            request.t,
-            request.pseudocount,
-            request.window_size,
-            request.s,
+def wants_stream(http_request: Request, stream: bool):
+    return stream or "application/x-ndjson" in http_request.headers.get("accept", "")
+
+
+def check_request(request: TFBSRequest):
+    if not request.m or not request.mrna:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Motif and mRNA parameters are required",
         )
+    check_threshold(request)
+    check_background(request)
 
-        if len(wsi) == 0:
-            return {
-                "message": "No TFBS found with these parameters, please choose different ones",
-                "parameters": {
-                    "motif": request.m,
-                    "threshold": request.t,
-                    "promoter_length": request.promoter_length,
-                    "window_size": request.window_size,
-                    "window_threshold": request.s,
-                    "pseudocount": request.pseudocount,
-                    "mrna": request.mrna,
-                },
-            }
 
-        output = []
-        for i in wsi:
-            window_info = TFBSWindow(
-                window_id=int(i),
-                tf=tf_name,
-                window_pos=[int(wsi[i][0]), int(wsi[i][1])],
-                window_score=float(wsi[i][2]),
-                details=[
-                    TFBSDetail(
-                        sequence_id=j,
-                        position=int(wsi[i][3][j][0]),
-                        score=float(wsi[i][3][j][1]),
-                    )
-                    for j in wsi[i][3]
-                ],
-            )
-            output.append(window_info)
+def check_threshold(request):
+    if request.t is None and request.p_value is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="A score threshold (t) or a p-value threshold (p_value) is required",
+        )
+    if request.p_value is not None and not 0 < request.p_value <= 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="p_value must be between 0 and 1",
+        )
 
-        return output
 
+def check_background(request):
+    if request.background is not None and request.background not in background_names():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"background must be one of {', '.join(background_names())}",
+        )
+
+
+async def prefetch(request, motif_ids=(), promoters=True):
+    """Download the missing motifs and, unless promoters is False, the missing promoters of a request.
+
+    The downloads go through the pooled async clients of app.utils.upstream, so waiting on NCBI and JASPAR
+    does not hold a worker thread, and the search that follows only reads the stores.
+    """
+    Entrez.email = request.email
+    downloads = [prefetch_motifs(motif_ids)]
+    if promoters:
+        downloads.append(get_store().prefetch(request.mrna, request.promoter_length))
+    try:
+        await asyncio.gather(*downloads)
     except Exception as e:
-        traceback_str = "".join(traceback.format_tb(e.__traceback__))
-        error_message = f"{str(e)}\n{traceback_str}"
-        print(f"Exception: {error_message}")
+        logger.warning("Could not download the promoters or motifs of a request: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Could not download the promoters or motifs of the request.",
+        )
+
+
+async def estimate_cost(request, motif_ids=None):
+    try:
+        return await run_in_threadpool(admission.estimate, request, motif_ids)
+    except Exception:
+        logger.exception("Cost estimate failed")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="An internal error occurred. Please try again later.",
+        )
+
+
+def too_busy(cost):
+    """Return the 429 of a request whose lane is full, with the time to wait before retrying it."""
+    retry_after = admission.lanes[cost.lane].retry_after()
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=f"Too many {cost.lane} searches are running (this one is estimated at {cost.seconds:.1f} s), "
+        f"please retry in {retry_after} s.",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+async def admit_search(request, cost):
+    """Take a slot in the lane of a search, then download its promoters, returns the admission token.
+
+    A 429 is raised when the lane is full, the slot is freed when the download fails.
+    """
+    token = admission.admit(cost)
+    if token is None:
+        raise too_busy(cost)
+    try:
+        await prefetch(request)
+    except BaseException:
+        admission.lanes[cost.lane].release(token)
+        raise
+    return token
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """StreamingResponse of an admitted search, which frees its admission slot once the response is over.
+
+    The slot is freed by the response itself, whether its stream was consumed, interrupted or never started.
+    """
+
+    def __init__(self, content, cost, token, **kwargs):
+        super().__init__(content, **kwargs)
+        self.cost = cost
+        self.token = token
+
+    async def __call__(self, scope, receive, send):
+        start = time.perf_counter()
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            admission.done(self.cost, self.token, time.perf_counter() - start)
+
+
+@router.post(
+    "/tfbs",
+    response_model=Union[List[TFBSWindow], dict],
+    status_code=200,
+    responses={202: {"model": TFBSJob}, 429: {"description": "Too many searches of the same cost running"}},
+)
+async def get_tfbs(request: TFBSRequest, http_request: Request, stream: bool = False):
+    """Search the TFBS of a motif in the promoters of the given genes.
+
+    With ?stream=true, or an Accept: application/x-ndjson header, the windows are streamed as one JSON
+    line each while they are found, instead of being returned as a single list.
+
+    Promoters and motifs are downloaded on the event loop, the scan and window search run in the threadpool.
+    The cost of the search is estimated first, from its motif (see app.utils.admission): a search estimated
+    too long for a request runs as a background job instead, answered with a 202 and the job (as /tfbs/jobs
+    does), which downloads the promoters itself, and a search whose lane is full gets a 429 with a Retry-After
+    header. The promoters of the searches admitted are downloaded once they have their slot.
+    """
+    check_request(request)
+    await prefetch(request, [request.m], promoters=False)
+    cost = await estimate_cost(request)
+    if cost.lane == admission.BACKGROUND:
+        job = submit_job(request, cost)
+        return JSONResponse(
+            job_to_model(job).dict(),
+            status_code=status.HTTP_202_ACCEPTED,
+            headers={"Location": f"/tfbs/jobs/{job['id']}"},
+        )
+
+    token = await admit_search(request, cost)
+    if wants_stream(http_request, stream):
+        chunks = stream_search(request)
+        return AdmittedStreamingResponse(chunks, cost, token, media_type="application/x-ndjson")
+
+    start = time.perf_counter()
+    try:
+        return await run_in_threadpool(run_search, request)
+
+    except Exception:
+        logger.exception("TFBS search failed")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="An internal error occurred. Please try again later.",
         )
+
+    finally:
+        admission.done(cost, token, time.perf_counter() - start)
+
+
+def job_to_model(job):
+    return TFBSJob(
+        job_id=job["id"],
+        status=job["status"],
+        phase=job["phase"],
+        result=job["result"],
+        error="An internal error occurred. Please try again later." if job["error"] else None,
+    )
+
+
+def submit_job(request: TFBSRequest, cost=None):
+    """Start the search of a TFBSRequest as a background job, returns the job.
+
+    With the Estimate of a search rerouted from /tfbs, the job takes a slot of the background lane (a 429 is
+    raised when it is full) and frees it once done.
+    """
+    token = None
+    if cost is not None:
+        token = admission.admit(cost)
+        if token is None:
+            raise too_busy(cost)
+
+    def search(progress):
+        start = time.perf_counter()
+        try:
+            Entrez.email = request.email
+            result = run_search(request, progress)
+            if isinstance(result, dict):
+                return result
+            return [w.dict() for w in result]
+        finally:
+            if token is not None:
+                admission.done(cost, token, time.perf_counter() - start)
+
+    submitted = time.time()
+    # The email only identifies the caller to NCBI, it does not change the result.
+    try:
+        job = get_manager().submit(request.dict(exclude={"email"}), search)
+    except Exception:
+        if token is not None:
+            admission.lanes[cost.lane].release(token)
+        raise
+    if token is not None and job["created"] < submitted:
+        # An identical request already has a job, no search was started for this one.
+        admission.lanes[cost.lane].release(token)
+    return job
+
+
+@router.post("/tfbs/jobs", response_model=TFBSJob, status_code=202)
+def create_tfbs_job(request: TFBSRequest):
+    """Start the search of a TFBSRequest in the background and return its job right away.
+
+    An identical request that is still running, or whose result is still kept, returns the same job.
+    """
+    check_request(request)
+    return job_to_model(submit_job(request))
+
+
+@router.get("/tfbs/jobs/{job_id}", response_model=TFBSJob, status_code=200)
+def get_tfbs_job(job_id: str):
+    """Return the status, current phase and, once done, the result of a job."""
+    job = get_manager().get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown or expired job.",
+        )
+    return job_to_model(job)
+
+
+async def resolve_motifs(request):
+    """Return the motif ids of a request, its own and those of its JASPAR collection."""
+    motif_ids = list(request.m)
+    if request.collection:
+        try:
+            motif_ids += await upstream.list_collection_motifs(request.collection, request.tax_group)
+        except Exception as e:
+            logger.warning("Could not list the motifs of %s: %s", request.collection, e)
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail="Could not list the motifs of the requested JASPAR collection.",
+            )
+    return motif_ids
+
+
+@router.post("/tfbs/batch", status_code=200)
+async def get_tfbs_batch(request: TFBSBatchRequest):
+    """Search many motifs over the same genes, streaming one JSON line per motif.
+
+    The search goes through the admission control of /tfbs, with the cost of all its motifs, but is never
+    rerouted to a background job.
+    """
+    if (not request.m and not request.collection) or not request.mrna:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Motif (or collection) and mRNA parameters are required",
+        )
+    check_threshold(request)
+    check_background(request)
+    motif_ids = await resolve_motifs(request)
+    await prefetch(request, motif_ids, promoters=False)
+    cost = await estimate_cost(request, motif_ids)
+    token = await admit_search(request, cost)
+
+    def results():
+        try:
+            for motif_id, tf_name, wsi in batch_search_luncher(
+                request.mrna,
+                motif_ids,
+                psw=request.pseudocount,
+                threshold=request.t,
+                len_prom=request.promoter_length,
+                window_size=request.window_size,
+                window_threshlod=request.s,
+                p_value=request.p_value,
+                background=request.background,
+            ):
+                windows = [window_to_dict(tf_name, i, wsi[i]) for i in wsi]
+                yield json.dumps({"motif": motif_id, "tf": tf_name, "windows": windows}) + "\n"
+        except Exception:
+            logger.exception("Batch search failed")
+            yield json.dumps({"error": "An internal error occurred. Please try again later."}) + "\n"
+
+    return AdmittedStreamingResponse(results(), cost, token, media_type="application/x-ndjson")
+
+
+def module_to_dict(window_id, window):
+    """Convert one window of iter_module_windows into a JSON-ready dictionnary."""
+    start, end, score, module_info = window
+    return {
+        "window_id": int(window_id),
+        "window_pos": [int(start), int(end)],
+        "window_score": float(score),
+        "tfs": sorted({tf for hits in module_info.values() for _, tf, _, _ in hits}),
+        "details": [
+            {
+                "sequence_id": seq_id,
+                "motif": motif_id,
+                "tf": tf,
+                "position": int(position),
+                "score": float(hit_score),
+            }
+            for seq_id, hits in module_info.items()
+            for motif_id, tf, position, hit_score in hits
+        ],
+    }
+
+
+@router.post("/tfbs/modules", status_code=200)
+async def get_tfbs_modules(request: TFBSModuleRequest):
+    """Search the windows where several TFs bind the same genes together, streaming one JSON line per window.
+
+    The search goes through the admission control of /tfbs, as /tfbs/batch does.
+    """
+    if (not request.m and not request.collection) or not request.mrna:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Motif (or collection) and mRNA parameters are required",
+        )
+    if request.min_tfs < 1 or request.min_genes < 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="min_tfs and min_genes must be at least 1",
+        )
+    check_threshold(request)
+    check_background(request)
+    motif_ids = await resolve_motifs(request)
+    await prefetch(request, motif_ids, promoters=False)
+    cost = await estimate_cost(request, motif_ids)
+    token = await admit_search(request, cost)
+
+    def results():
+        try:
+            search = TFBSSearch(
+                request.mrna,
+                psw=request.pseudocount,
+                threshold=request.t,
+                len_prom=request.promoter_length,
+                window_size=request.window_size,
+                window_threshlod=None,
+                p_value=request.p_value,
+                background=request.background,
+            )
+            for window_id, window in search.run_modules(motif_ids, request.min_tfs, request.min_genes):
+                yield json.dumps(module_to_dict(window_id, window)) + "\n"
+        except Exception:
+            logger.exception("Module search failed")
+            yield json.dumps({"error": "An internal error occurred. Please try again later."}) + "\n"
+
+    return AdmittedStreamingResponse(results(), cost, token, media_type="application/x-ndjson")
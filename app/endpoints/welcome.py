@@ -17,7 +17,13 @@ def index():
             <h3>Available Endpoints:</h3>
             <ul>
                 <li><b>GET /health</b> - Check the health status of the API</li>
-                <li><b>POST /tfbs</b> - Find TFBS in promoter sequences of given genes</li>
+                <li><b>GET /health/ready</b> - 503 until the worker is warmed up, then 200</li>
+                <li><b>GET /metrics</b> - Metrics of the API in the Prometheus text format</li>
+                <li><b>POST /tfbs</b> - Find TFBS in promoter sequences of given genes (long searches are answered with a job, 202)</li>
+                <li><b>POST /tfbs/jobs</b> - Start a TFBS search in the background and get its job id</li>
+                <li><b>GET /tfbs/jobs/{id}</b> - Get the progress and the result of a TFBS search job</li>
+                <li><b>POST /tfbs/batch</b> - Find TFBS of many motifs (or a JASPAR collection) in the same genes</li>
+                <li><b>POST /tfbs/modules</b> - Find windows where several TFs bind the same genes together</li>
             </ul>
         </body>
     </html>
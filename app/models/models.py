@@ -1,10 +1,12 @@
 from pydantic import BaseModel, EmailStr
-from typing import List, Optional
+from typing import Any, List, Optional
 
 
 class TFBSRequest(BaseModel):
     email: EmailStr
-    t: float
+    t: Optional[float] = None
+    p_value: Optional[float] = None
+    background: Optional[str] = None
     m: str
     s: float
     promoter_length: int
@@ -13,6 +15,37 @@ class TFBSRequest(BaseModel):
     mrna: List[str]
 
 
+class TFBSBatchRequest(BaseModel):
+    email: EmailStr
+    t: Optional[float] = None
+    p_value: Optional[float] = None
+    background: Optional[str] = None
+    m: List[str] = []
+    collection: Optional[str] = None
+    tax_group: Optional[str] = None
+    s: float
+    promoter_length: int
+    window_size: int
+    pseudocount: float
+    mrna: List[str]
+
+
+class TFBSModuleRequest(BaseModel):
+    email: EmailStr
+    t: Optional[float] = None
+    p_value: Optional[float] = None
+    background: Optional[str] = None
+    m: List[str] = []
+    collection: Optional[str] = None
+    tax_group: Optional[str] = None
+    min_tfs: int = 2
+    min_genes: int = 2
+    promoter_length: int
+    window_size: int
+    pseudocount: float
+    mrna: List[str]
+
+
 class TFBSDetail(BaseModel):
     sequence_id: str
     position: int
@@ -25,3 +58,12 @@ class TFBSWindow(BaseModel):
     window_pos: List[int]
     window_score: float
     details: List[TFBSDetail]
+
+
+class TFBSJob(BaseModel):
+    job_id: str
+    status: str
+    phase: Optional[str] = None
+    result: Optional[Any] = None
+    error: Optional[str] = None
+
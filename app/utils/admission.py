@@ -0,0 +1,219 @@
+"""Cost estimation and admission control of the /tfbs searches.
+
+The duration of a search is estimated before it runs from the work of its scan, genes x promoter_length x
+motif length on both strands, and from the hits it is expected to find, which the window search goes through:
+genes x promoter_length x 2 x the hit density of the threshold. The density is the p-value of the request, or
+the p-value of its score threshold t under the score distribution of the motif (see app.utils.score_dist):
+
+    seconds = 2 x positions x motif length / TFBS_SCAN_RATE + expected hits / TFBS_HIT_RATE
+
+The estimate only needs the motifs, it is made before the promoters are downloaded. The scan work and the
+hits of several motifs (/tfbs/batch and /tfbs/modules) add up, their estimate has the sum of the motif
+lengths and of the hit densities. It ignores the result caches, a repeated search takes less. It puts each
+request in a lane:
+
+- "fast", estimated under TFBS_FAST_LANE_SECONDS, with its own TFBS_FAST_LANE_LIMIT concurrent searches, so
+  that the small interactive queries never wait behind the big ones,
+- "standard", up to TFBS_BACKGROUND_SECONDS, at most TFBS_STANDARD_LIMIT at a time,
+- "background", above, run as a background job (see app.utils.jobs) instead of in the request, at most
+  TFBS_BACKGROUND_LIMIT of them in flight. The batch and module searches have no job, they stream under
+  the limit of the lane.
+
+A request finding its lane full is not queued, it gets a 429 with a Retry-After header, the estimated time
+until the first search of the lane ends. The estimated and actual durations of every search are logged, and
+appended to TFBS_COST_LOG (a JSON lines file) when it is set, to fit the rates on real traffic:
+
+    python -m app.utils.admission fit cost.jsonl
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from app.utils.metrics import Counter, Histogram
+
+SCAN_RATE = float(os.environ.get("TFBS_SCAN_RATE", 5e7))  # motif column x position scores per second
+HIT_RATE = float(os.environ.get("TFBS_HIT_RATE", 4e5))  # hits per second through the window search
+FAST_LANE_SECONDS = float(os.environ.get("TFBS_FAST_LANE_SECONDS", 0.5))
+BACKGROUND_SECONDS = float(os.environ.get("TFBS_BACKGROUND_SECONDS", 20))
+FAST_LANE_LIMIT = int(os.environ.get("TFBS_FAST_LANE_LIMIT", 8))
+STANDARD_LIMIT = int(os.environ.get("TFBS_STANDARD_LIMIT", 2))
+BACKGROUND_LIMIT = int(os.environ.get("TFBS_BACKGROUND_LIMIT", 16))
+COST_LOG = os.environ.get("TFBS_COST_LOG")
+
+FAST = "fast"
+STANDARD = "standard"
+BACKGROUND = "background"
+
+ADMISSIONS = Counter(
+    "tfbs_admissions_total", "Admission decisions of the /tfbs searches.", ["lane", "outcome"]
+)
+COST_RATIO = Histogram(
+    "tfbs_cost_ratio",
+    "Actual over estimated duration of the /tfbs searches.",
+    ["lane"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 4, 10),
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Estimate:
+    """Estimated cost of a search, with the quantities it is computed from."""
+
+    def __init__(self, genes, promoter_length, motif_length, hit_density):
+        self.genes = genes
+        self.promoter_length = promoter_length
+        self.motif_length = motif_length
+        self.hit_density = hit_density
+
+    @property
+    def scan_work(self):
+        return 2 * self.genes * self.promoter_length * self.motif_length
+
+    @property
+    def hits(self):
+        return 2 * self.genes * self.promoter_length * self.hit_density
+
+    @property
+    def seconds(self):
+        return self.scan_work / SCAN_RATE + self.hits / HIT_RATE
+
+    @property
+    def lane(self):
+        if self.seconds <= FAST_LANE_SECONDS:
+            return FAST
+        if self.seconds <= BACKGROUND_SECONDS:
+            return STANDARD
+        return BACKGROUND
+
+    def record(self):
+        return {
+            "genes": self.genes,
+            "promoter_length": self.promoter_length,
+            "motif_length": self.motif_length,
+            "hit_density": self.hit_density,
+            "estimated": round(self.seconds, 4),
+            "lane": self.lane,
+        }
+
+
+def estimate(request, motif_ids=None):
+    """Return the Estimate of a TFBSRequest, or of the motif_ids of a batch or module request.
+
+    The motifs must be in the motif store (see prefetch_motifs), the promoters are not needed.
+    """
+    from app.utils.background import UNIFORM, resolve_background
+    from app.utils.motif_store import get_pssm
+    from app.utils.score_dist import get_distribution
+
+    # The composition of the promoters is only known once they are read, the uniform background stands in.
+    background = UNIFORM
+    if request.background != "promoters":
+        background = resolve_background(request.background, None, None)
+    motif_length, hit_density = 0, 0.0
+    for motif_id in [request.m] if motif_ids is None else motif_ids:
+        pssm, _ = get_pssm(motif_id, request.pseudocount, background=background)
+        motif_length += pssm.length
+        if request.p_value is not None:
+            hit_density += request.p_value
+        else:
+            hit_density += get_distribution(motif_id, request.pseudocount, background).p_value(request.t)
+    return Estimate(len(request.mrna), request.promoter_length, motif_length, hit_density)
+
+
+class Lane:
+    """Bounded number of searches running at the same time, with the time their estimates say they end."""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._ends = dict()  # token -> estimated end time.
+        self._lock = threading.Lock()
+
+    def try_acquire(self, seconds):
+        """Return a token for a search of the estimated duration, or None when the lane is full."""
+        with self._lock:
+            if len(self._ends) >= self.limit:
+                return None
+            token = object()
+            self._ends[token] = time.time() + seconds
+            return token
+
+    def release(self, token):
+        with self._lock:
+            self._ends.pop(token, None)
+
+    def retry_after(self):
+        """Return the seconds until the first search of the lane is expected to end, at least one."""
+        with self._lock:
+            first = min(self._ends.values(), default=time.time())
+        return max(1, math.ceil(first - time.time()))
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._ends)
+
+
+lanes = {
+    FAST: Lane(FAST, FAST_LANE_LIMIT),
+    STANDARD: Lane(STANDARD, STANDARD_LIMIT),
+    BACKGROUND: Lane(BACKGROUND, BACKGROUND_LIMIT),
+}
+
+
+def lane_stats():
+    """Return the number of searches in flight in each lane, exported by /metrics."""
+    return {f"admission_{name}_in_flight": lane.in_flight() for name, lane in lanes.items()}
+
+
+def admit(cost):
+    """Take a slot in the lane of an Estimate, returns its token, or None when the lane is full."""
+    token = lanes[cost.lane].try_acquire(cost.seconds)
+    ADMISSIONS.inc(lane=cost.lane, outcome="admitted" if token is not None else "rejected")
+    return token
+
+
+def done(cost, token, actual):
+    """Free the slot of a search and log its estimated and actual durations."""
+    lanes[cost.lane].release(token)
+    COST_RATIO.observe(actual / max(cost.seconds, 1e-6), lane=cost.lane)
+    record = dict(cost.record(), actual=round(actual, 4))
+    logger.info("Search cost: %s", json.dumps(record))
+    if COST_LOG:
+        with open(COST_LOG, "a") as handle:
+            handle.write(json.dumps(record) + "\n")
+
+
+def fit(path):
+    """Fit the scan and hit rates on a cost log by least squares, returns (scan rate, hit rate)."""
+    import numpy as np
+
+    with open(path) as handle:
+        records = [json.loads(line) for line in handle if line.strip()]
+    costs = [Estimate(r["genes"], r["promoter_length"], r["motif_length"], r["hit_density"]) for r in records]
+    work = np.array([[c.scan_work, c.hits] for c in costs], dtype=float)
+    actual = np.array([r["actual"] for r in records], dtype=float)
+    (per_score, per_hit), *_ = np.linalg.lstsq(work, actual, rcond=None)
+    return 1 / max(per_score, 1e-15), 1 / max(per_hit, 1e-15)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune the cost model of the /tfbs admission control.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    fit_parser = sub.add_parser("fit", help="fit the rates of the cost model on a TFBS_COST_LOG file")
+    fit_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "fit":
+        scan_rate, hit_rate = fit(args.path)
+        print(f"TFBS_SCAN_RATE={scan_rate:.3g}")
+        print(f"TFBS_HIT_RATE={hit_rate:.3g}")
+
+
+if __name__ == "__main__":
+    main()
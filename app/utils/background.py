@@ -0,0 +1,149 @@
+"""Nucleotide background models of the log-odds PSSMs.
+
+A background is a tuple of the A, C, G, T probabilities, chosen by name:
+
+- "uniform" (the default), every base has probability 0.25,
+- "promoters", the base composition of the promoters of the search,
+- a species of the background table (e.g. "human"), its genome-wide base composition.
+
+Motifs are scanned on both strands, so backgrounds are strand-symmetric (P(A) = P(T), P(C) = P(G)) and
+only depend on the GC content, which is rounded to GC_STEP. This keeps the number of distinct backgrounds
+small, and with it the number of PSSMs and score distributions cached for them.
+
+The compositions of promoter sets are counted on their encoded sequences and cached per sequence set. The
+species table comes with defaults and can be extended from a genome (FASTA with a .fai index, or .2bit):
+
+    python -m app.utils.background genome <species> <genome file>
+    python -m app.utils.background list
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from app.utils.result_cache import SCAN_CACHE_SIZE, ResultCache
+from app.utils.scan import INVALID, encode_sequences
+
+BACKGROUNDS_FILE = "./data/backgrounds.json"
+GC_STEP = 0.005
+UNIFORM = (0.25, 0.25, 0.25, 0.25)
+
+# Genome-wide GC content of common species.
+SPECIES_GC = {
+    "human": 0.41,
+    "mouse": 0.42,
+    "rat": 0.42,
+    "chicken": 0.42,
+    "zebrafish": 0.37,
+    "fly": 0.42,
+    "worm": 0.35,
+    "yeast": 0.38,
+    "arabidopsis": 0.36,
+}
+
+background_cache = ResultCache("background", SCAN_CACHE_SIZE)
+
+
+def from_gc(gc):
+    """Return the strand-symmetric background of a GC content, rounded to GC_STEP."""
+    gc = round(round(float(gc) / GC_STEP) * GC_STEP, 6)
+    at, gc = round((1 - gc) / 2, 6), round(gc / 2, 6)
+    return (at, gc, gc, at)
+
+
+def base_counts(codes):
+    """Return the A, C, G, T counts of an array of base codes, the INVALID codes (N, padding) are left out."""
+    return np.bincount(codes.ravel(), minlength=INVALID + 1)[:INVALID]
+
+
+def gc_content(counts):
+    """Return the GC content of A, C, G, T counts."""
+    # One pseudocount per base, so a set without any valid base gets the uniform background.
+    return (counts[1] + counts[2] + 2) / (counts.sum() + 4)
+
+
+def species_table():
+    """Return {species: GC content}, the defaults updated with the table file."""
+    table = dict(SPECIES_GC)
+    if os.path.exists(BACKGROUNDS_FILE):
+        with open(BACKGROUNDS_FILE) as handle:
+            table.update(json.load(handle))
+    return table
+
+
+def background_names():
+    """Return the names of the backgrounds that can be requested."""
+    return ["uniform", "promoters"] + sorted(species_table())
+
+
+def promoter_background(sequences, seq_key, codes=None):
+    """Return the background of a set of promoters, computed once per sequence set.
+
+    codes are the encoded sequences, when the caller already has them (see encode_sequences).
+    """
+    background = background_cache.get(seq_key)
+    if background is None:
+        if codes is None:
+            codes, _ = encode_sequences(list(sequences.values()))
+        background = from_gc(gc_content(base_counts(codes)))
+        background_cache.put(seq_key, background)
+    return background
+
+
+def resolve_background(name, sequences, seq_key, codes=None):
+    """Return the A, C, G, T probabilities of a background name (None is the uniform background)."""
+    if name is None or name == "uniform":
+        return UNIFORM
+    if name == "promoters":
+        return promoter_background(sequences, seq_key, codes)
+    table = species_table()
+    if name not in table:
+        raise ValueError(f"Unknown background {name}, expected one of {', '.join(background_names())}.")
+    return from_gc(table[name])
+
+
+def genome_gc(path, chunk_size=10_000_000):
+    """Return the GC content of a genome, read chunk by chunk (see app.utils.genome)."""
+    from app.utils.genome import open_genome
+
+    genome = open_genome(path)
+    counts = np.zeros(INVALID, dtype=np.int64)
+    try:
+        for chrom, length in genome.lengths().items():
+            for start in range(0, length, chunk_size):
+                counts += base_counts(genome.codes(chrom, start, start + chunk_size))
+    finally:
+        genome.close()
+    return gc_content(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the species background table.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    genome_parser = subparsers.add_parser("genome", help="add the background of a species from its genome")
+    genome_parser.add_argument("species")
+    genome_parser.add_argument("path", help="FASTA file with a .fai index, or .2bit file")
+    subparsers.add_parser("list", help="print the species table")
+    args = parser.parse_args()
+
+    if args.command == "genome":
+        gc = round(float(genome_gc(args.path)), 4)
+        table = dict()
+        if os.path.exists(BACKGROUNDS_FILE):
+            with open(BACKGROUNDS_FILE) as handle:
+                table = json.load(handle)
+        table[args.species] = gc
+        os.makedirs(os.path.dirname(BACKGROUNDS_FILE), exist_ok=True)
+        with open(BACKGROUNDS_FILE + ".tmp", "w") as handle:
+            json.dump(table, handle, indent=1, sort_keys=True)
+        os.replace(BACKGROUNDS_FILE + ".tmp", BACKGROUNDS_FILE)
+        print(f"{args.species}: GC content {gc} written to {BACKGROUNDS_FILE}.")
+    else:
+        for species, gc in sorted(species_table().items()):
+            print(f"{species}: GC content {gc}, background {from_gc(gc)}")
+
+
+if __name__ == "__main__":
+    main()
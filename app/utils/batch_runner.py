@@ -0,0 +1,333 @@
+"""Offline runner of many TFBS searches listed in a manifest, without going through the HTTP API.
+
+    python -m app.utils.batch_runner manifest.jsonl results/ [--workers 8] [--format jsonl|parquet]
+
+The manifest is a JSONL file (one job per line) or a CSV file (with a header line), whose fields are those of
+the /tfbs requests: m, mrna, t or p_value, s, promoter_length, window_size, pseudocount, and optionally
+background and id (the line number by default). In CSV files, the mRNAs of a job are separated by ";". The
+duplicate mRNAs of a job are dropped, its windows have one entry per gene.
+
+Jobs sharing the same genes and promoter length are grouped into tasks of at most --jobs-per-shard jobs. A task
+reads and encodes its promoters once, then scans all its motifs together for each set of scan and window
+parameters (see TFBSSearch.run_batch). Tasks run on a pool of worker processes, and each one writes the results
+of its jobs, one record per job, to its own shard, results/shard-<task>.jsonl (or .parquet, with pyarrow).
+The promoters and motifs missing from the local stores are downloaded once, by the main process, beforehand
+(failed downloads are retried PREFETCH_RETRIES times). The workers never download: the tasks whose promoters or
+motifs are still missing fail, and are run again when the run is resumed.
+
+Shards are written to a temporary file then renamed, and the finished tasks are listed in
+results/checkpoint.jsonl. Running the same manifest again into the same directory skips them, so a run that
+was interrupted or had failed tasks is resumed by running the same command again.
+"""
+
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from app.utils import parallel
+from app.utils.background import background_names
+from app.utils.motif_store import get_motif
+from app.utils.pwm import TFBSSearch
+from app.utils.seq_store import get_store
+from app.utils.utils import Entrez, fetch_promotors
+
+FIELDS = ("m", "mrna", "t", "p_value", "s", "promoter_length", "window_size", "pseudocount", "background")
+REQUIRED = ("m", "mrna", "s", "promoter_length", "window_size", "pseudocount")
+NUMBERS = {
+    "t": float,
+    "p_value": float,
+    "s": float,
+    "promoter_length": int,
+    "window_size": int,
+    "pseudocount": float,
+}
+JOBS_PER_SHARD = 256
+PREFETCH_RETRIES = 2
+CHECKPOINT = "checkpoint.jsonl"
+RUN_FILE = "run.json"
+
+
+def read_manifest(path):
+    """Return the jobs of a JSONL or CSV manifest, as dictionnaries with an id and the fields of a /tfbs request."""
+    with open(path, newline="") as handle:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(handle))
+        else:
+            rows = [json.loads(line) for line in handle if line.strip()]
+
+    jobs = []
+    for line, row in enumerate(rows, 1):
+        job = {"id": str(row.get("id") or line)}
+        for field in FIELDS:
+            value = row.get(field)
+            if value == "" or value is None:
+                value = None
+            elif field == "mrna":
+                if isinstance(value, str):
+                    value = [mrna.strip() for mrna in value.split(";") if mrna.strip()]
+                # The promoters of a search are keyed by mRNA, a duplicate would be dropped by the search anyway.
+                value = list(dict.fromkeys(value))
+            elif field in NUMBERS:
+                value = NUMBERS[field](value)
+            job[field] = value
+        check_job(job, line)
+        jobs.append(job)
+    return jobs
+
+
+def check_job(job, line):
+    missing = [field for field in REQUIRED if job[field] is None or job[field] == []]
+    if job["t"] is None and job["p_value"] is None:
+        missing.append("t or p_value")
+    if missing:
+        raise ValueError(f"Job {job['id']} (line {line}) of the manifest has no {', '.join(missing)}.")
+    if job["background"] is not None and job["background"] not in background_names():
+        raise ValueError(f"Job {job['id']} (line {line}) of the manifest has an unknown background.")
+
+
+def search_params(job):
+    """Return the scan and window parameters of a job, the jobs sharing them are searched together."""
+    return (job["pseudocount"], job["t"], job["p_value"], job["background"], job["window_size"], job["s"])
+
+
+def make_tasks(jobs, jobs_per_shard=JOBS_PER_SHARD):
+    """Group the jobs sharing the same genes and promoter length into tasks of at most jobs_per_shard jobs.
+
+    The jobs of a task are sorted by search_params. Tasks only depend on the manifest and jobs_per_shard, so a
+    resumed run finds the same tasks.
+    """
+    groups = dict()
+    for job in jobs:
+        groups.setdefault((tuple(job["mrna"]), job["promoter_length"]), []).append(job)
+    tasks = []
+    for group in groups.values():
+        group.sort(key=lambda job: repr(search_params(job)))
+        tasks.extend(group[i : i + jobs_per_shard] for i in range(0, len(group), jobs_per_shard))
+    return tasks
+
+
+def prefetch(jobs, retries=PREFETCH_RETRIES):
+    """Download, once, the promoters and motifs of the jobs missing from the local stores.
+
+    Failed downloads are retried. Returns the (mrna, promoter_length) promoters and the motifs still missing.
+    """
+    store = get_store()
+    lengths = dict()
+    for job in jobs:
+        lengths.setdefault(job["promoter_length"], dict()).update(dict.fromkeys(job["mrna"]))
+    missing_promoters = set()
+    for promoter_length, mrnas in lengths.items():
+        missing = store.missing(list(mrnas), promoter_length)
+        for _ in range(retries + 1):
+            if not missing:
+                break
+            print(f"Fetching {len(missing)} promoters from NCBI, please wait...")
+            try:
+                store.add_records(fetch_promotors(missing, promoter_length), promoter_length)
+            except Exception as e:
+                print(f"Could not download the promoters: {e}")
+            missing = store.missing(missing, promoter_length)
+        missing_promoters.update((mrna, promoter_length) for mrna in missing)
+
+    missing_motifs = set()
+    for motif_id in dict.fromkeys(job["m"] for job in jobs):
+        try:
+            get_motif(motif_id)
+        except Exception as e:
+            print(f"Could not download the motif {motif_id}: {e}")
+            missing_motifs.add(motif_id)
+    return missing_promoters, missing_motifs
+
+
+def missing_data(jobs, missing_promoters, missing_motifs):
+    """Return a message listing the promoters and motifs of a task that could not be downloaded, or None."""
+    mrna, promoter_length = jobs[0]["mrna"], jobs[0]["promoter_length"]
+    promoters = [m for m in mrna if (m, promoter_length) in missing_promoters]
+    motifs = sorted({job["m"] for job in jobs} & missing_motifs)
+    if not promoters and not motifs:
+        return None
+    return f"missing promoters {', '.join(promoters[:5]) or '-'}, missing motifs {', '.join(motifs[:5]) or '-'}"
+
+
+def window_record(window_id, window):
+    start, end, score, window_info = window
+    return {
+        "window_id": int(window_id),
+        "window_pos": [int(start), int(end)],
+        "window_score": float(score),
+        "details": [
+            {"sequence_id": seq_id, "position": int(position), "score": float(hit_score)}
+            for seq_id, (position, hit_score) in window_info.items()
+        ],
+    }
+
+
+def shard_path(out_dir, task_index, fmt):
+    return os.path.join(out_dir, f"shard-{task_index:05d}.{fmt}")
+
+
+def write_shard(records, path, fmt):
+    """Write the records of a task, to a temporary file first so that a shard is never partial."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pq.write_table(pa.Table.from_pylist(records), tmp_path)
+    else:
+        with open(tmp_path, "w") as handle:
+            for record in records:
+                handle.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, path)
+
+
+def init_worker(email):
+    # The batch workers are the parallelism, their scans do not use the pool of app.utils.parallel.
+    parallel.WORKERS = 1
+    Entrez.email = email
+
+
+def run_task(task_index, jobs, out_dir, fmt):
+    """Worker task: run the jobs of a task and write their results to its shard, returns the shard path."""
+    mrna, promoter_length = jobs[0]["mrna"], jobs[0]["promoter_length"]
+    # The promoters are downloaded by the main process, a worker downloading them would race with the others.
+    missing = get_store().missing(mrna, promoter_length)
+    if missing:
+        raise RuntimeError(f"{len(missing)} promoters are missing from the store ({', '.join(missing[:5])}).")
+    records = []
+    for params, group in itertools.groupby(jobs, key=search_params):
+        group = list(group)
+        psw, t, p_value, background, window_size, s = params
+        search = TFBSSearch(
+            mrna, psw, t, promoter_length, window_size, s, p_value=p_value, background=background
+        )
+        results = {
+            motif_id: (tf_name, wsi)
+            for motif_id, tf_name, wsi in search.run_batch(list(dict.fromkeys(job["m"] for job in group)))
+        }
+        for job in group:
+            tf_name, wsi = results[job["m"]]
+            records.append(
+                {
+                    "id": job["id"],
+                    "motif": job["m"],
+                    "tf": tf_name,
+                    "windows": [window_record(i, wsi[i]) for i in wsi],
+                }
+            )
+    path = shard_path(out_dir, task_index, fmt)
+    write_shard(records, path, fmt)
+    return path
+
+
+def manifest_digest(path, jobs_per_shard):
+    digest = hashlib.sha256(f"{jobs_per_shard}\n".encode())
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def start_run(out_dir, digest):
+    """Record the manifest of a run in its directory, or check that a resumed run has the same manifest."""
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, RUN_FILE)
+    if os.path.exists(path):
+        with open(path) as handle:
+            if json.load(handle)["manifest"] != digest:
+                raise SystemExit(f"{out_dir} holds the results of another manifest, use another directory.")
+    else:
+        with open(path, "w") as handle:
+            json.dump({"manifest": digest}, handle)
+
+
+def read_checkpoint(out_dir):
+    """Return the indices of the tasks whose shard is written."""
+    path = os.path.join(out_dir, CHECKPOINT)
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path) as handle:
+        for line in handle:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line cut by an interruption.
+                continue
+            if os.path.exists(entry["shard"]):
+                done.add(entry["task"])
+    return done
+
+
+def run(manifest, out_dir, workers=None, fmt="jsonl", jobs_per_shard=JOBS_PER_SHARD, email=None):
+    """Run the jobs of a manifest, skipping the tasks already done in out_dir. Returns the number of failed tasks."""
+    if fmt == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit("Parquet shards need pyarrow (pip install pyarrow).")
+
+    Entrez.email = email
+    jobs = read_manifest(manifest)
+    tasks = make_tasks(jobs, jobs_per_shard)
+    start_run(out_dir, manifest_digest(manifest, jobs_per_shard))
+    done = read_checkpoint(out_dir)
+    todo = [i for i in range(len(tasks)) if i not in done]
+    print(f"{len(jobs)} jobs in {len(tasks)} tasks, {len(tasks) - len(todo)} already done.")
+    if not todo:
+        return 0
+
+    missing_promoters, missing_motifs = prefetch([job for i in todo for job in tasks[i]])
+    failures = 0
+    ready = []
+    for i in todo:
+        message = missing_data(tasks[i], missing_promoters, missing_motifs)
+        if message is None:
+            ready.append(i)
+        else:
+            failures += 1
+            print(f"Task {i} failed: {message}.")
+    if not ready:
+        return failures
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers or parallel.WORKERS, mp_context=context, initializer=init_worker, initargs=(email,)
+    ) as executor, open(os.path.join(out_dir, CHECKPOINT), "a") as checkpoint:
+        futures = {executor.submit(run_task, i, tasks[i], out_dir, fmt): i for i in ready}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                path = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"Task {i} failed: {e}")
+                continue
+            checkpoint.write(json.dumps({"task": i, "shard": path, "jobs": [job["id"] for job in tasks[i]]}) + "\n")
+            checkpoint.flush()
+            print(f"Task {i} done ({len(tasks[i])} jobs), {path}.")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the TFBS searches of a manifest offline.")
+    parser.add_argument("manifest", help="JSONL or CSV file of jobs")
+    parser.add_argument("out_dir", help="directory of the result shards")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (TFBS_WORKERS by default)")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--jobs-per-shard", type=int, default=JOBS_PER_SHARD)
+    parser.add_argument("--email", default=None, help="email sent to NCBI with the downloads")
+    args = parser.parse_args()
+
+    failures = run(args.manifest, args.out_dir, args.workers, args.format, args.jobs_per_shard, args.email)
+    if failures:
+        raise SystemExit(f"{failures} task(s) failed, run the same command again to resume.")
+
+
+if __name__ == "__main__":
+    main()
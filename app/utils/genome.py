@@ -0,0 +1,263 @@
+"""Motif scanning over a local reference genome.
+
+Whole chromosomes, or the regions of a BED file, are read from a FASTA file indexed by a samtools-style .fai
+file, or from a UCSC .2bit file. Both are memory-mapped and scanned in chunks of chunk_size bases, each chunk
+being extended by motif_length - 1 bases so that the windows overlapping two chunks are scored once, in the
+chunk where they start. Memory only depends on the chunk size, whatever the size of the genome.
+
+Scores are the log-odds of score_encoded, the same as scan_sequence. Hits are streamed to a BED file (one
+line per hit, with the strand) or to a compact binary file of HIT_DTYPE records:
+
+    python -m app.utils.genome hg38.fa MA0114.4 --threshold 8 --out hits.bed
+    python -m app.utils.genome hg38.2bit MA0114.4 --bed promoters.bed --format bin --out hits.bin
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from app.utils.motif_store import get_pssm
+from app.utils.scan import INVALID, _CODES, pssm_matrix, score_encoded
+
+CHUNK_SIZE = 1_000_000
+
+# Record of the binary output, chrom is the index of the chromosome in the names of the .json sidecar file.
+HIT_DTYPE = np.dtype([("chrom", "<u4"), ("start", "<u8"), ("strand", "i1"), ("score", "<f4")])
+
+TWOBIT_SIGNATURE = 0x1A412743
+
+# 2bit packs T, C, A, G as 0, 1, 2, 3, this maps them to the codes of app.utils.scan (A=0, C=1, G=2, T=3).
+_TWOBIT_CODES = np.array([3, 1, 0, 2], dtype=np.uint8)
+# Byte -> its 4 base codes, most significant bits first.
+_TWOBIT_UNPACK = _TWOBIT_CODES[
+    (np.arange(256, dtype=np.uint8)[:, None] >> np.array([6, 4, 2, 0], dtype=np.uint8)) & 3
+]
+
+
+class FastaGenome:
+    """Memory-mapped FASTA file, read through its .fai index."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = dict()
+        with open(path + ".fai") as handle:
+            for line in handle:
+                name, length, offset, line_bases, line_bytes = line.split("\t")[:5]
+                self.index[name] = (int(length), int(offset), int(line_bases), int(line_bytes))
+        self._handle = open(path, "rb")
+        self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def lengths(self):
+        """Return {chromosome: length}, in the order of the index."""
+        return {name: entry[0] for name, entry in self.index.items()}
+
+    def codes(self, chrom, start, end):
+        """Return the base codes of chrom[start:end] as a uint8 array."""
+        length, offset, line_bases, line_bytes = self.index[chrom]
+        end = min(end, length)
+        first = offset + (start // line_bases) * line_bytes + start % line_bases
+        last = offset + (end // line_bases) * line_bytes + end % line_bases
+        raw = np.frombuffer(self._mmap[first:last], dtype=np.uint8)
+        # Drop the line ends, they are the only bytes that are not letters.
+        return _CODES[raw[(raw != ord("\n")) & (raw != ord("\r"))]]
+
+    def close(self):
+        self._mmap.close()
+        self._handle.close()
+
+
+class TwoBitGenome:
+    """Memory-mapped UCSC .2bit file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._handle = open(path, "rb")
+        self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        signature = struct.unpack("<I", self._mmap[:4])[0]
+        self._endian = "<" if signature == TWOBIT_SIGNATURE else ">"
+        if struct.unpack(self._endian + "I", self._mmap[:4])[0] != TWOBIT_SIGNATURE:
+            raise ValueError(f"{path} is not a .2bit file")
+        _, _, count, _ = struct.unpack(self._endian + "4I", self._mmap[:16])
+
+        self.index = dict()  # chromosome -> (length, packed DNA offset, N blocks starts, N blocks ends).
+        pos = 16
+        for _ in range(count):
+            size = self._mmap[pos]
+            name = self._mmap[pos + 1 : pos + 1 + size].decode("ascii")
+            pos += 1 + size
+            (record_offset,) = struct.unpack(self._endian + "I", self._mmap[pos : pos + 4])
+            pos += 4
+            self.index[name] = self._read_record(record_offset)
+
+    def _uint32s(self, offset, count):
+        return np.frombuffer(self._mmap, dtype=self._endian + "u4", count=count, offset=offset).astype(np.int64)
+
+    def _read_record(self, offset):
+        length, n_blocks = struct.unpack(self._endian + "2I", self._mmap[offset : offset + 8])
+        offset += 8
+        n_starts = self._uint32s(offset, n_blocks)
+        n_sizes = self._uint32s(offset + 4 * n_blocks, n_blocks)
+        offset += 8 * n_blocks
+        (mask_blocks,) = struct.unpack(self._endian + "I", self._mmap[offset : offset + 4])
+        # Soft-masked blocks are skipped, case does not change the scores.
+        offset += 4 + 8 * mask_blocks + 4
+        return length, offset, n_starts, n_starts + n_sizes
+
+    def lengths(self):
+        """Return {chromosome: length}, in the order of the index."""
+        return {name: entry[0] for name, entry in self.index.items()}
+
+    def codes(self, chrom, start, end):
+        """Return the base codes of chrom[start:end] as a uint8 array."""
+        length, offset, n_starts, n_ends = self.index[chrom]
+        end = min(end, length)
+        if end <= start:
+            return np.empty(0, dtype=np.uint8)
+        packed = np.frombuffer(self._mmap[offset + start // 4 : offset + (end + 3) // 4], dtype=np.uint8)
+        codes = _TWOBIT_UNPACK[packed].ravel()[start % 4 : start % 4 + end - start]
+        for block in np.flatnonzero((n_starts < end) & (n_ends > start)):
+            codes[max(n_starts[block], start) - start : min(n_ends[block], end) - start] = INVALID
+        return codes
+
+    def close(self):
+        self._mmap.close()
+        self._handle.close()
+
+
+def open_genome(path):
+    """Open a .2bit file, or a FASTA file with a .fai index."""
+    if path.endswith(".2bit"):
+        return TwoBitGenome(path)
+    return FastaGenome(path)
+
+
+def read_bed(path):
+    """Yield the (chromosome, start, end) regions of a BED file."""
+    with open(path) as handle:
+        for line in handle:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            fields = line.split("\t") if "\t" in line else line.split()
+            yield fields[0], int(fields[1]), int(fields[2])
+
+
+def scan_region(genome, matrix, chrom, start, end, scorethreshold, chunk_size=CHUNK_SIZE):
+    """Scan chrom[start:end] of a genome with a log-odds matrix, chunk_size bases at a time.
+
+    Yields, for each chunk, the arrays of the genomic start positions, strands (1 or -1) and scores of the
+    hits whose window lies in the region, sorted by position.
+    """
+    motif_length = matrix.shape[0]
+    end = min(end, genome.lengths()[chrom])
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        # Extend the chunk so that every window starting in it is complete.
+        codes = genome.codes(chrom, chunk_start, min(chunk_end + motif_length - 1, end))
+        forward, reverse = score_encoded(matrix, codes[None, :])
+        forward, reverse = forward[0], reverse[0]
+        with np.errstate(invalid="ignore"):
+            pos_offsets = np.flatnonzero(forward >= scorethreshold)
+            neg_offsets = np.flatnonzero(reverse >= scorethreshold)
+        offsets = np.concatenate([pos_offsets, neg_offsets])
+        order = np.argsort(offsets, kind="stable")
+        strands = np.concatenate(
+            [np.ones(len(pos_offsets), dtype=np.int8), -np.ones(len(neg_offsets), dtype=np.int8)]
+        )
+        scores = np.concatenate([forward[pos_offsets], reverse[neg_offsets]])
+        yield chunk_start + offsets[order], strands[order], scores[order]
+
+
+def scan_genome(
+    genome,
+    matrix,
+    scorethreshold,
+    regions=None,
+    chunk_size=CHUNK_SIZE,
+):
+    """Scan the regions (all the chromosomes by default) of a genome.
+
+    Yields (chromosome, starts, strands, scores) for each chunk, see scan_region.
+    """
+    if regions is None:
+        regions = ((chrom, 0, length) for chrom, length in genome.lengths().items())
+    for chrom, start, end in regions:
+        for starts, strands, scores in scan_region(
+            genome, matrix, chrom, start, end, scorethreshold, chunk_size
+        ):
+            yield chrom, starts, strands, scores
+
+
+def write_bed(hits, handle, motif_length, name):
+    """Write the hits of scan_genome as BED lines, returns the number of hits."""
+    count = 0
+    for chrom, starts, strands, scores in hits:
+        for start, strand, score in zip(starts.tolist(), strands.tolist(), scores.tolist()):
+            handle.write(
+                f"{chrom}\t{start}\t{start + motif_length}\t{name}\t{score:.3f}\t{'+' if strand > 0 else '-'}\n"
+            )
+        count += len(starts)
+    return count
+
+
+def write_binary(hits, path, chromosomes):
+    """Write the hits of scan_genome as HIT_DTYPE records, with the chromosome names in path + ".json".
+
+    Returns the number of hits.
+    """
+    chrom_index = {chrom: i for i, chrom in enumerate(chromosomes)}
+    count = 0
+    with open(path, "wb") as handle:
+        for chrom, starts, strands, scores in hits:
+            records = np.empty(len(starts), dtype=HIT_DTYPE)
+            records["chrom"] = chrom_index[chrom]
+            records["start"] = starts
+            records["strand"] = strands
+            records["score"] = scores
+            records.tofile(handle)
+            count += len(records)
+    with open(path + ".json", "w") as handle:
+        json.dump({"chromosomes": list(chromosomes), "dtype": HIT_DTYPE.descr}, handle)
+    return count
+
+
+def read_binary(path):
+    """Return the chromosome names and the HIT_DTYPE records of a binary hits file."""
+    with open(path + ".json") as handle:
+        chromosomes = json.load(handle)["chromosomes"]
+    return chromosomes, np.fromfile(path, dtype=HIT_DTYPE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan a local genome (FASTA + .fai, or .2bit) for a motif.")
+    parser.add_argument("genome", help="FASTA file indexed by a .fai file, or .2bit file")
+    parser.add_argument("motif", help="JASPAR matrix id")
+    parser.add_argument("--threshold", type=float, default=8.0)
+    parser.add_argument("--pseudocount", type=float, default=0.5)
+    parser.add_argument("--bed", help="only scan the regions of this BED file")
+    parser.add_argument("--out", required=True, help="output file")
+    parser.add_argument("--format", choices=("bed", "bin"), default="bed")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    pssm, tf_name = get_pssm(args.motif, args.pseudocount)
+    matrix = pssm_matrix(pssm)
+    genome = open_genome(args.genome)
+    try:
+        regions = read_bed(args.bed) if args.bed else None
+        hits = scan_genome(genome, matrix, args.threshold, regions, args.chunk_size)
+        if args.format == "bed":
+            with open(args.out, "w") as handle:
+                count = write_bed(hits, handle, matrix.shape[0], args.motif)
+        else:
+            count = write_binary(hits, args.out, list(genome.lengths()))
+    finally:
+        genome.close()
+    print(f"{count} hits of {args.motif} ({tf_name}) written to {args.out}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Columnar representation of the hits of a motif over a set of sequences.
+
+A HitTable holds the hits as contiguous NumPy arrays (sequence index, position, strand, score) instead of a
+dictionnary of lists of tuples. Rows are sorted by sequence, then by offset on the sequence, in the order of
+Bio.motifs search, including the hits of both strands at the same offset (see bio_order). The rows of a
+sequence are a contiguous range of the arrays, so slicing them never copies.
+
+Positions follow the Bio.motifs convention: offsets on the positive strand, offset - len(sequence) on the
+negative strand. The strand-adjusted positions used by the window search depend on the promoter length,
+they are computed by adjusted(prom_len).
+
+For compatibility, a HitTable also reads like the former {sequence id: [(position, score), ...]} mapping.
+"""
+
+import numpy as np
+
+
+def bio_order(offsets):
+    """Return the order of the hits of a sequence in Bio.motifs search, from the offsets of its hits.
+
+    offsets holds the offsets of the positive strand hits, then those of the negative strand hits, both
+    ascending. Bio.motifs sorts them with the default (unstable) np.argsort, so the order of two hits at the
+    same offset is not fixed by strand: only the same call on the same array gives the same order.
+    """
+    return np.argsort(offsets)
+
+
+class HitTable:
+    """Hits of a motif over a set of sequences, as contiguous arrays sorted by sequence then position."""
+
+    def __init__(self, seq, position, strand, score, ids):
+        self.seq = seq
+        self.position = position
+        self.strand = strand
+        self.score = score
+        self.ids = list(ids)
+        # Rows of the sequence i are bounds[i]:bounds[i + 1].
+        self.bounds = np.searchsorted(seq, np.arange(len(self.ids) + 1))
+        self._sorted = dict()
+
+    @classmethod
+    def from_scores(cls, forward, reverse, lengths, scorethreshold, ids=None):
+        """Build the table of the scores above scorethreshold of (n_sequences, n_offsets) score arrays."""
+        pos_seq, pos_offsets = np.nonzero(forward >= scorethreshold)
+        neg_seq, neg_offsets = np.nonzero(reverse >= scorethreshold)
+        seq = np.concatenate([pos_seq, neg_seq]).astype(np.int32)
+        offsets = np.concatenate([pos_offsets, neg_offsets]).astype(np.int64)
+        strand = np.concatenate(
+            [np.ones(len(pos_seq), dtype=np.int8), -np.ones(len(neg_seq), dtype=np.int8)]
+        )
+        score = np.concatenate(
+            [forward[pos_seq, pos_offsets], reverse[neg_seq, neg_offsets]]
+        ).astype(np.float32)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        position = np.where(strand > 0, offsets, offsets - lengths[seq])
+
+        # Sort by sequence, then offset. Only the sequences with hits of both strands at the same offset
+        # depend on the sort, they are sorted again the way Bio.motifs does.
+        order = np.lexsort((strand < 0, offsets, seq))
+        sorted_seq, sorted_offsets = seq[order], offsets[order]
+        tied = (sorted_seq[1:] == sorted_seq[:-1]) & (sorted_offsets[1:] == sorted_offsets[:-1])
+        for i in np.unique(sorted_seq[1:][tied]):
+            pos_rows = np.arange(*np.searchsorted(pos_seq, [i, i + 1]))
+            neg_rows = len(pos_seq) + np.arange(*np.searchsorted(neg_seq, [i, i + 1]))
+            rows = np.concatenate([pos_rows, neg_rows])
+            start = np.searchsorted(sorted_seq, i)
+            order[start : start + len(rows)] = rows[bio_order(offsets[rows])]
+        if ids is None:
+            ids = range(forward.shape[0])
+        return cls(seq[order], position[order], strand[order], score[order], ids)
+
+    @classmethod
+    def concat(cls, tables, ids=None):
+        """Concatenate the tables of consecutive sets of sequences into one table."""
+        offsets = np.cumsum([0] + [len(table.ids) for table in tables])
+        seq = np.concatenate([table.seq + offset for table, offset in zip(tables, offsets)])
+        if ids is None:
+            ids = [seq_id for table in tables for seq_id in table.ids]
+        return cls(
+            seq.astype(np.int32),
+            np.concatenate([table.position for table in tables]),
+            np.concatenate([table.strand for table in tables]),
+            np.concatenate([table.score for table in tables]),
+            ids,
+        )
+
+    def with_ids(self, ids):
+        """Return the same hits (the arrays are shared) with other sequence ids."""
+        return HitTable(self.seq, self.position, self.strand, self.score, ids)
+
+    def sequences(self, start, stop):
+        """Return the table of the sequences at indices start to stop (the arrays are views on this table)."""
+        rows = slice(int(self.bounds[start]), int(self.bounds[stop]))
+        return HitTable(
+            self.seq[rows] - start, self.position[rows], self.strand[rows], self.score[rows], self.ids[start:stop]
+        )
+
+    def rows(self, i):
+        """Return the slice of the rows of the sequence at index i."""
+        return slice(int(self.bounds[i]), int(self.bounds[i + 1]))
+
+    def adjusted(self, prom_len):
+        """Return the strand-adjusted positions, the - strand positions being corrected with prom_len."""
+        return np.where(self.position < 0, prom_len + self.position + 1, self.position)
+
+    def sorted_adjusted(self, prom_len):
+        """Return the row indices sorted by sequence then adjusted position, and the sorted adjusted positions.
+
+        Computed once per prom_len. Within the rows of a sequence, the ties keep the order of the table.
+        """
+        if prom_len not in self._sorted:
+            adjusted = self.adjusted(prom_len)
+            order = np.lexsort((adjusted, self.seq))
+            self._sorted[prom_len] = order, adjusted[order]
+        return self._sorted[prom_len]
+
+    def in_range(self, i, start, end, prom_len):
+        """Return the rows of the hits of the sequence at index i whose adjusted position is in [start, end)."""
+        order, sorted_adjusted = self.sorted_adjusted(prom_len)
+        rows = self.rows(i)
+        lo, hi = np.searchsorted(sorted_adjusted[rows], [start, end]) + rows.start
+        return np.sort(order[lo:hi])
+
+    def hit(self, row):
+        """Return the (position, score) couple of a row."""
+        return self.position[row], self.score[row]
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __eq__(self, other):
+        if not isinstance(other, HitTable):
+            return NotImplemented
+        return self.ids == other.ids and all(
+            np.array_equal(getattr(self, name), getattr(other, name))
+            for name in ("seq", "position", "strand", "score")
+        )
+
+    def __getstate__(self):
+        # The sorted orders are recomputed on demand.
+        state = dict(self.__dict__)
+        state["_sorted"] = dict()
+        return state
+
+    # Read access as a {sequence id: [(position, score), ...]} mapping.
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, seq_id):
+        return seq_id in self.ids
+
+    def __getitem__(self, seq_id):
+        rows = self.rows(self.ids.index(seq_id))
+        return list(zip(self.position[rows], self.score[rows]))
+
+    def keys(self):
+        return list(self.ids)
+
+    def values(self):
+        return [self[seq_id] for seq_id in self.ids]
+
+    def items(self):
+        return [(seq_id, self[seq_id]) for seq_id in self.ids]
@@ -0,0 +1,281 @@
+"""Background jobs for long-running TFBS searches.
+
+A job runs a search on a bounded pool of threads and records its status (pending, running, done or failed),
+the phase it is in (download, scan, window) and, once done, its result. Jobs are kept in a JobStore:
+MemoryJobStore by default, or SQLiteJobStore to share them between the workers of a node and keep them
+across restarts. The TFBS_JOB_STORE environment variable selects the store ("memory", or "sqlite:<path>").
+
+Identical requests share the same job while it is in flight or its result is still kept, finished jobs
+are dropped ttl seconds (TFBS_JOB_TTL) after their last update. Each job records the process running it
+(host:pid), the SQLiteJobStore marks the jobs in flight of a process that is gone as failed, when it opens
+and before it looks up or purges jobs, so that a restart never leaves a request stuck on a dead job.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+JOB_WORKERS = int(os.environ.get("TFBS_JOB_WORKERS", 2))
+JOB_TTL = float(os.environ.get("TFBS_JOB_TTL", 3600))
+JOB_STORE = os.environ.get("TFBS_JOB_STORE", "memory")
+
+FIELDS = ("id", "key", "status", "phase", "created", "updated", "result", "error", "owner")
+INTERRUPTED = "The server stopped before the job finished."
+
+logger = logging.getLogger(__name__)
+
+
+def job_owner():
+    """Return the owner of the jobs started by this process, host:pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def owner_alive(owner):
+    """Return whether the process owning a job may still run it, those of other hosts are assumed alive."""
+    host, _, pid = (owner or "").rpartition(":")
+    if host != socket.gethostname():
+        return owner is not None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def request_key(params):
+    """Return a key identifying a request from its (JSON serializable) parameters."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class JobStore:
+    """Interface of the job stores, jobs are dictionnaries with the keys of FIELDS."""
+
+    def add(self, job):
+        raise NotImplementedError
+
+    def get(self, job_id):
+        """Return a job, or None if it does not exist (or has expired)."""
+        raise NotImplementedError
+
+    def update(self, job_id, **fields):
+        raise NotImplementedError
+
+    def find(self, key):
+        """Return the job of a request key that is in flight or done, or None."""
+        raise NotImplementedError
+
+    def purge(self, before):
+        """Remove the finished jobs last updated before the given time."""
+        raise NotImplementedError
+
+
+class MemoryJobStore(JobStore):
+    """Jobs kept in the memory of the process."""
+
+    def __init__(self):
+        self._jobs = dict()
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def find(self, key):
+        with self._lock:
+            for job in self._jobs.values():
+                if job["key"] == key and job["status"] != FAILED:
+                    return dict(job)
+        return None
+
+    def purge(self, before):
+        with self._lock:
+            for job_id in [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job["status"] in (DONE, FAILED) and job["updated"] < before
+            ]:
+                del self._jobs[job_id]
+
+
+class SQLiteJobStore(JobStore):
+    """Jobs kept in a local SQLite database, results are stored as JSON."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, key TEXT, status TEXT, phase TEXT,"
+                " created REAL, updated REAL, result TEXT, error TEXT, owner TEXT)"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+            if "owner" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+            # A process with the pid of this one is gone, its jobs were left in flight.
+            self._fail_orphans(job_owner())
+
+    def _fail_orphans(self, gone=None):
+        """Mark as failed the jobs in flight of the processes that are gone, with the lock held."""
+        owners = [
+            owner
+            for (owner,) in self._conn.execute(
+                "SELECT DISTINCT owner FROM jobs WHERE status IN (?, ?)", (PENDING, RUNNING)
+            )
+        ]
+        dead = [owner for owner in owners if owner == gone or not owner_alive(owner)]
+        for owner in dead:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE status IN (?, ?) AND owner IS ?",
+                (FAILED, INTERRUPTED, time.time(), PENDING, RUNNING, owner),
+            )
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = dict(zip(FIELDS, row))
+        if job["result"] is not None:
+            job["result"] = json.loads(job["result"])
+        return job
+
+    def add(self, job):
+        job = dict(job, result=json.dumps(job["result"]) if job["result"] is not None else None)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT INTO jobs ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))})",
+                [job[field] for field in FIELDS],
+            )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(FIELDS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._job(row)
+
+    def update(self, job_id, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"UPDATE jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                [*fields.values(), job_id],
+            )
+
+    def find(self, key):
+        with self._lock, self._conn:
+            self._fail_orphans()
+            row = self._conn.execute(
+                f"SELECT {', '.join(FIELDS)} FROM jobs WHERE key = ? AND status != ?"
+                " ORDER BY created DESC LIMIT 1",
+                (key, FAILED),
+            ).fetchone()
+        return self._job(row)
+
+    def purge(self, before):
+        with self._lock, self._conn:
+            self._fail_orphans()
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?", (DONE, FAILED, before)
+            )
+
+
+def make_store(spec=JOB_STORE):
+    """Create the job store described by spec, "memory" or "sqlite:<path>"."""
+    if spec == "memory":
+        return MemoryJobStore()
+    if spec.startswith("sqlite:"):
+        return SQLiteJobStore(spec[len("sqlite:") :])
+    raise ValueError(f"Unknown job store: {spec}")
+
+
+class JobManager:
+    """Run jobs on a bounded pool of threads and keep track of them in a JobStore."""
+
+    def __init__(self, store=None, workers=JOB_WORKERS, ttl=JOB_TTL):
+        self.store = store if store is not None else make_store()
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tfbs-job")
+        self._lock = threading.Lock()
+
+    def submit(self, params, func):
+        """Start func(progress) for a request, unless an identical request already has a job.
+
+        func receives a progress(phase) callback and returns the (JSON serializable) result of the job.
+        Returns the job.
+        """
+        key = request_key(params)
+        now = time.time()
+        with self._lock:
+            self.store.purge(now - self.ttl)
+            job = self.store.find(key)
+            if job is not None:
+                return job
+            job = dict.fromkeys(FIELDS)
+            job.update(
+                id=uuid.uuid4().hex, key=key, status=PENDING, created=now, updated=now, owner=job_owner()
+            )
+            self.store.add(job)
+        self._executor.submit(self._run, job["id"], func)
+        return job
+
+    def get(self, job_id):
+        """Return a job, or None if it does not exist or has expired."""
+        self.store.purge(time.time() - self.ttl)
+        return self.store.get(job_id)
+
+    def _run(self, job_id, func):
+        def progress(phase):
+            self.store.update(job_id, status=RUNNING, phase=phase, updated=time.time())
+
+        self.store.update(job_id, status=RUNNING, updated=time.time())
+        try:
+            result = func(progress)
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            self.store.update(job_id, status=FAILED, error=str(e), updated=time.time())
+        else:
+            self.store.update(job_id, status=DONE, result=result, updated=time.time())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """Return the process-wide JobManager, created on first use."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
@@ -0,0 +1,137 @@
+"""Counters, histograms and timing spans, exported in the Prometheus text format by /metrics.
+
+Stages of the pipeline are timed with span(stage), which records their duration in the tfbs_stage_seconds
+histogram and, when the request asked for it (see profiling), in the stage breakdown of the request.
+Values owned by other modules (e.g. cache statistics) are added to the export by register_collector.
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_collectors = []
+_lock = threading.Lock()
+
+# Stage breakdown of the current request, {stage: seconds}, None when it is not profiled.
+_profile = contextvars.ContextVar("tfbs_profile", default=None)
+
+
+def _labels_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels."""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = dict()
+        with _lock:
+            _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels_text(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histogram of observed values with cumulative buckets, optionally split by labels."""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = dict()  # labels -> [bucket counts..., sum, count]
+        with _lock:
+            _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with _lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, counts in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, [('le', '+Inf')])} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {counts[-2]}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {counts[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("tfbs_stage_seconds", "Duration of the stages of the searches.", ["stage"])
+REQUEST_SECONDS = Histogram("tfbs_request_seconds", "Duration of the HTTP requests.", ["method", "path"])
+ENTREZ_CALLS = Counter("tfbs_entrez_calls_total", "Calls to the NCBI E-utilities.", ["utility", "outcome"])
+HITS = Counter("tfbs_hits_total", "TFBS hits found by the scans.")
+WINDOWS = Counter("tfbs_windows_total", "Windows returned by the searches.")
+
+
+def register_collector(collect):
+    """Add a function returning {metric name: value} to the export, its values are exported as gauges."""
+    with _lock:
+        _collectors.append(collect)
+
+
+@contextmanager
+def span(stage):
+    """Time a stage of a search."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        profile = _profile.get()
+        if profile is not None:
+            profile[stage] = profile.get(stage, 0) + elapsed
+
+
+def start_profile():
+    """Start recording the stage breakdown of the current request, returns the {stage: seconds} dict."""
+    profile = dict()
+    _profile.set(profile)
+    return profile
+
+
+def server_timing(profile):
+    """Format a stage breakdown as a Server-Timing header value (durations in milliseconds)."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in profile.items())
+
+
+def render():
+    """Return all the metrics in the Prometheus text format."""
+    with _lock:
+        metrics = list(_registry)
+        collectors = list(_collectors)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for collect in collectors:
+        for name, value in collect().items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
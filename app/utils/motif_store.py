@@ -0,0 +1,225 @@
+"""On-disk store of JASPAR matrices with an in-process cache of log-odds PSSMs.
+
+All the matrices of a JASPAR release are kept in a single index file, ./data/motifs/jaspar<release>.json.
+Motifs are looked up in this index first, then in the legacy ./data/motifs/<id>.jaspar files, and only
+downloaded from the JASPAR API as a last resort (and then added to the index).
+
+Several processes may add motifs to the same index: the read-modify-write of the index file holds an
+exclusive fcntl lock on jaspar<release>.json.lock, and re-reads the file under it, so that the motifs added by
+the others are kept.
+
+The index can be filled offline from a JASPAR flat file dump:
+
+    python -m app.utils.motif_store import JASPAR2020_CORE_non-redundant_pfms_jaspar.txt
+    python -m app.utils.motif_store stats
+"""
+
+import argparse
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+
+from app.utils import upstream
+from app.utils.background import UNIFORM
+from app.utils.utils import download_motif
+
+JASPAR_RELEASE = "2020"
+MOTIFS_DIR = "./data/motifs"
+PSSM_CACHE_SIZE = 1024
+
+logger = logging.getLogger(__name__)
+
+counters = Counter()  # index_hits, file_hits, downloads.
+
+_index = dict()  # release -> loaded index.
+_lock = threading.Lock()
+
+
+def index_path(release=JASPAR_RELEASE):
+    """Return the path of the index file of a JASPAR release."""
+    return os.path.join(MOTIFS_DIR, f"jaspar{release}.json")
+
+
+def load_index(release=JASPAR_RELEASE):
+    """Return the index of a release, {"release": ..., "motifs": {motif_id: {"name": ..., "counts": ...}}}.
+
+    The file is read once per process, an empty index is returned if it does not exist yet.
+    """
+    with _lock:
+        if release not in _index:
+            path = index_path(release)
+            if os.path.exists(path):
+                with open(path) as handle:
+                    _index[release] = json.load(handle)
+            else:
+                _index[release] = {"release": release, "motifs": {}}
+        return _index[release]
+
+
+@contextmanager
+def index_lock(release=JASPAR_RELEASE):
+    """Hold the lock of the index file of a release, shared by the processes writing it."""
+    os.makedirs(MOTIFS_DIR, exist_ok=True)
+    with open(index_path(release) + ".lock", "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def add_motifs(motif_list, release=JASPAR_RELEASE):
+    """Add Bio.motifs Motif objects to the index of a release and write it back to disk.
+
+    The motifs added to the file by other processes since it was loaded are merged into the index first.
+    Returns the number of motifs added or updated.
+    """
+    index = load_index(release)
+    path = index_path(release)
+    with _lock, index_lock(release):
+        if os.path.exists(path):
+            with open(path) as handle:
+                index["motifs"].update(json.load(handle)["motifs"])
+        for m in motif_list:
+            index["motifs"][m.matrix_id] = {
+                "name": m.name,
+                "counts": {letter: [float(x) for x in m.counts[letter]] for letter in "ACGT"},
+            }
+        # Write to a temporary file first so that readers never see a partial index.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as handle:
+            json.dump(index, handle)
+        os.replace(tmp_path, path)
+    return len(motif_list)
+
+
+def resolve_id(motif_id, index):
+    """Return the id under which motif_id is stored in the index, or None.
+
+    An id without version (e.g. MA0114) resolves to the latest version stored (e.g. MA0114.4).
+    """
+    if motif_id in index["motifs"]:
+        return motif_id
+    versions = [key for key in index["motifs"] if key.split(".")[0] == motif_id]
+    if not versions:
+        return None
+    return max(versions, key=lambda key: int(key.split(".")[1]) if "." in key else 0)
+
+
+def motif_version(motif_id, release=JASPAR_RELEASE):
+    """Return the id of the version of a motif in the store (see resolve_id), adding it to the store if needed."""
+    return resolve_id(motif_id, load_index(release)) or get_motif(motif_id, release).matrix_id
+
+
+def get_motif(motif_id, release=JASPAR_RELEASE):
+    """Return the Bio.motifs Motif object of a JASPAR matrix id."""
+    # Bio.motifs is imported on first use, see app.utils.warmup.
+    from Bio import motifs
+
+    index = load_index(release)
+    key = resolve_id(motif_id, index)
+    if key is not None:
+        counters["index_hits"] += 1
+        entry = index["motifs"][key]
+        m = motifs.Motif(counts=entry["counts"])
+        m.matrix_id = key
+        m.name = entry["name"]
+        return m
+
+    motif_file_path = os.path.join(MOTIFS_DIR, f"{motif_id}.jaspar")
+    if os.path.exists(motif_file_path):
+        counters["file_hits"] += 1
+    else:
+        counters["downloads"] += 1
+        os.makedirs(MOTIFS_DIR, exist_ok=True)
+        download_motif(motif_id, MOTIFS_DIR)
+
+    with open(motif_file_path) as handle:
+        m = motifs.read(handle, "jaspar")
+    m.matrix_id = motif_id
+    add_motifs([m], release)
+    return m
+
+
+async def prefetch_motifs(motif_ids, release=JASPAR_RELEASE):
+    """Download the motifs missing from the store with the async JASPAR client (see app.utils.upstream).
+
+    Once done, get_motif reads all of them from the store without any network call.
+    """
+    index = load_index(release)
+    missing = [
+        motif_id
+        for motif_id in dict.fromkeys(motif_ids)
+        if resolve_id(motif_id, index) is None
+        and not os.path.exists(os.path.join(MOTIFS_DIR, f"{motif_id}.jaspar"))
+    ]
+    if missing:
+        os.makedirs(MOTIFS_DIR, exist_ok=True)
+        counters["downloads"] += len(missing)
+        await asyncio.gather(*(upstream.download_motif(motif_id, MOTIFS_DIR) for motif_id in missing))
+
+
+@lru_cache(maxsize=PSSM_CACHE_SIZE)
+def get_pssm(motif_id, pseudocount, release=JASPAR_RELEASE, background=UNIFORM):
+    """Return the PositionSpecificScoringMatrix and TF name of a motif.
+
+    The log-odds are computed against background, a tuple of the A, C, G, T probabilities (see
+    app.utils.background). Results are kept in an LRU cache keyed by (motif_id, pseudocount, release,
+    background), the returned PSSM is shared and must not be modified.
+    """
+    m = get_motif(motif_id, release)
+
+    logger.debug("Motif %s:\n%s", motif_id, m.counts)
+
+    pwm = m.counts.normalize(pseudocounts=pseudocount)
+    return pwm.log_odds(background=dict(zip("ACGT", background))), m.name
+
+
+def import_jaspar(path, release=JASPAR_RELEASE):
+    """Load every matrix of a JASPAR flat file (e.g. a full collection dump) into the index."""
+    from Bio import motifs
+
+    with open(path) as handle:
+        motif_list = list(motifs.parse(handle, "jaspar"))
+    return add_motifs(motif_list, release)
+
+
+def cache_stats():
+    """Return the hit/miss counters of the store and of the PSSM cache."""
+    info = get_pssm.cache_info()
+    return {
+        "pssm_hits": info.hits,
+        "pssm_misses": info.misses,
+        "pssm_cached": info.currsize,
+        "index_hits": counters["index_hits"],
+        "file_hits": counters["file_hits"],
+        "downloads": counters["downloads"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the local JASPAR motif store.")
+    parser.add_argument("--release", default=JASPAR_RELEASE, help="JASPAR release of the index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="import a JASPAR flat file dump")
+    import_parser.add_argument("path", nargs="+")
+    subparsers.add_parser("stats", help="print the content of the index")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        for path in args.path:
+            count = import_jaspar(path, args.release)
+            print(f"Imported {count} motifs from {path} into {index_path(args.release)}.")
+    else:
+        index = load_index(args.release)
+        print(f"JASPAR {index['release']}: {len(index['motifs'])} motifs in {index_path(args.release)}.")
+
+
+if __name__ == "__main__":
+    main()
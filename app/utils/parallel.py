@@ -0,0 +1,173 @@
+"""Parallel scanning over a persistent pool of worker processes.
+
+The encoded sequences are copied once into shared memory, and every task only receives the name of the
+shared block and the rows it has to scan, so promoters are never pickled. Tasks are (sequence shard, motif
+chunk) pairs, and their results are merged back in shard order, so the output is the same as a serial
+scan_encoded_batch whatever the number of workers.
+
+The number of workers defaults to the TFBS_WORKERS environment variable, or the number of CPUs.
+"""
+
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from app.utils.hits import HitTable
+from app.utils.scan import motif_thresholds, scan_encoded_batch
+
+WORKERS = int(os.environ.get("TFBS_WORKERS", os.cpu_count() or 1))
+
+# Below this many (base, motif) cells, a serial scan is faster than dispatching to the pool.
+MIN_PARALLEL_WORK = 2_000_000
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def get_executor(workers=None):
+    """Return the process pool, creating it (or resizing it) on first use."""
+    global _executor, _executor_workers
+    workers = workers or WORKERS
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=True)
+            context = multiprocessing.get_context("spawn")
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _executor_workers = workers
+        return _executor
+
+
+def shutdown():
+    """Stop the worker processes of the pool."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+def discard(executor):
+    """Drop a broken pool, so that the next get_executor starts new worker processes."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def use_parallel(codes, n_motifs, workers=None):
+    """Return True if a scan is large enough, and enough workers are configured, to be worth parallelizing."""
+    return (workers or WORKERS) > 1 and codes.size * n_motifs >= MIN_PARALLEL_WORK
+
+
+def shards(n_items, n_shards):
+    """Split range(n_items) into at most n_shards contiguous (start, stop) ranges."""
+    bounds = np.linspace(0, n_items, min(n_shards, n_items) + 1, dtype=int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def attach(shm_name):
+    """Open the shared block of the parent process without registering it with the resource tracker.
+
+    The workers share the resource tracker of the parent, which creates the block and unlinks it, and so owns
+    it: a registration from a worker would be removed twice.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=shm_name, track=False)
+    # Before Python 3.13, attaching to a block always registers it.
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=shm_name)
+    finally:
+        resource_tracker.register = register
+
+
+def _scan_shard(shm_name, shape, rows, matrices, lengths, scorethreshold):
+    """Worker task: scan the given rows of the shared encoded sequences with a chunk of motifs."""
+    shm = attach(shm_name)
+    try:
+        start, stop = rows
+        # Copy the rows out of the block so that no view on it outlives shm.close().
+        codes = np.array(np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)[start:stop])
+    finally:
+        shm.close()
+    return scan_encoded_batch(matrices, codes, lengths[start:stop], scorethreshold)
+
+
+def scan_batch(matrices, codes, lengths, scorethreshold, workers=None):
+    """Scan several motifs over encoded sequences, on the process pool when the scan is large enough.
+
+    Returns the same result as scan_encoded_batch, which is used directly for small scans.
+    """
+    if use_parallel(codes, len(matrices), workers):
+        return parallel_scan(matrices, codes, lengths, scorethreshold, workers)
+    return scan_encoded_batch(matrices, codes, lengths, scorethreshold)
+
+
+def parallel_scan(matrices, codes, lengths, scorethreshold, workers=None, motifs_per_task=16):
+    """Scan several motifs over encoded sequences on the process pool.
+
+    Returns the same result as scan_encoded_batch(matrices, codes, lengths, scorethreshold): for each motif,
+    the HitTable of its hits. If a worker dies (the pool is then broken), the scan is run again once on a new
+    pool, then serially.
+    """
+    workers = workers or WORKERS
+    if not matrices:
+        return []
+    thresholds = motif_thresholds(scorethreshold, len(matrices))
+    shm = shared_memory.SharedMemory(create=True, size=max(codes.nbytes, 1))
+    try:
+        np.ndarray(codes.shape, dtype=np.uint8, buffer=shm.buf)[:] = codes
+        for attempt in range(2):
+            executor = get_executor(workers)
+            try:
+                return pool_scan(
+                    executor, shm.name, matrices, codes, lengths, thresholds, workers, motifs_per_task
+                )
+            except BrokenProcessPool as e:
+                fallback = "retrying on a new pool" if attempt == 0 else "scanning serially"
+                logger.warning("Process pool broken (%s), %s", e, fallback)
+                discard(executor)
+    finally:
+        shm.close()
+        shm.unlink()
+    return scan_encoded_batch(matrices, codes, lengths, scorethreshold)
+
+
+def pool_scan(executor, shm_name, matrices, codes, lengths, thresholds, workers, motifs_per_task):
+    """Scan the encoded sequences copied in the shared block shm_name on the pool, see parallel_scan."""
+    motif_chunks = shards(len(matrices), -(-len(matrices) // motifs_per_task))
+    # Enough sequence shards to keep every worker busy, even with a single motif chunk.
+    seq_shards = shards(codes.shape[0], max(1, -(-workers // len(motif_chunks))))
+    futures = {
+        (m, s): executor.submit(
+            _scan_shard,
+            shm_name,
+            codes.shape,
+            rows,
+            matrices[m_start:m_stop],
+            lengths,
+            thresholds[m_start:m_stop],
+        )
+        for m, (m_start, m_stop) in enumerate(motif_chunks)
+        for s, rows in enumerate(seq_shards)
+    }
+
+    results = []
+    for m, (m_start, m_stop) in enumerate(motif_chunks):
+        shard_results = [futures[m, s].result() for s in range(len(seq_shards))]
+        for k in range(m_stop - m_start):
+            results.append(HitTable.concat([shard[k] for shard in shard_results], range(codes.shape[0])))
+    return results
@@ -1,237 +1,231 @@
-import glob
-import os
+import logging
 import numpy as np
-from Bio import motifs
 from app.utils.utils import *
+from app.utils.background import UNIFORM, resolve_background
+from app.utils.metrics import HITS, WINDOWS, span
+from app.utils.motif_store import JASPAR_RELEASE, get_pssm, motif_version
+from app.utils.seq_store import get_store
+from app.utils.parallel import scan_batch
+from app.utils.hits import HitTable
+from app.utils.result_cache import (
+    GENES_PER_ENTRY,
+    gene_cache,
+    scan_cache,
+    sequence_digest,
+    sequence_set_key,
+    window_cache,
+    window_state_cache,
+)
+from app.utils.score_dist import score_threshold
+from app.utils.scan import (
+    encode_sequences,
+    pssm_matrix,
+    scan_encoded,
+)
+
+
+logger = logging.getLogger(__name__)
+
+SLIDE_STEP = 7  # Arbitrary value to indicate the slide step of the window
+
+
+def pwm2pssm(FPM, psw, background=UNIFORM):
+    """Return TF name and his PositionSpecificScoringMatrix object from a JASPAR matrix id, a given
+    pseudocount and the A, C, G, T probabilities of the background (see app.utils.background).
+
+    The matrix comes from the local motif store (see app.utils.motif_store), which only downloads it
+    from JASPAR when it is not already indexed, and PSSMs are cached per (FPM, psw, background).
+    """
+    return get_pssm(FPM, psw, background=background)
 
 
-def ensure_directory_exists(directory):
-    """Ensure that a directory exists, and create it if it does not."""
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-        print(f"Directory {directory} created.")
-    else:
-        print(f"Directory {directory} already exists.")
-
+def scan_sequence(pssm, seq, scorethreshold):
+    """Return a list of tuples with position and score of hits in the promotor sequences with the psw that are
+    greater or equal to the given scorethreshold.
 
-def pwm2pssm(FPM, psw):
-    """Return TF name and his PositionSpecificScoringMatrix object from a .jaspar file and
-    a given PositionWeigthMAtrix object.
+    Hits are the same as pssm.search(seq, threshold=scorethreshold, both=True), positions on
+    the negative strand are negative. The scoring is done by the vectorized engine of app.utils.scan.
     """
-    motifs_dir = "./data/motifs"
+    codes, lengths = encode_sequences([seq])
+    results = scan_encoded(pssm_matrix(pssm), codes, lengths, scorethreshold)[0]
 
-    # Ensure the motifs directory exists
-    ensure_directory_exists(motifs_dir)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Scanning sequence %s... for threshold %s", seq[:30], scorethreshold)
+        for position, score in results:
+            logger.debug("Position: %s, Score: %s", position, score)
 
-    # Download the motif
-    download_motif(FPM, motifs_dir)
+    return results
 
-    motif_file_path = os.path.join(motifs_dir, f"{FPM}.jaspar")
 
-    with open(motif_file_path) as handle:
-        m = motifs.read(handle, "jaspar")
+def scan_all_sequences(pssm, sequences, scorethreshold):
+    """Create a table of the position/score of the hits of multiple sequences.
 
-    # Debug: Print motif information
-    print(f"Motif {FPM}:")
-    print(m.counts)
+    All the sequences of the {id: sequence} dictionnary are encoded into a single array and scored in one batch
+    (see app.utils.scan), giving for each seq the position and score of the TBFS hits, stored into a HitTable
+    (see app.utils.hits) whose sequence ids are the keys of the dictionnary. Large sets of sequences are
+    sharded across the worker processes of app.utils.parallel.
+    """
 
-    # Get the PSSM from PSW.
-    pssm = m.counts.normalize(pseudocounts=psw).log_odds()
+    codes, lengths = encode_sequences(list(sequences.values()))
+    hits = scan_batch([pssm_matrix(pssm)], codes, lengths, scorethreshold)[0]
+    HITS.inc(len(hits))
 
-    return pssm, m.name
+    # Reads like {id1:[(pos,score,),...],id2:[(pos2,score2),..],....}
+    return hits.with_ids(list(sequences))
 
 
-def scan_sequence(pssm, seq, scorethreshold):
-    """Return a list of tuples with position and score of hits in the promotor sequences with the psw that are
-    greater or equal to the given scorethreshold.
+def sorted_hits(sas, prom_len):
+    """Sort once the strand-adjusted hit positions of each sequence of a HitTable.
 
-    Note: both=False refers to only positions on the positive strand.
+    Returns, for each sequence of sas (in order), a tuple with its id, its first row in the table, the adjusted
+    positions in the original hit order, the hit indices sorted by adjusted position and the sorted adjusted
+    positions. The arrays are views on the table (see HitTable.sorted_adjusted).
     """
-    results = list(pssm.search(seq, threshold=scorethreshold, both=True))
+    # Positions on the - strand are negative, same correction as benchmarks.reference.score_window.
+    adjusted = sas.adjusted(prom_len)
+    order, sorted_adjusted = sas.sorted_adjusted(prom_len)
+    hits = []
+    for k, item in enumerate(sas.ids):
+        rows = sas.rows(k)
+        hits.append(
+            (item, rows.start, adjusted[rows], order[rows] - rows.start, sorted_adjusted[rows].tolist())
+        )
+    return hits
+
+
+def proximity_values(samples, seuil):
+    """Return the distance ratios lower than seuil of consecutive rows of adjusted positions, in row order.
+
+    Every position of a row is compared with every position of the next row.
+    """
+    valid_scores = []
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for curr_row, next_row in zip(samples, samples[1:]):
+            percentage_matrix = np.abs(curr_row[:, None] - next_row) / next_row
+            valid_scores.append(percentage_matrix[percentage_matrix < seuil])
+    return np.concatenate(valid_scores) if valid_scores else np.empty(0)
 
-    # Debug: Print scan results
-    print(f"Scanning sequence {seq[:30]}... for threshold {scorethreshold}")
-    for position, score in results:
-        print(f"Position: {position}, Score: {score}")
 
-    return results
+def proximity_score(samples, seuil):
+    """Score the proximity of the rows of adjusted positions of a window, as the reference score_window.
 
+    The score is the sum of the proximity_values of the rows.
+    """
+    if not samples:
+        return 0
+    return np.sum(proximity_values(samples, seuil))
 
-def scan_all_sequences(pssm, list_seq, scorethreshold):
-    """Create a dictionnary of couple position/score for multiple sequences.
 
-    It uses scan_sequence(pssm, seq, scorethreshold) compute for each seq the position and score of the TBFS hits,
-    store them into a dictionnay with the key being the sequence id and values the list of (position/score).
-    """
+def sweep_windows(sas, window_size, slide_step, prom_len, seuil):
+    """Slide a window along the sequences of a HitTable, yield start, end, score and window info at each step.
 
-    data_struct = dict()
-    # Returns a list of SeqIO object from a list of.
-    seq_obj_list = Seq_obj_from_files(list_seq)
-
-    for seq_object, mrna in zip(seq_obj_list, mRNAs):
-        data_struct[mrna] = scan_sequence(
-            pssm, seq_object.seq, scorethreshold
-        )  # -> {id1:[(pos,score,),...],id2:[(pos2,score2),..],....}
-    return data_struct
-
-
-# def score_window(sas, start, end):
-#     """Scan a window between a start and end positions ( points ).
-
-#     This function uses the sliding window algorithm to analyze a certain window between a starting and ending
-#     points. The main algorithm ( approach ) used to calculate the score, is to check if hits (occurences) of a set
-#     of genes are near to each other; For instance, we can say that to points are in a proximity if their distance is
-#     close to zero. So we calculate the diffrence like this : diff = abs(pointA - pointB), then we campute a score on the difference:
-#                      A -> 1 ( 100 %)
-#                      B -> x ( ?% )
-#                      diff = abs ( A - B )
-#                      x = diff/B
-#     Here x means the percentage of the distance between A and B, if x is less or equal then the third of the window size / 100 ( to get
-#     the percentage ), then A is near to B, else A is not in proximty of B, those occurences are far from each other and the score of this window
-#     is not the preferead score ( see best_window ).
-#     It returns start, end , sum(scores), and widow info. The window info contains the hits of the sequences.
-#     """
-
-#     samples = list()  # A list to hold samples from each sequences.
-#     # A list to hold scores of distances between elements of consecutive rows.
-#     percentage = list()
-#     # A list to hold all the scores that are less or equal than a percentage threshold.
-#     occurences = list()
-#     i = 0  # Index.
-#     r = 0  # Rows.
-#     window_info = dict()
-
-#     # Iterate througth our dict of seq object.
-#     for item in sas:
-#         # For each sequence, create a row.
-#         row = []
-#         # Iterate througth pos,score in each sequence.
-#         for position, score in sas[item]:
-#             # If the position is neg, it means we are in the - srand.
-#             window_info[item] = position, score
-#             if position < 0:
-#                 # Calculate the correcte position.
-#                 # position = prom_len + position + 1
-#                 # If the algorithm finds a occurence in the window, then
-#                 # append it to the row.
-#                 if (prom_len + position + 1) >= start and (
-#                     prom_len + position + 1
-#                 ) < end:
-#                     row.append(prom_len + position + 1)
-#             else:
-#                 # Same as above but in the + srand.
-#                 neg_srand = False
-#                 if position >= start and position < end:
-#                     row.append(position)
-#         # If we have non-empty row,
-#         # add it to the samples.
-#         if row != []:
-#             samples.append(row)
-#             r += 1  # Increment the rows.
-#         else:
-#             pass
-
-#     # If non-empty samples.
-#     if samples != []:
-#         # For each row, compare each element of it with
-#         # the next row, and so on.
-#         for i in range(r - 1):
-#             curr_row = samples[i - 1]
-#             next_row = samples[i]
-#             for e in curr_row:
-#                 for n in next_row:
-#                     # Calculate the distence between two positions.
-#                     diff = abs(e - n)
-#                     # Give a percentage like score for the difference,
-#                     # Then add it to the percentage list.
-#                     percentage.append(diff / n)
-#             # For each elements of percentage, take only those with
-#             # a value less or equal then threshold, i.e that all this values
-#             # are in proximity.
-#             occurences = [x for x in percentage if x < seuil]
-#     # Sum up the score for this window.
-
-#     return start, end, sum(occurences), window_info
+    This gives the same results as the score_window of benchmarks.reference at each step, but
+    incrementally: the hits are sorted once (see sorted_hits), then two pointers per sequence follow the window
+    bounds, so a row is only rebuilt when a hit enters or leaves the window, and the score of a window is reused
+    as is when none of its rows changed.
+    """
+    for start, end, score, window_info, *_ in sweep_steps(sas, window_size, slide_step, prom_len, seuil):
+        yield start, end, score, window_info
 
 
-import numpy as np
+def sweep_steps(sas, window_size, slide_step, prom_len, seuil):
+    """Same as sweep_windows, also yielding the first and the last non-empty rows of each window (or None),
+    and the proximity_values the score of the window sums.
 
+    These are all merge_steps needs to append the windows of other sequences to these ones.
+    """
+    hits = sorted_hits(sas, prom_len)
+    lo = [0] * len(hits)  # First hit (in sorted order) at or after the window start.
+    hi = [0] * len(hits)  # First hit (in sorted order) at or after the window end.
+    rows = [None] * len(hits)  # Adjusted positions in the window, in the original hit order.
+    infos = [None] * len(hits)  # Last hit (in the original order) in the window.
+    score, window_info = 0, dict()
+    first, last, values = None, None, np.empty(0)
+
+    start = 0
+    end = window_size
+    changed = True
+    while start < (prom_len - window_size):
+        for k, (item, first_row, adjusted, order, sorted_adjusted) in enumerate(hits):
+            new_lo, new_hi = lo[k], hi[k]
+            while new_lo < len(sorted_adjusted) and sorted_adjusted[new_lo] < start:
+                new_lo += 1
+            new_hi = max(new_hi, new_lo)
+            while new_hi < len(sorted_adjusted) and sorted_adjusted[new_hi] < end:
+                new_hi += 1
+            if (new_lo, new_hi) == (lo[k], hi[k]):
+                continue
+            changed = True
+            lo[k], hi[k] = new_lo, new_hi
+            if new_lo == new_hi:
+                rows[k] = infos[k] = None
+            else:
+                in_window = np.sort(order[new_lo:new_hi])
+                rows[k] = adjusted[in_window]
+                infos[k] = sas.hit(first_row + in_window[-1])
+
+        if changed:
+            window_info = {hits[k][0]: infos[k] for k in range(len(hits)) if rows[k] is not None}
+            samples = [row for row in rows if row is not None]
+            values = proximity_values(samples, seuil)
+            score = np.sum(values) if samples else 0
+            first, last = (samples[0], samples[-1]) if samples else (None, None)
+            changed = False
+
+        yield start, end, score, window_info, first, last, values
+        start += slide_step
+        end += slide_step
 
-def score_window(sas, start, end):
-    """Scan a window between a start and end positions (points).
 
-    This function uses a sliding window algorithm to analyze a window between starting and ending points.
-    The main approach is to calculate the distance between occurrences (hits) of TFBS and compute a score based on proximity.
+def merge_steps(steps, new_steps, seuil):
+    """Merge the sweep_steps of sequences appended after others into the sweep_steps of the first ones.
 
-    Returns start, end, sum(scores), and window info.
+    The score of a window sums the proximity of consecutive non-empty rows, so the proximity values of the
+    whole set are those of the first sequences, then those of the last row of the first sequences and the
+    first row of the new ones, then those of the new sequences. They are summed again in this order, so the
+    steps of the whole set are exactly those of sweep_steps over all the sequences, score bits included.
     """
+    merged = []
+    for step, new_step in zip(steps, new_steps):
+        start, end, _, window_info, first, last, values = step
+        _, _, _, new_info, new_first, new_last, new_values = new_step
+        if new_first is None:
+            merged.append(step)
+        elif first is None:
+            merged.append(new_step)
+        else:
+            values = np.concatenate([values, proximity_values([last, new_first], seuil), new_values])
+            merged.append((start, end, np.sum(values), {**window_info, **new_info}, first, new_last, values))
+    return merged
 
-    samples = []  # List to hold samples from each sequence.
-    window_info = (
-        {}
-    )  # Dictionary to hold positional information and scores for each sequence.
-
-    # Iterate through the sequences and collect positions within the window.
-    for item in sas:
-        row = []
-        for position, score in sas[item]:
-            adjusted_position = prom_len + position + 1 if position < 0 else position
-            if start <= adjusted_position < end:
-                row.append(adjusted_position)
-                window_info[item] = (position, score)
-        if row:
-            samples.append(row)
-
-    if not samples:
-        return start, end, 0, window_info
 
-    # Convert samples to a NumPy array for vectorized operations.
-    samples = [np.array(row) for row in samples]
-    num_rows = len(samples)
+def window_seuil(window_size):
+    # Threshold of the proximity condition, the percentage of the third of the window size.
+    return (window_size / 3) / 100
 
-    # Calculate scores based on proximity.
-    scores = []
-    for i in range(num_rows - 1):
-        curr_row = samples[i]
-        next_row = samples[i + 1]
-        diff_matrix = np.abs(curr_row[:, None] - next_row)
-        percentage_matrix = diff_matrix / next_row
-        valid_scores = percentage_matrix[percentage_matrix < seuil]
-        scores.extend(valid_scores)
 
-    return start, end, np.sum(scores), window_info
+def iter_windows(sas, window_size, prom_len, w_threshold):
+    """Yield the windows of best_window one at a time, as (window index, window) couples.
 
+    Windows are yielded as soon as the sweep reaches them, so they never have to be held all together.
+    """
+    sweep = sweep_windows(sas, window_size, SLIDE_STEP, prom_len, window_seuil(window_size))
+    yield from select_windows(sweep, w_threshold)
 
-def best_window(sas, window_size):
-    """Calculate the best window score by scanning a set of sequences.
 
-    Start from the head of sequences, and then slide througth the set, between each starting point in a sequence
-    and the size of the window, calls scan_window to compute a score on this locations, then check if the score is
-    lower or equal to the window threshold given as argument.
+def select_windows(sweep, w_threshold):
+    """Yield, as (window index, window) couples, the windows of a sweep whose score is below w_threshold.
 
-    Returns windows infos, a dictionnary with the score, start and end position and the window info on this specific location.
+    sweep yields start, end, score and window info (and possibly more) at each step, see sweep_windows.
     """
 
-    global seuil  # Define a global threshlod for the score_window condition.
-    # Take the percentage of the third of the window size.
-    seuil = (window_size / 3) / 100
-
     start_bw = 0  # Starting point for the best window.
     end_bw = 0  # End point for the best window.
-    start = 0  # Start the scan at position 0 for all the sequences.
-    bws = 0  # Define a bws for the scans.
     tmp = 0
-    end = window_size  # Set the end for the window scan.
     window_index = 1
 
-    slide_step = 7  # Arbitrary value to indicate the slide step of the window
-
-    windows_info = dict()
-
     # Scann all the sequences entil reaching the end.
-    while start < (prom_len - window_size):
-        # Get the score of the current window between start and end positions.
-        start_curr, end_curr, curr_bws, window_info = score_window(sas, start, end)
+    for start_curr, end_curr, curr_bws, window_info, *_ in sweep:
         # Check if the current score is valid.
         if curr_bws > 0 and w_threshold > curr_bws:
             # To get ride of same value.
@@ -239,13 +233,390 @@ def best_window(sas, window_size):
                 # Set it start and end window as the best start window.
                 start_bw = start_curr
                 end_bw = end_curr
-                windows_info[window_index] = (start_bw, end_bw, curr_bws, window_info)
+                yield window_index, (start_bw, end_bw, curr_bws, window_info)
                 window_index += 1
             tmp = curr_bws
-        # Take a step further.
+
+
+def best_window(sas, window_size, prom_len, w_threshold):
+    """Calculate the best window score by scanning a set of sequences.
+
+    Start from the head of sequences, and then slide througth the set, between each starting point in a sequence
+    and the size of the window, compute a score on this locations (see sweep_windows), then check if the score is
+    lower than the window threshold w_threshold. prom_len is the length of the promoters.
+
+    Returns windows infos, a dictionnary with the score, start and end position and the window info on this specific location.
+    """
+    return dict(iter_windows(sas, window_size, prom_len, w_threshold))
+
+
+def module_index(tables, prom_len):
+    """Index the hits of several motifs over the same sequences, for the window queries of iter_module_windows.
+
+    Returns, for each sequence, the adjusted positions of the hits of all the motifs sorted together, with the
+    index of the motif and the row in its HitTable of each hit.
+    """
+    adjusted = [table.adjusted(prom_len) for table in tables]
+    index = []
+    for k in range(len(tables[0].ids) if tables else 0):
+        positions, hit_motifs, rows = [], [], []
+        for m, table in enumerate(tables):
+            table_rows = table.rows(k)
+            positions.append(adjusted[m][table_rows])
+            hit_motifs.append(np.full(table_rows.stop - table_rows.start, m, dtype=np.int32))
+            rows.append(np.arange(table_rows.start, table_rows.stop))
+        positions = np.concatenate(positions)
+        order = np.argsort(positions, kind="stable")
+        index.append((positions[order], np.concatenate(hit_motifs)[order], np.concatenate(rows)[order]))
+    return index
+
+
+def iter_module_windows(
+    tables, motif_ids, tf_names, window_size, prom_len, min_tfs, min_genes, slide_step=SLIDE_STEP
+):
+    """Slide a window along sequences scanned with several motifs and yield the windows holding a module.
+
+    A sequence holds a module in a window when hits of at least min_tfs distinct motifs fall in it, a window is
+    yielded when at least min_genes sequences hold a module in it, and its content differs from the previous
+    window yielded. Hits are looked up with the interval index of module_index. The score of a window is the sum,
+    over the motifs, of the proximity score (see proximity_score) of their hits in the sequences holding a module.
+
+    Yields (window index, (start, end, score, {sequence id: [(motif id, TF name, position, score), ...]})).
+    """
+    seuil = window_seuil(window_size)
+    adjusted = [table.adjusted(prom_len) for table in tables]
+    index = module_index(tables, prom_len)
+    ids = tables[0].ids if tables else []
+
+    previous = None
+    window_index = 1
+    start = 0
+    while start < (prom_len - window_size):
+        end = start + window_size
+        selected = dict()
+        for k, (positions, hit_motifs, rows) in enumerate(index):
+            lo, hi = np.searchsorted(positions, [start, end])
+            if hi - lo >= min_tfs and len(np.unique(hit_motifs[lo:hi])) >= min_tfs:
+                selected[k] = (hit_motifs[lo:hi], rows[lo:hi])
+
+        if len(selected) >= min_genes:
+            content = [(k, m.tolist(), r.tolist()) for k, (m, r) in selected.items()]
+            if content != previous:
+                score = 0
+                for m in range(len(tables)):
+                    samples = [
+                        adjusted[m][np.sort(rows[hit_motifs == m])]
+                        for hit_motifs, rows in selected.values()
+                        if np.any(hit_motifs == m)
+                    ]
+                    score += proximity_score(samples, seuil)
+                module_info = {
+                    ids[k]: [
+                        (motif_ids[m], tf_names[m]) + tuple(tables[m].hit(row))
+                        for m, row in zip(motif_list, row_list)
+                    ]
+                    for k, motif_list, row_list in content
+                }
+                yield window_index, (start, end, score, module_info)
+                window_index += 1
+                previous = content
         start += slide_step
-        end += slide_step
-    return windows_info
+
+
+class TFBSSearch:
+    """Parameters of a TFBS search over a set of genes, independent of the motifs searched.
+
+    All the parameters of the pipeline are held by the search and passed explicitly to the scan and window
+    functions, nothing is kept in module globals, so several searches can run at the same time in threads or
+    worker processes. A search is not modified once created and can be run for any number of motifs.
+
+    Hits are kept when their score is at least threshold, or, when p_value is given, when their p-value is
+    at most p_value (see app.utils.score_dist), which gives each motif its own score threshold.
+
+    The log-odds of the motifs are computed against the background named by background: "uniform" (or None),
+    "promoters" for the composition of the promoters of the search, or a species (see app.utils.background).
+    """
+
+    def __init__(
+        self,
+        list_mRNA,
+        psw,
+        threshold,
+        len_prom,
+        window_size,
+        window_threshlod,
+        chunk_size=16,
+        p_value=None,
+        background=None,
+    ):
+        self.mRNAs = list(list_mRNA)
+        self.psw = psw
+        self.threshold = threshold
+        self.p_value = p_value
+        self.prom_len = len_prom
+        self.window_size = window_size
+        self.w_threshold = window_threshlod
+        self.chunk_size = chunk_size
+        self.background = background
+
+    def sequences(self):
+        """Return {mrna: promoter sequence} for the genes of the search."""
+        with span("fetch"):
+            return promoter_sequences(self.mRNAs, self.prom_len)
+
+    def background_model(self, sequences, seq_key, codes=None):
+        """Return the A, C, G, T probabilities of the background of the search over a set of promoters."""
+        with span("background"):
+            return resolve_background(self.background, sequences, seq_key, codes)
+
+    def motif_threshold(self, motif_id, background):
+        """Return the score threshold of a motif, translated from the p-value when one is given."""
+        if self.p_value is None:
+            return self.threshold
+        with span("motif"):
+            return score_threshold(motif_id, self.psw, self.p_value, background)
+
+    def scan_key(self, motif_id, seq_key, background):
+        """Return the key of the hits of a motif in the scan cache (see app.utils.result_cache).
+
+        The motif is keyed by the version stored and the JASPAR release, so that an id without version is
+        scanned again once a newer version is stored.
+        """
+        version = motif_version(motif_id)
+        return (version, self.psw, self.motif_threshold(version, background), seq_key, background, JASPAR_RELEASE)
+
+    def window_key(self, scan_key):
+        """Return the key of the windows of a scan in the window cache."""
+        return scan_key + (self.window_size, self.w_threshold, self.prom_len)
+
+    def gene_hits_key(self, scan_key):
+        """Return the key of the per-gene hits of a motif in the gene cache, the scan key without the sequence set."""
+        return scan_key[:3] + scan_key[4:] + (self.prom_len,)
+
+    def window_state_key(self, scan_key):
+        """Return the key of the window steps of a motif in the window state cache."""
+        return self.gene_hits_key(scan_key) + (self.window_size,)
+
+    def windows(self, tf_name, scan_key, dict_seq, sequences):
+        """Return the TF name and the windows informations of the hits of a motif, through the window cache."""
+        window_key = self.window_key(scan_key)
+        result = window_cache.get(window_key)
+        if result is None:
+            with span("window"):
+                steps = self.window_steps(scan_key, dict_seq, gene_keys(sequences))
+                result = tf_name, dict(select_windows(steps, self.w_threshold))
+            window_cache.put(window_key, result)
+        WINDOWS.inc(len(result[1]))
+        return result
+
+    def window_steps(self, scan_key, dict_seq, keys):
+        """Return the sweep_steps of the hits of a motif over genes, given by their gene_keys.
+
+        The steps of the last set of genes searched with the motif and window size are kept in the window state
+        cache. When that set is the beginning of this one, only the genes added after it are swept, and their
+        windows merged into the kept steps (see merge_steps), else the whole set is swept.
+        """
+        state_key = self.window_state_key(scan_key)
+        state = window_state_cache.get(state_key)
+        known = 0
+        if state is not None and state[0] == keys[: len(state[0])]:
+            known = len(state[0])
+
+        seuil = window_seuil(self.window_size)
+        if known == 0:
+            steps = list(sweep_steps(dict_seq, self.window_size, SLIDE_STEP, self.prom_len, seuil))
+        else:
+            steps = state[1]
+            if known < len(keys):
+                added = dict_seq.sequences(known, len(keys))
+                steps = merge_steps(
+                    steps, sweep_steps(added, self.window_size, SLIDE_STEP, self.prom_len, seuil), seuil
+                )
+        if known < len(keys):
+            window_state_cache.put(state_key, (keys, steps))
+        return steps
+
+    def run(self, jaspar_matrix_name, progress=None):
+        """Search a motif and return its TF name and the dictionnary of the windows informations.
+
+        When given, progress is called with the name of each phase ("download", "scan", "window") as the
+        search enters it.
+        """
+        progress = progress or (lambda phase: None)
+
+        progress("download")
+        sequences = self.sequences()
+
+        # Hits only depend on the scan parameters, windows also depend on the window ones (see app.utils.result_cache).
+        seq_key = sequence_set_key(sequences)
+        scan_key = self.scan_key(jaspar_matrix_name, seq_key, self.background_model(sequences, seq_key))
+        cached = window_cache.get(self.window_key(scan_key))
+        if cached is not None:
+            WINDOWS.inc(len(cached[1]))
+            return cached
+
+        tf_name, dict_seq = self.scan(jaspar_matrix_name, sequences, scan_key, progress)
+        progress("window")
+        return self.windows(tf_name, scan_key, dict_seq, sequences)
+
+    def scan(self, jaspar_matrix_name, sequences, scan_key, progress):
+        """Return the TF name and the {mrna: hits} of a motif, through the scan cache."""
+        scanned = scan_cache.get(scan_key)
+        if scanned is None:
+            with span("motif"):
+                pssm, tf_name = pwm2pssm(scan_key[0], self.psw, scan_key[4])
+            progress("scan")
+            # The threshold and the background of the motif are part of its scan key.
+            with span("scan"):
+                scanned = tf_name, self.scan_genes([pssm], sequences, [scan_key])[0]
+            scan_cache.put(scan_key, scanned)
+        return scanned
+
+    def scan_genes(self, pssms, sequences, scan_keys, codes=None, lengths=None):
+        """Return the HitTable of each motif over the sequences, only scanning the genes missing from the gene cache.
+
+        The hits of each gene are kept in the gene cache (see app.utils.result_cache), so adding genes to a set
+        searched before only scans the added genes. codes and lengths are the encoded sequences, when the caller
+        already has them.
+        """
+        keys = gene_keys(sequences)
+        entry_keys = [self.gene_hits_key(scan_key) for scan_key in scan_keys]
+        entries = [gene_cache.get(entry_key) or dict() for entry_key in entry_keys]
+        missing = [k for k, key in enumerate(keys) if any(key not in entry for entry in entries)]
+
+        if missing:
+            if codes is None or len(missing) < len(keys):
+                values = list(sequences.values())
+                codes, lengths = encode_sequences([values[k] for k in missing])
+            hits = scan_batch(
+                [pssm_matrix(pssm) for pssm in pssms], codes, lengths, [key[2] for key in scan_keys]
+            )
+            HITS.inc(sum(len(motif_hits) for motif_hits in hits))
+            # Cached entries are shared, they are copied instead of being modified.
+            entries = [
+                {**entry, **{keys[k]: motif_hits.sequences(i, i + 1) for i, k in enumerate(missing)}}
+                for entry, motif_hits in zip(entries, hits)
+            ]
+
+        tables = [HitTable.concat([entry[key] for key in keys], list(sequences)) for entry in entries]
+        if missing:
+            for entry_key, entry in zip(entry_keys, entries):
+                gene_cache.put(entry_key, trim_genes(entry, keys))
+        return tables
+
+    def stream(self, jaspar_matrix_name, progress=None):
+        """Search a motif and yield (TF name, window index, window) tuples as soon as windows are found.
+
+        Unlike run, the windows are never all held in memory, so they are not added to the window cache
+        (they are read from it when it already has them).
+        """
+        progress = progress or (lambda phase: None)
+
+        progress("download")
+        sequences = self.sequences()
+
+        seq_key = sequence_set_key(sequences)
+        scan_key = self.scan_key(jaspar_matrix_name, seq_key, self.background_model(sequences, seq_key))
+        cached = window_cache.get(self.window_key(scan_key))
+        if cached is not None:
+            tf_name, windows = cached
+            for window_index, window in windows.items():
+                yield tf_name, window_index, window
+            WINDOWS.inc(len(windows))
+            return
+
+        tf_name, dict_seq = self.scan(jaspar_matrix_name, sequences, scan_key, progress)
+        progress("window")
+        for window_index, window in iter_windows(
+            dict_seq, self.window_size, self.prom_len, self.w_threshold
+        ):
+            WINDOWS.inc()
+            yield tf_name, window_index, window
+
+    def run_batch(self, jaspar_matrix_names):
+        """Search many motifs and yield, for each one, its id, TF name and windows informations.
+
+        The promoters are read and encoded once, then the motifs are scanned together, chunk_size
+        matrices at a time (see scan_encoded_batch), on the worker processes of app.utils.parallel when the
+        scan is large enough.
+        """
+        logger.debug("Searching for TFBS of %d motifs", len(jaspar_matrix_names))
+        sequences = self.sequences()
+        codes, lengths = encode_sequences(list(sequences.values()))
+        seq_key = sequence_set_key(sequences)
+        background = self.background_model(sequences, seq_key, codes)
+
+        for i in range(0, len(jaspar_matrix_names), self.chunk_size):
+            chunk = jaspar_matrix_names[i : i + self.chunk_size]
+            scan_keys, scanned = self.scan_chunk(chunk, sequences, codes, lengths, seq_key, background)
+            for motif_id, scan_key, (tf_name, dict_seq) in zip(chunk, scan_keys, scanned):
+                yield (motif_id,) + self.windows(tf_name, scan_key, dict_seq, sequences)
+
+    def scan_chunk(self, chunk, sequences, codes, lengths, seq_key, background):
+        """Scan a chunk of motifs over encoded sequences in one pass, through the scan cache.
+
+        Returns the scan keys of the motifs and their (TF name, HitTable) couples.
+        """
+        scan_keys = [self.scan_key(motif_id, seq_key, background) for motif_id in chunk]
+        scanned = [scan_cache.get(key) for key in scan_keys]
+
+        # Only the motifs missing from the scan cache are scanned.
+        missing = [k for k, entry in enumerate(scanned) if entry is None]
+        with span("motif"):
+            pssms = [pwm2pssm(scan_keys[k][0], self.psw, background) for k in missing]
+        with span("scan"):
+            hits = self.scan_genes(
+                [pssm for pssm, _ in pssms], sequences, [scan_keys[k] for k in missing], codes, lengths
+            )
+        for k, (_, tf_name), motif_hits in zip(missing, pssms, hits):
+            scanned[k] = tf_name, motif_hits
+            scan_cache.put(scan_keys[k], scanned[k])
+        return scan_keys, scanned
+
+    def run_modules(self, jaspar_matrix_names, min_tfs, min_genes):
+        """Search the windows where several motifs bind together (cis-regulatory modules).
+
+        All the motifs are scanned over the same encoded promoters, chunk_size at a time, then the windows
+        where at least min_tfs distinct motifs hit at least min_genes genes are yielded as they are found
+        (see iter_module_windows).
+        """
+        logger.debug("Searching for modules of %d motifs", len(jaspar_matrix_names))
+        sequences = self.sequences()
+        codes, lengths = encode_sequences(list(sequences.values()))
+        seq_key = sequence_set_key(sequences)
+        background = self.background_model(sequences, seq_key, codes)
+
+        scanned = []
+        for i in range(0, len(jaspar_matrix_names), self.chunk_size):
+            chunk = jaspar_matrix_names[i : i + self.chunk_size]
+            scanned.extend(self.scan_chunk(chunk, sequences, codes, lengths, seq_key, background)[1])
+
+        for window_index, window in iter_module_windows(
+            [table for _, table in scanned],
+            list(jaspar_matrix_names),
+            [tf_name for tf_name, _ in scanned],
+            self.window_size,
+            self.prom_len,
+            min_tfs,
+            min_genes,
+        ):
+            WINDOWS.inc()
+            yield window_index, window
+
+
+def gene_keys(sequences):
+    """Return the (mrna, sequence digest) key of each promoter of an {mrna: sequence} mapping, in order."""
+    return [(mrna, sequence_digest(sequence)) for mrna, sequence in sequences.items()]
+
+
+def trim_genes(entry, keys):
+    """Return a copy of the {gene key: hits} entry of the gene cache, bounded to GENES_PER_ENTRY genes.
+
+    The genes of keys, just used, are kept and the genes used the longest time ago are dropped first.
+    """
+    used = set(keys)
+    entry = {**{key: hits for key, hits in entry.items() if key not in used}, **{key: entry[key] for key in keys}}
+    return dict(list(entry.items())[-GENES_PER_ENTRY:])
 
 
 def search_luncher(
@@ -256,46 +627,54 @@ def search_luncher(
     len_prom,
     window_size,
     window_threshlod,
+    progress=None,
+    p_value=None,
+    background=None,
 ):
     """Act as a luncher for the putative_TFBS.py script.
 
     This function is like a main, takes all the arguments from the input from users, process
-    the search, and returns TF name and a dictionnary of the winodws informations.
+    the search (see TFBSSearch.run), and returns TF name and a dictionnary of the winodws informations.
     """
-    print("Searching for TFBS...")
-    global prom_len
-    prom_len = len_prom
-
-    global w_threshold
-    w_threshold = window_threshlod
-
-    global mRNAs
-    mRNAs = list_mRNA
+    search = TFBSSearch(
+        list_mRNA,
+        psw,
+        threshold,
+        len_prom,
+        window_size,
+        window_threshlod,
+        p_value=p_value,
+        background=background,
+    )
+    return search.run(jaspar_matrix_name, progress)
+
+
+def promoter_sequences(list_mRNA, len_prom):
+    """Return {mrna: promoter sequence} for the requested mRNAs and promoter length.
+
+    Sequences come from the promoter store (see app.utils.seq_store), only the missing ones are downloaded.
+    """
+    return get_store().fetch(list_mRNA, len_prom)
 
-    pssm, tf_name = pwm2pssm(jaspar_matrix_name, psw)
 
-    # directory to store downlaoded promotors.
-    file_path_sequences = "./data/sequences"
+def batch_search_luncher(
+    list_mRNA,
+    jaspar_matrix_names,
+    psw,
+    threshold,
+    len_prom,
+    window_size,
+    window_threshlod,
+    chunk_size=16,
+    p_value=None,
+    background=None,
+):
+    """Act as a luncher for a search over many motifs on the same set of genes.
 
-    # Check if there's no .fa file, so the program starts downloading data, else just use the data in the dir.
-    if os.path.exists(file_path_sequences) and os.path.isdir(file_path_sequences):
-        if not any(fname.endswith(".fa") for fname in os.listdir(file_path_sequences)):
-            print("No mRNA found in the database. Downloading the file, please wait...")
-            # download promoters.
-            download_promotors(mRNAs, prom_len, file_path_sequences)
-            print("Downloading is finished ✅")
-        else:
-            print("Using files from directory.")
-    else:
-        print("Given directory doesn't exist")
-        print("Creating the '" + file_path_sequences + "' directory")
-        os.makedirs(file_path_sequences)
-        # download promoters.
-        download_promotors(mRNAs, prom_len, file_path_sequences)
-        print("Downloading is finished ✅")
-
-    # create a list with all the files in the download directory.
-    file_list = glob.glob(os.path.join(os.getcwd(), file_path_sequences, "*.fa"))
-    dict_seq = scan_all_sequences(pssm, file_list, threshold)
-
-    return tf_name, best_window(dict_seq, window_size)
+    It yields, for each motif, a tuple with the motif id, the TF name and the dictionnary of the windows
+    informations, as search_luncher returns them (see TFBSSearch.run_batch).
+    """
+    search = TFBSSearch(
+        list_mRNA, psw, threshold, len_prom, window_size, window_threshlod, chunk_size, p_value, background
+    )
+    return search.run_batch(jaspar_matrix_names)
@@ -0,0 +1,273 @@
+"""Two-level cache of search results.
+
+The scan cache keeps the raw hits of a motif over a set of promoters, keyed by (motif id, pseudocount,
+threshold, sequence set hash, background), so that changing only the window parameters of a request reuses the scan.
+The window cache keeps the final windows, keyed by the scan key plus (window_size, window threshold,
+promoter_length), so that repeating a request costs a dictionnary lookup.
+
+Two more caches make the searches incremental when genes are added to a set analysed before. The gene cache
+keeps the hits of each gene, keyed by (motif id, pseudocount, threshold, background, promoter_length) and then
+by (gene, sequence digest), so only the new genes are scanned. The window state cache keeps the sweep of the
+windows of the last set of genes searched with a motif and window size, so the windows of the new genes are
+merged into it instead of being computed again for the whole set (see TFBSSearch.window_steps).
+
+Both levels are LRU caches bounded to a number of entries (TFBS_SCAN_CACHE_SIZE and TFBS_WINDOW_CACHE_SIZE).
+When TFBS_RESULT_CACHE_DIR is set, entries are also pickled to disk, in one file per entry, so they survive
+restarts and are shared by the workers of a node. The entries of the gene cache are directories of chunks
+instead (see ChunkedResultCache), a put only writes the genes that are not on disk yet. The disk copy of each
+cache is bounded to the same number of entries and to TFBS_RESULT_CACHE_DISK_MB, it is trimmed every
+TFBS_RESULT_CACHE_TRIM_EVERY writes, the least recently used entries are removed first.
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import Counter, OrderedDict
+
+SCAN_CACHE_SIZE = int(os.environ.get("TFBS_SCAN_CACHE_SIZE", 256))
+WINDOW_CACHE_SIZE = int(os.environ.get("TFBS_WINDOW_CACHE_SIZE", 1024))
+GENE_CACHE_SIZE = int(os.environ.get("TFBS_GENE_CACHE_SIZE", 256))
+GENES_PER_ENTRY = int(os.environ.get("TFBS_GENES_PER_ENTRY", 20000))
+CACHE_DIR = os.environ.get("TFBS_RESULT_CACHE_DIR")
+DISK_BYTES = int(float(os.environ.get("TFBS_RESULT_CACHE_DISK_MB", 1024)) * 2**20)
+TRIM_EVERY = int(os.environ.get("TFBS_RESULT_CACHE_TRIM_EVERY", 64))
+
+
+def sequence_set_key(sequences):
+    """Return a hash of an {id: sequence} mapping, covering the ids, their order and the sequences."""
+    digest = hashlib.sha256()
+    for seq_id, sequence in sequences.items():
+        if isinstance(sequence, str):
+            sequence = sequence.encode("ascii")
+        digest.update(f"{seq_id}\t{len(sequence)}\n".encode())
+        digest.update(bytes(sequence))
+    return digest.hexdigest()
+
+
+def sequence_digest(sequence):
+    """Return a short hash of one sequence."""
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii")
+    return hashlib.sha256(bytes(sequence)).hexdigest()[:16]
+
+
+class ResultCache:
+    """LRU cache of picklable values keyed by tuples, optionally mirrored in a directory."""
+
+    def __init__(self, name, maxsize, directory=CACHE_DIR, max_bytes=DISK_BYTES):
+        self.name = name
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.directory = os.path.join(directory, name) if directory else None
+        self.counters = Counter()  # hits, disk_hits, misses.
+        self._entries = OrderedDict()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + ".pkl")
+
+    def _dump(self, path, key, value):
+        """Pickle (key, value) to a file, unless it is bigger than the whole disk copy may be."""
+        data = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return False
+        # Write to a temporary file first so that readers never see a partial entry.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as handle:
+            handle.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def get(self, key):
+        """Return the value of a key, or None if it is not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return self._entries[key]
+
+        value = self._read(key)
+        with self._lock:
+            if value is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+        self._write(key, value)
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _read(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as handle:
+                stored_key, value = pickle.load(handle)
+            # Mark the file as recently used for the eviction of the disk copy.
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value if stored_key == key else None
+
+    def _write(self, key, value):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._store(key, value)
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % TRIM_EVERY == 1 or TRIM_EVERY <= 1
+        if trim:
+            self._trim_disk()
+
+    def _store(self, key, value):
+        self._dump(self._path(key), key, value)
+
+    def _trim_disk(self):
+        """Remove the least recently used entries beyond maxsize entries or max_bytes."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(".pkl"):
+                    entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+                elif entry.is_dir():
+                    size = sum(chunk.stat().st_size for chunk in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                pass
+        entries.sort(reverse=True)
+        kept = 0
+        for i, (_, size, path) in enumerate(entries):
+            kept += size
+            if i < self.maxsize and kept <= self.max_bytes:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                f"{self.name}_hits": self.counters["hits"],
+                f"{self.name}_disk_hits": self.counters["disk_hits"],
+                f"{self.name}_misses": self.counters["misses"],
+                f"{self.name}_cached": len(self._entries),
+            }
+
+
+class ChunkedResultCache(ResultCache):
+    """ResultCache of dictionnaries whose items never change once added, such as the {gene key: hits} entries.
+
+    On disk, an entry is a directory of chunks, each a pickled dictionnary of some of its items. A put only
+    writes the items that are not on disk yet, as a new chunk, and the directory is compacted into a single
+    chunk once it holds twice as many items as the entry. A chunk removed by the compaction of another process
+    while it is read only loses items, a reader gets the entry without them.
+    """
+
+    def __init__(self, name, maxsize, directory=CACHE_DIR, max_bytes=DISK_BYTES):
+        super().__init__(name, maxsize, directory, max_bytes)
+        self._stored = OrderedDict()  # key -> (item keys on disk, items on disk counting the duplicates).
+
+    def _path(self, key):
+        return super()._path(key)[: -len(".pkl")]
+
+    def _set_stored(self, key, items, count):
+        with self._lock:
+            self._stored[key] = (items, count)
+            self._stored.move_to_end(key)
+            while len(self._stored) > self.maxsize:
+                self._stored.popitem(last=False)
+
+    def _read(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        value = dict()
+        count = 0
+        try:
+            names = sorted(name for name in os.listdir(path) if name.endswith(".pkl"))
+            for name in names:
+                try:
+                    with open(os.path.join(path, name), "rb") as handle:
+                        stored_key, items = pickle.load(handle)
+                except FileNotFoundError:
+                    continue
+                if stored_key != key:
+                    return None
+                value.update(items)
+                count += len(items)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if not value:
+            return None
+        self._set_stored(key, set(value), count)
+        return value
+
+    def _store(self, key, value):
+        path = self._path(key)
+        with self._lock:
+            stored, count = self._stored.get(key, (set(), 0))
+        compact = count >= 2 * len(value)
+        items = value if compact else {k: v for k, v in value.items() if k not in stored}
+        if not items:
+            return
+        os.makedirs(path, exist_ok=True)
+        old = [name for name in os.listdir(path) if name.endswith(".pkl")] if compact else []
+        # Chunk names sort in the order they were written.
+        name = f"{time.time_ns():020d}-{os.getpid()}-{threading.get_ident()}.pkl"
+        try:
+            if not self._dump(os.path.join(path, name), key, items):
+                return
+        except FileNotFoundError:
+            # The entry was removed by the trim of another process, it is written whole next time.
+            with self._lock:
+                self._stored.pop(key, None)
+            return
+        for old_name in old:
+            try:
+                os.remove(os.path.join(path, old_name))
+            except OSError:
+                pass
+        if compact:
+            self._set_stored(key, set(value), len(value))
+        else:
+            self._set_stored(key, stored | set(items), count + len(items))
+
+
+scan_cache = ResultCache("scan", SCAN_CACHE_SIZE)
+window_cache = ResultCache("window", WINDOW_CACHE_SIZE)
+gene_cache = ChunkedResultCache("gene", GENE_CACHE_SIZE)
+window_state_cache = ResultCache("window_state", GENE_CACHE_SIZE)
+
+
+def cache_stats():
+    """Return the hit/miss counters of every cache."""
+    return {
+        **scan_cache.stats(),
+        **window_cache.stats(),
+        **gene_cache.stats(),
+        **window_state_cache.stats(),
+    }
@@ -0,0 +1,243 @@
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from app.utils.hits import HitTable, bio_order
+
+BASES = "ACGT"
+
+# Code used for anything that is not A, C, G or T (N, gaps, padding...).
+INVALID = 4
+
+# Byte -> base code lookup table, upper and lower case are both accepted.
+_CODES = np.full(256, INVALID, dtype=np.uint8)
+for _i, _b in enumerate(BASES):
+    _CODES[ord(_b)] = _i
+    _CODES[ord(_b.lower())] = _i
+
+# Base code -> one-hot row, the invalid code maps to an all-zero row.
+_ONEHOT = np.vstack([np.eye(4), np.zeros((1, 4))])
+
+# Motifs of up to LOOKUP_MAX_LENGTH columns are scored with tables of the k-mers of LOOKUP_BLOCK columns
+# (see score_lookup).
+LOOKUP_MAX_LENGTH = int(os.environ.get("TFBS_LOOKUP_MAX_LENGTH", 16))
+LOOKUP_BLOCK = 4
+
+
+def encode_sequences(sequences):
+    """Encode a list of sequences into one padded array of base codes.
+
+    Each sequence (str, Seq or bytes) becomes a row of uint8 codes (A=0, C=1, G=2, T=3), shorter
+    sequences are padded with INVALID so they can all be stored in a single array.
+
+    Returns the (n_sequences, max_length) array of codes and the array of sequence lengths.
+    """
+    raw = [bytes(s) if not isinstance(s, str) else s.encode("ascii") for s in sequences]
+    lengths = np.array([len(s) for s in raw], dtype=np.int64)
+    codes = np.full((len(raw), int(lengths.max(initial=0))), INVALID, dtype=np.uint8)
+    for i, s in enumerate(raw):
+        codes[i, : len(s)] = _CODES[np.frombuffer(s, dtype=np.uint8)]
+    return codes, lengths
+
+
+def pssm_matrix(pssm):
+    """Return the log-odds of a PositionSpecificScoringMatrix as a (motif_length, 4) array."""
+    return np.array(
+        [[pssm[letter][i] for letter in BASES] for i in range(pssm.length)], dtype=float
+    )
+
+
+def valid_windows(codes, motif_length):
+    """Return a boolean (n_sequences, n_offsets) array, True where a window holds only A, C, G, T."""
+    invalid = np.zeros((codes.shape[0], codes.shape[1] + 1), dtype=np.int64)
+    np.cumsum(codes == INVALID, axis=1, out=invalid[:, 1:])
+    return (invalid[:, motif_length:] - invalid[:, :-motif_length]) == 0
+
+
+def kmer_tables(matrix, block=LOOKUP_BLOCK):
+    """Split a (motif_length, 4) log-odds matrix into blocks of block columns and score every k-mer on each.
+
+    The last block is completed with zero columns. The k-mer of codes c_1 ... c_k has the index
+    c_1 * 4 ** (k - 1) + ... + c_k (see kmer_indices).
+
+    Returns the (n_blocks, 4 ** block) array of the k-mer scores of each block.
+    """
+    n_blocks = -(-matrix.shape[0] // block)
+    columns = np.zeros((n_blocks * block, 4))
+    columns[: matrix.shape[0]] = matrix
+    # kmers[j, i] is the code at column j of the k-mer of index i.
+    kmers = np.indices((4,) * block).reshape(block, -1)
+    return columns.reshape(n_blocks, block, 4)[:, np.arange(block)[:, None], kmers].sum(axis=1)
+
+
+def kmer_indices(codes, width, block=LOOKUP_BLOCK):
+    """Return the (n_sequences, width) array of the index of the k-mer starting at each offset of the codes.
+
+    The indices are rolled over the sequences, the invalid codes count as A, their windows being masked by
+    the caller (see valid_windows), and the offsets past the end of the codes as padding.
+    """
+    # The indices of 4-mers fit in bytes, which keeps the arrays small.
+    dtype = np.uint8 if block <= 4 else np.intp
+    padded = np.zeros((codes.shape[0], width + block - 1), dtype=dtype)
+    n_columns = min(codes.shape[1], padded.shape[1])
+    padded[:, :n_columns] = np.where(codes[:, :n_columns] == INVALID, 0, codes[:, :n_columns])
+    indices = np.zeros((codes.shape[0], width), dtype=dtype)
+    for j in range(block):
+        indices = indices * 4 + padded[:, j : j + width]
+    return indices
+
+
+def score_lookup(matrix, codes, n_offsets, block=LOOKUP_BLOCK):
+    """Score the first n_offsets offsets of the encoded sequences on both strands with k-mer tables.
+
+    The score of an offset is the sum of the table scores of its blocks: one table lookup per block
+    instead of one multiply-add per column and base. Invalid windows are not masked.
+
+    Returns the (n_sequences, n_offsets) arrays of forward and reverse strand scores (float64).
+    """
+    forward_tables = kmer_tables(matrix, block)
+    reverse_tables = kmer_tables(matrix[::-1, ::-1], block)
+    n_blocks = forward_tables.shape[0]
+    indices = kmer_indices(codes, n_offsets + (n_blocks - 1) * block, block)
+    forward = np.zeros((codes.shape[0], n_offsets))
+    reverse = np.zeros((codes.shape[0], n_offsets))
+    for b in range(n_blocks):
+        block_indices = indices[:, b * block : b * block + n_offsets]
+        forward += forward_tables[b][block_indices]
+        reverse += reverse_tables[b][block_indices]
+    return forward, reverse
+
+
+def use_lookup(motif_length):
+    """Return True when a motif is short enough to be scored with k-mer tables."""
+    return motif_length <= LOOKUP_MAX_LENGTH
+
+
+def score_encoded(matrix, codes, lookup=None):
+    """Score every offset of every encoded sequence on both strands.
+
+    Short motifs (see use_lookup) are scored with precomputed k-mer tables (see score_lookup). Otherwise,
+    the sequences are one-hot encoded and viewed as sliding windows of the motif length, the windows are
+    then contracted against the log-odds matrix (and its reverse complement) with a single einsum each.
+    lookup forces one method or the other. Windows overlapping an invalid base or the padding are set to
+    NaN, the same way Bio.motifs does for ambiguous bases.
+
+    Returns the (n_sequences, n_offsets) arrays of forward and reverse strand scores (float32).
+    """
+    motif_length = matrix.shape[0]
+    n_offsets = codes.shape[1] - motif_length + 1
+    if n_offsets <= 0:
+        empty = np.empty((codes.shape[0], 0), dtype=np.float32)
+        return empty, empty
+
+    if lookup is None:
+        lookup = use_lookup(motif_length)
+    if lookup:
+        forward, reverse = score_lookup(matrix, codes, n_offsets)
+    else:
+        windows = sliding_window_view(_ONEHOT[codes], motif_length, axis=1)
+        # Reversing both the columns and the ACGT axis gives the reverse complement.
+        forward = np.einsum("nobj,jb->no", windows, matrix)
+        reverse = np.einsum("nobj,jb->no", windows, matrix[::-1, ::-1])
+
+    valid = valid_windows(codes, motif_length)
+    forward[~valid] = np.nan
+    reverse[~valid] = np.nan
+    return forward.astype(np.float32), reverse.astype(np.float32)
+
+
+def hits_from_scores(forward, reverse, lengths, scorethreshold):
+    """Turn forward/reverse score arrays into per-sequence lists of (position, score) hits.
+
+    Positions follow the Bio.motifs convention: offsets on the positive strand, and
+    offset - len(sequence) on the negative strand. Hits are ordered by offset, the hits of both strands at the
+    same offset in the order of Bio.motifs search (see bio_order).
+    """
+    results = []
+    for i, length in enumerate(lengths):
+        fwd = forward[i]
+        rev = reverse[i]
+        pos_positions = np.flatnonzero(fwd >= scorethreshold)
+        neg_positions = np.flatnonzero(rev >= scorethreshold)
+        positions = np.append(pos_positions, neg_positions - length)
+        scores = np.append(fwd[pos_positions], rev[neg_positions])
+        order = bio_order(np.append(pos_positions, neg_positions))
+        results.append(list(zip(positions[order], scores[order])))
+    return results
+
+
+def scan_encoded(matrix, codes, lengths, scorethreshold):
+    """Return, for each encoded sequence, the list of (position, score) hits above scorethreshold."""
+    forward, reverse = score_encoded(matrix, codes)
+    return hits_from_scores(forward, reverse, lengths, scorethreshold)
+
+
+def stack_matrices(matrices):
+    """Stack log-odds matrices of different lengths into padded (n_motifs, max_length, 4) tensors.
+
+    Shorter motifs are padded with zero columns at their end, which leaves their scores unchanged.
+    Returns the forward tensor, the reverse complement tensor and the array of motif lengths.
+    """
+    motif_lengths = np.array([m.shape[0] for m in matrices], dtype=np.int64)
+    max_length = int(motif_lengths.max(initial=0))
+    forward = np.zeros((len(matrices), max_length, 4))
+    reverse = np.zeros((len(matrices), max_length, 4))
+    for k, matrix in enumerate(matrices):
+        forward[k, : matrix.shape[0]] = matrix
+        reverse[k, : matrix.shape[0]] = matrix[::-1, ::-1]
+    return forward, reverse, motif_lengths
+
+
+def motif_thresholds(scorethreshold, n_motifs):
+    """Return an array with the threshold of each of n_motifs motifs, from one threshold or one per motif."""
+    return np.broadcast_to(np.asarray(scorethreshold, dtype=float), (n_motifs,))
+
+
+def scan_encoded_batch(matrices, codes, lengths, scorethreshold):
+    """Scan several motifs over the same encoded sequences in one pass.
+
+    The matrices are stacked into padded tensors (see stack_matrices) and every motif is scored
+    against the same one-hot sliding-window view of the sequences with a single einsum per strand.
+    Motifs short enough for k-mer tables (see use_lookup) are scored on their own instead.
+
+    scorethreshold is either one threshold for all the motifs, or a sequence with the threshold of each motif.
+
+    Returns, for each motif, a HitTable of its hits (see app.utils.hits), the sequences being identified by
+    their index in codes.
+    """
+    if not matrices:
+        return []
+    thresholds = motif_thresholds(scorethreshold, len(matrices))
+    results = [None] * len(matrices)
+    stacked = []
+    for k, matrix in enumerate(matrices):
+        if use_lookup(matrix.shape[0]):
+            forward, reverse = score_encoded(matrix, codes, lookup=True)
+            results[k] = HitTable.from_scores(forward, reverse, lengths, thresholds[k])
+        else:
+            stacked.append(k)
+    if not stacked:
+        return results
+
+    forward_stack, reverse_stack, motif_lengths = stack_matrices([matrices[k] for k in stacked])
+    max_length = forward_stack.shape[1]
+
+    # Pad the sequences so that every offset of the longest sequence is covered by the longest motif.
+    padded = np.full((codes.shape[0], codes.shape[1] + max_length - 1), INVALID, dtype=np.uint8)
+    padded[:, : codes.shape[1]] = codes
+    windows = sliding_window_view(_ONEHOT[padded], max_length, axis=1)
+    forward = np.einsum("nobj,kjb->kno", windows, forward_stack)
+    reverse = np.einsum("nobj,kjb->kno", windows, reverse_stack)
+
+    for i, (k, motif_length) in enumerate(zip(stacked, motif_lengths)):
+        n_offsets = max(codes.shape[1] - int(motif_length) + 1, 0)
+        valid = valid_windows(padded, motif_length)[:, :n_offsets]
+        fwd = forward[i, :, :n_offsets]
+        rev = reverse[i, :, :n_offsets]
+        fwd[~valid] = np.nan
+        rev[~valid] = np.nan
+        results[k] = HitTable.from_scores(
+            fwd.astype(np.float32), rev.astype(np.float32), lengths, thresholds[k]
+        )
+    return results
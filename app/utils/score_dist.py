@@ -0,0 +1,127 @@
+"""Exact score distributions of PSSMs, used to turn p-values into score thresholds.
+
+The distribution of the log-odds score of a motif over random sequences drawn from a background model is
+computed by dynamic programming over its columns, on scores discretized to STEP (the same approach as
+Bio.motifs ScoreDistribution, with NumPy shifted additions instead of Python loops). Only the survival
+function, P(score >= s), is kept.
+
+Distributions are computed once per (motif id, pseudocount, background) and cached in memory and on disk,
+next to the motif store, in ./data/motifs/distributions/<motif id>_<pseudocount>_<background>.npz. The motif
+id is the version stored (see app.utils.motif_store.resolve_id), so that an id without version shares the
+distribution of its latest version and never reads the one of an older version.
+"""
+
+import hashlib
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from app.utils.background import UNIFORM
+from app.utils.motif_store import MOTIFS_DIR, get_pssm, motif_version
+from app.utils.scan import pssm_matrix
+
+DISTRIBUTIONS_DIR = os.path.join(MOTIFS_DIR, "distributions")
+STEP = 0.01
+
+
+class ScoreDistribution:
+    """Survival function of the discretized score of a motif, P(score >= offset + i * step)."""
+
+    def __init__(self, offset, step, survival):
+        self.offset = offset
+        self.step = step
+        self.survival = survival
+
+    @classmethod
+    def from_matrix(cls, matrix, background=UNIFORM, step=STEP):
+        """Compute the distribution of a (motif_length, 4) log-odds matrix under a background model.
+
+        Entries of -inf (bases never seen in the motif, without pseudocount) make the score -inf, their
+        probability is left out of the distribution, which does not change P(score >= s) for any finite s.
+        """
+        finite = np.where(np.isfinite(matrix), matrix, np.nan)
+        mins = np.nanmin(finite, axis=1)
+        # Scores of each column, as integer numbers of steps above the column minimum.
+        bins = np.rint((finite - mins[:, None]) / step)
+
+        probabilities = np.ones(1)
+        for column in bins:
+            size = len(probabilities) + int(np.nanmax(column))
+            shifted = np.zeros(size)
+            for base, shift in enumerate(column):
+                if not np.isnan(shift):
+                    shift = int(shift)
+                    shifted[shift : shift + len(probabilities)] += background[base] * probabilities
+            probabilities = shifted
+
+        survival = np.cumsum(probabilities[::-1])[::-1]
+        return cls(float(mins.sum()), step, survival)
+
+    def threshold(self, p_value):
+        """Return the lowest score whose p-value (probability of a score at least as high) is <= p_value."""
+        above = np.flatnonzero(self.survival <= p_value)
+        if len(above) == 0:
+            # Even the best score is more frequent than p_value, every score passes.
+            return -np.inf
+        return self.offset + above[0] * self.step
+
+    def p_value(self, score):
+        """Return P(score' >= score) for a random sequence of the background model."""
+        i = int(np.ceil((score - self.offset) / self.step - 1e-9))
+        if i <= 0:
+            return float(self.survival[0])
+        if i >= len(self.survival):
+            return 0.0
+        return float(self.survival[i])
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, offset=self.offset, step=self.step, survival=self.survival)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(float(data["offset"]), float(data["step"]), data["survival"])
+
+
+def background_key(background):
+    """Return a short, file name safe key of a background model."""
+    return hashlib.sha256(repr(tuple(round(float(p), 6) for p in background)).encode()).hexdigest()[:12]
+
+
+def distribution_path(motif_id, pseudocount, background):
+    return os.path.join(
+        DISTRIBUTIONS_DIR, f"{motif_id}_{pseudocount}_{background_key(background)}.npz"
+    )
+
+
+def get_distribution(motif_id, pseudocount, background=UNIFORM):
+    """Return the ScoreDistribution of a motif, computed once and cached on disk.
+
+    background is a sequence of the A, C, G, T probabilities.
+    """
+    version = motif_version(motif_id)
+    return cached_distribution(version, pseudocount, tuple(background))
+
+
+@lru_cache(maxsize=1024)
+def cached_distribution(version, pseudocount, background):
+    """Return the ScoreDistribution of a stored motif version, see get_distribution."""
+    path = distribution_path(version, pseudocount, background)
+    if os.path.exists(path):
+        return ScoreDistribution.load(path)
+    # The log-odds and the random sequences share the same background, called like pwm2pssm to share its PSSM.
+    pssm, _ = get_pssm(version, pseudocount, background=background)
+    distribution = ScoreDistribution.from_matrix(pssm_matrix(pssm), background)
+    distribution.save(path)
+    return distribution
+
+
+def score_threshold(motif_id, pseudocount, p_value, background=UNIFORM):
+    """Translate a p-value into the log-odds score threshold of a motif."""
+    return get_distribution(motif_id, pseudocount, background).threshold(p_value)
+
@@ -0,0 +1,209 @@
+"""Store of promoter sequences keyed by (accession, promoter_length).
+
+All the promoters live in a single FASTA file, ./data/sequences/promoters.fa, indexed by a samtools-style
+.fai file (name, length, offset, line bases, line bytes). Records are named <accession>_<promoter_length>,
+the same names as the per-gene .fa files that were used before. Sequences are read through an mmap of the
+FASTA file using the .fai offsets, so looking up a promoter never scans the directory or parses a file.
+
+Several processes (the API workers, the batch runner pool) may share the store: appends take an exclusive
+fcntl lock on promoters.fa.lock, and a name missing from the index of a process is looked up again in the
+records appended to the .fai file by the others since it was read.
+"""
+
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+
+from app.utils import upstream
+from app.utils.utils import fetch_promotors
+
+SEQUENCES_DIR = "./data/sequences"
+STORE_NAME = "promoters.fa"
+LINE_BASES = 60
+
+logger = logging.getLogger(__name__)
+
+
+def record_name(accession, promoter_length):
+    """Return the name of the record of a promoter in the store."""
+    return f"{accession}_{promoter_length}"
+
+
+class SequenceStore:
+    """Append-only indexed FASTA of promoter sequences."""
+
+    def __init__(self, directory=SEQUENCES_DIR, name=STORE_NAME):
+        self.directory = directory
+        self.fasta_path = os.path.join(directory, name)
+        self.fai_path = self.fasta_path + ".fai"
+        self.lock_path = self.fasta_path + ".lock"
+        self._index = None
+        self._fai_size = 0  # Bytes of the .fai file read into the index.
+        self._handle = None
+        self._mmap = None
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _file_lock(self, shared=False):
+        """Hold the lock of the store files, shared by the processes using them."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, "a") as handle:
+            fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        """Read the records added to the .fai file since the last read into the index."""
+        if not os.path.exists(self.fai_path):
+            return
+        with open(self.fai_path, "rb") as handle:
+            handle.seek(self._fai_size)
+            data = handle.read()
+        # Only whole lines, in case a writer that does not take the lock is appending.
+        data = data[: data.rfind(b"\n") + 1]
+        self._fai_size += len(data)
+        for line in data.decode("ascii").splitlines():
+            name, length, offset, line_bases, line_bytes = line.split("\t")[:5]
+            self._index[name] = (int(length), int(offset), int(line_bases), int(line_bytes))
+
+    def _load_index(self):
+        """Read the .fai file into {name: (length, offset, line_bases, line_bytes)}."""
+        if self._index is None:
+            self._index = dict()
+            if os.path.exists(self.fai_path):
+                with self._file_lock(shared=True):
+                    self._read_index()
+        return self._index
+
+    def _entry(self, name):
+        """Return the index entry of a record, reading the records added by other processes on a miss."""
+        index = self._load_index()
+        grown = os.path.exists(self.fai_path) and os.path.getsize(self.fai_path) > self._fai_size
+        if name not in index and grown:
+            with self._file_lock(shared=True):
+                self._read_index()
+        return index.get(name)
+
+    def _map(self, end):
+        """Return an mmap of the FASTA file covering at least the first end bytes."""
+        if self._mmap is None or len(self._mmap) < end:
+            self.close()
+            self._handle = open(self.fasta_path, "rb")
+            self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._handle.close()
+            self._mmap = self._handle = None
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._entry(name) is not None
+
+    def get(self, name):
+        """Return the sequence of a record as bytes, or None if it is not in the store."""
+        with self._lock:
+            entry = self._entry(name)
+            if entry is None:
+                return None
+            length, offset, line_bases, line_bytes = entry
+            # Number of bytes taken by the sequence, new lines included.
+            end = offset + (length // line_bases) * line_bytes + length % line_bases
+            return self._map(end)[offset:end].replace(b"\n", b"").replace(b"\r", b"")
+
+    def add(self, name, sequence, description=""):
+        """Append a sequence (str, Seq or bytes) to the FASTA file and to its index.
+
+        A record that another process added in the meantime is not added again.
+        """
+        if isinstance(sequence, str):
+            sequence = sequence.encode("ascii")
+        sequence = bytes(sequence)
+        with self._lock:
+            index = self._load_index()
+            with self._file_lock():
+                self._read_index()
+                if name in index:
+                    return
+                header = f">{name} {description}".rstrip() + "\n"
+                with open(self.fasta_path, "ab") as handle:
+                    # The end of the file, whatever was appended since it was opened.
+                    offset = os.fstat(handle.fileno()).st_size + len(header)
+                    handle.write(header.encode("ascii"))
+                    for i in range(0, len(sequence), LINE_BASES):
+                        handle.write(sequence[i : i + LINE_BASES] + b"\n")
+                entry = (len(sequence), offset, LINE_BASES, LINE_BASES + 1)
+                with open(self.fai_path, "a") as handle:
+                    handle.write("\t".join(str(x) for x in (name,) + entry) + "\n")
+                self._fai_size = os.path.getsize(self.fai_path)
+                index[name] = entry
+
+    def missing(self, list_mRNA, promoter_length):
+        """Return the mRNAs of a list whose promoters are not in the store.
+
+        Promoters found in a legacy <accession>_<length>.fa file are imported into the store first.
+        """
+        missing = []
+        for mrna in dict.fromkeys(list_mRNA):
+            name = record_name(mrna, promoter_length)
+            if name in self:
+                continue
+            legacy_path = os.path.join(self.directory, name + ".fa")
+            if os.path.exists(legacy_path):
+                from Bio import SeqIO
+
+                record = SeqIO.read(legacy_path, "fasta")
+                self.add(name, record.seq, record.description)
+            else:
+                missing.append(mrna)
+        return missing
+
+    def add_records(self, records, promoter_length):
+        """Add the {mrna: SeqRecord} promoters downloaded from NCBI to the store."""
+        for mrna, record in records.items():
+            self.add(record_name(mrna, promoter_length), record.seq, record.description)
+
+    def fetch(self, list_mRNA, promoter_length):
+        """Return {mrna: promoter sequence as bytes} for a list of mRNA accessions.
+
+        Promoters missing from the store are imported from a legacy <accession>_<length>.fa file when one
+        exists, otherwise downloaded from NCBI in one batch (see fetch_promotors), and added to the store.
+        """
+        missing = self.missing(list_mRNA, promoter_length)
+        if missing:
+            logger.info("Fetching %d promoters from NCBI", len(missing))
+            self.add_records(fetch_promotors(missing, promoter_length), promoter_length)
+
+        return {mrna: self.get(record_name(mrna, promoter_length)) for mrna in list_mRNA}
+
+    async def prefetch(self, list_mRNA, promoter_length):
+        """Download the missing promoters of a list of mRNAs with the async client of app.utils.upstream.
+
+        Once done, fetch reads all of them from the store without any network call. The lookups and appends,
+        which read legacy files and wait for the lock of the store, run in a thread, off the event loop.
+        """
+        missing = await asyncio.to_thread(self.missing, list_mRNA, promoter_length)
+        if missing:
+            logger.info("Fetching %d promoters from NCBI", len(missing))
+            records = await upstream.fetch_promotors(missing, promoter_length)
+            await asyncio.to_thread(self.add_records, records, promoter_length)
+
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+def get_store(directory=SEQUENCES_DIR):
+    """Return the process-wide SequenceStore of a directory."""
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = SequenceStore(directory)
+        return _stores[directory]
@@ -0,0 +1,202 @@
+"""Async clients of the upstream services, the NCBI E-utilities and the JASPAR API.
+
+Each upstream has one pooled httpx.AsyncClient (keep-alive connections), a bound on its concurrent
+requests and its own timeout, so that waiting on the network never holds a worker thread:
+
+    TFBS_NCBI_URL, TFBS_NCBI_CONCURRENCY (3), TFBS_NCBI_TIMEOUT (30 s)
+    TFBS_JASPAR_URL, TFBS_JASPAR_CONCURRENCY (8), TFBS_JASPAR_TIMEOUT (30 s)
+
+NCBI requests also take their tokens from the rate limiter of the blocking calls (see entrez_call). The
+functions below mirror the blocking ones of app.utils.utils and parse the responses the same way, the URLs
+can point to a local mock server to run offline (see benchmarks/mock_upstream.py). httpx is imported on
+first use (see app.utils.warmup).
+"""
+
+import asyncio
+import io
+import logging
+import os
+
+from Bio import Entrez
+
+from app.utils.metrics import ENTREZ_CALLS
+from app.utils.utils import (
+    _limiters,
+    batches,
+    collection_params,
+    db,
+    dbfrom,
+    genes_from_linksets,
+    jaspar_timeout,
+    jaspar_url,
+    max_retries,
+    ncbi_timeout,
+    ncbi_url,
+    entrez_params,
+    read_fasta_bytes,
+    retry_backoff,
+    summaries_from_record,
+    transient,
+    unknown_ids,
+    upstream_params,
+    write_motif,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Upstream:
+    """Pooled async HTTP client of an upstream service, with a bound on its concurrent requests."""
+
+    def __init__(self, name, base_url, concurrency, timeout):
+        self.name = name
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._loop = None
+        self._client = None
+        self._semaphore = None
+
+    def _bind(self):
+        # Clients and semaphores belong to an event loop, they are created again for a new loop.
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.concurrency, max_keepalive_connections=self.concurrency
+                ),
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def get(self, path, params=None, limiter=None, utility=None):
+        """GET a path (or an absolute URL) and return the response.
+
+        Network errors, timeouts and HTTP 429 or 5xx answers are retried up to max_retries times, with an
+        exponential backoff, other errors are raised right away. limiter is a RateLimiter to take a token from
+        before each try, utility the label of the calls in ENTREZ_CALLS.
+        """
+        import httpx
+
+        self._bind()
+        for attempt in range(max_retries):
+            async with self._semaphore:
+                if limiter is not None:
+                    await asyncio.sleep(limiter.reserve())
+                try:
+                    response = await self._client.get(path, params=params)
+                    response.raise_for_status()
+                except httpx.HTTPError as e:
+                    if utility is not None:
+                        ENTREZ_CALLS.inc(utility=utility, outcome="error")
+                    if attempt == max_retries - 1 or not transient(e):
+                        raise
+                    logger.warning("%s %s failed (%s), retrying...", self.name, path, e)
+                else:
+                    if utility is not None:
+                        ENTREZ_CALLS.inc(utility=utility, outcome="ok")
+                    return response
+            await asyncio.sleep(retry_backoff * 2**attempt)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+        self._loop = self._client = self._semaphore = None
+
+
+ncbi = Upstream("NCBI", ncbi_url, int(os.environ.get("TFBS_NCBI_CONCURRENCY", 3)), ncbi_timeout)
+jaspar = Upstream("JASPAR", jaspar_url, int(os.environ.get("TFBS_JASPAR_CONCURRENCY", 8)), jaspar_timeout)
+
+
+async def close():
+    """Close the connections of the clients, on shutdown."""
+    await asyncio.gather(ncbi.aclose(), jaspar.aclose())
+
+
+async def entrez(utility, parse=Entrez.read, **params):
+    """Call an Entrez utility (e.g. "esummary") under the NCBI rate limit and parse its result."""
+    response = await ncbi.get(
+        f"{utility}.fcgi", entrez_params(params), limiter=_limiters[bool(Entrez.api_key)], utility=utility
+    )
+    return parse(io.BytesIO(response.content))
+
+
+async def mrnas_to_genes(ids_mrna_list):
+    """Search for the gene ids of a list of mrna accession numbers, see app.utils.utils.mrnas_to_genes."""
+    async def link(batch):
+        # A list of ids is sent as repeated id parameters, which gives one LinkSet per id.
+        record = await entrez("elink", dbfrom=dbfrom, db=db, id=batch)
+        if len(record) == len(batch):
+            return genes_from_linksets(batch, record)
+        # Some ids could not be linked, fall back to one request per id.
+        genes = dict()
+        for id_mrna in batch:
+            try:
+                record = await entrez("elink", dbfrom=dbfrom, db=db, id=id_mrna)
+            except Exception as e:
+                if not unknown_ids(e):
+                    raise
+                raise ValueError(f"No gene id found for {id_mrna}") from e
+            genes.update(genes_from_linksets([id_mrna], record))
+            if id_mrna not in genes:
+                raise ValueError(f"No gene id found for {id_mrna}")
+        return genes
+
+    genes = dict()
+    for batch_genes in await asyncio.gather(*(link(batch) for batch in batches(list(ids_mrna_list)))):
+        genes.update(batch_genes)
+    return genes
+
+
+async def gene_summaries(gene_ids):
+    """Fetch the summaries of a list of genes, see app.utils.utils.gene_summaries."""
+    records = await asyncio.gather(
+        *(
+            entrez("esummary", db=db, id=",".join(batch))
+            for batch in batches([str(id_gene) for id_gene in gene_ids])
+        )
+    )
+    summaries = dict()
+    for record in records:
+        summaries.update(summaries_from_record(record))
+    return summaries
+
+
+async def fetch_promotors(ids_mrna_list, seq_length):
+    """Fetch the promotor sequences of a list of MRNA from NCBI, see app.utils.utils.fetch_promotors.
+
+    The sequences are fetched concurrently, at most TFBS_NCBI_CONCURRENCY at a time.
+
+    Returns a dictionnary {mrna: SeqRecord}.
+    """
+    genes = await mrnas_to_genes(ids_mrna_list)
+    summaries = await gene_summaries(sorted(set(genes.values())))
+
+    async def fetch(id_mrna):
+        info = summaries[str(genes[id_mrna])]["GenomicInfo"][0]
+        return await entrez("efetch", read_fasta_bytes, **upstream_params(info, seq_length))
+
+    records = await asyncio.gather(*(fetch(id_mrna) for id_mrna in ids_mrna_list))
+    return dict(zip(ids_mrna_list, records))
+
+
+async def download_motif(motif_id, out_put_dir):
+    """Download a motif from the JASPAR API and save it in the JASPAR format."""
+    response = await jaspar.get(f"matrix/{motif_id}/")
+    write_motif(motif_id, response.json(), out_put_dir)
+
+
+async def list_collection_motifs(collection, tax_group=None):
+    """List the matrix ids of a JASPAR collection, see app.utils.utils.list_collection_motifs."""
+    url, params = "matrix/", collection_params(collection, tax_group)
+    motif_ids = []
+    while url:
+        data = (await jaspar.get(url, params)).json()
+        motif_ids.extend(matrix["matrix_id"] for matrix in data["results"])
+        # The next page url already carries the query parameters.
+        url, params = data.get("next"), None
+    return motif_ids
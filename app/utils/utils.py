@@ -1,136 +1,268 @@
-from Bio import SeqIO, Entrez
-import requests
+from Bio import Entrez
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
 import os
+import threading
+import time
 
-dbfrom = "nucleotide"
-db = "gene"
+from app.utils.metrics import ENTREZ_CALLS
 
+logger = logging.getLogger(__name__)
 
-def find_cds(seqrecord):
-    """Fonction used to find the coding area on a gene.
+dbfrom = "nucleotide"
+db = "gene"
 
-    Returns the start and end location of the coding area on a gene.
-    """
-    result = []
-    couplePosition = tuple()
+batch_size = 200  # Maximum number of ids per elink/esummary request.
+fetch_workers = 4  # Concurrent efetch requests.
+max_retries = 4
+retry_backoff = 0.5  # Seconds, doubled after each failed try.
 
-    for f in seqrecord.features:
-        if f.type == "CDS":
-            couplePosition = (f.location._start.position, f.location._end.position)
-            result.append(couplePosition)
+# Upstream services, the URLs can point to a local mock server (see benchmarks/mock_upstream.py).
+ncbi_url = os.environ.get("TFBS_NCBI_URL", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/")
+jaspar_url = os.environ.get("TFBS_JASPAR_URL", "https://jaspar2020.genereg.net/api/v1/")
+ncbi_timeout = float(os.environ.get("TFBS_NCBI_TIMEOUT", 30))  # Seconds.
+jaspar_timeout = float(os.environ.get("TFBS_JASPAR_TIMEOUT", 30))  # Seconds.
 
-    return result
+# Keep-alive connections to NCBI and JASPAR, shared by the blocking calls (see http_session).
+_session = None
+_session_lock = threading.Lock()
 
 
 def mrna_to_gene(num_accession):
     """Search for the id of gene given the number of accession of a mrna.
 
-    Returns the id of the gene from the gene data base.
+    Returns the id of the gene from the gene data base, raises ValueError when the mrna has none.
     """
 
-    handle = Entrez.elink(dbfrom=dbfrom, db=db, id=num_accession)
-    record = Entrez.read(handle)
-    handle.close()
-
     try:
-        linked = [link["Id"] for link in record[0]["LinkSetDb"][0]["Link"]]
-        return linked[0]
-    except ValueError:
-        print("No id found...")
+        record = entrez_call("elink", dbfrom=dbfrom, db=db, id=num_accession)
+    except Exception as e:
+        # NCBI answers some unknown accessions with an error instead of an empty LinkSet, the failures of
+        # the service itself are raised as they are.
+        if not unknown_ids(e):
+            raise
+        raise ValueError(f"No gene id found for {num_accession}") from e
+    genes = genes_from_linksets([num_accession], record)
+    if num_accession not in genes:
+        raise ValueError(f"No gene id found for {num_accession}")
+    return genes[num_accession]
+
+
+def upstream_seq_from_info(info, seq_length):
+    """Fetch the upstream sequence of a gene from the GenomicInfo of its summary.
 
+    Return the promotor sequence of a gene.
+    """
 
-def get_genom_id_accession(id_gene):
-    """Search for the id accession fo the chromosom given a gene id.
+    return entrez_call("efetch", read_fasta_bytes, **upstream_params(info, seq_length))
 
-    Returns the id accession of chromosomes.
-    """
 
-    handle = Entrez.esummary(db=db, id=id_gene)
-    record = Entrez.read(handle)
-    handle.close()
+def upstream_params(info, seq_length):
+    """Return the efetch parameters of the upstream sequence of a gene, from its GenomicInfo."""
+
+    seq_start = int(info["ChrStart"])
+    seq_stop = int(info["ChrStop"])
+    genom_accession = info["ChrAccVer"]
+
+    if seq_start < seq_stop:
+        params = dict(strand=1, seq_start=str(seq_start - seq_length), seq_stop=str(seq_start))
+    else:
+        params = dict(strand=-1, seq_start=str(seq_start + 2), seq_stop=str(seq_start + seq_length))
+
+    return dict(db=dbfrom, id=genom_accession, rettype="fasta", retmode="text", **params)
+
+
+def read_fasta(handle):
+    # Bio.SeqIO is imported on first use, see app.utils.warmup.
+    from Bio import SeqIO
+
+    return SeqIO.read(handle, "fasta")
+
+
+def read_fasta_bytes(handle):
+    return read_fasta(io.TextIOWrapper(handle, encoding="ascii"))
+
+
+def http_session():
+    """Return the requests session of the blocking NCBI and JASPAR calls, created on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+
+            _session = requests.Session()
+        return _session
+
 
-    dictElem = dict(record)["DocumentSummarySet"]
-    premierElem = dict(dictElem)["DocumentSummary"]
-    info = []
+class RateLimiter:
+    """Token bucket limiting the number of calls per second, shared between threads."""
 
-    for e in premierElem:
-        for stuff in dict(e).items():
-            if stuff[0] == "GenomicInfo":
-                info = stuff[1]
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-    return info[0]["ChrAccVer"]
+    def reserve(self):
+        """Take a token and return how long to wait, in seconds, before it can be used.
 
+        Tokens taken in advance leave the bucket in debt, so the callers waiting are served in order.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
 
-def get_seq_start_stop(id_gene):
-    """Search for the start and end sequence from a gene.
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        time.sleep(self.reserve())
 
-    Given an id of a gene, search for the start and end position of it sequence on the gene.
+
+# NCBI allows 3 requests per second, 10 with an API key.
+_limiters = {False: RateLimiter(3), True: RateLimiter(10)}
+
+
+def transient(error):
+    """Return whether a failed HTTP call (requests or httpx) is worth retrying.
+
+    Calls without an answer (network error, timeout) and answers 429 or 5xx are, other answers are not.
     """
-    seq_start = 0
-    seq_stop = 0
+    response = getattr(error, "response", None)
+    return response is None or response.status_code == 429 or response.status_code >= 500
 
-    handle = Entrez.esummary(db=db, id=id_gene)
-    record = Entrez.read(handle)
-    handle.close()
 
-    dictElem = dict(record)["DocumentSummarySet"]
-    premierElem = dict(dictElem)["DocumentSummary"]
-    info = []
+def unknown_ids(error):
+    """Return whether a failed Entrez call is NCBI rejecting the ids of the request, not a failure of NCBI.
 
-    for e in premierElem:
-        for stuff in dict(e).items():
-            if stuff[0] == "GenomicInfo":
-                info = stuff[1]
+    NCBI rejects them with an HTTP 400, or with an error in its answer, raised by Entrez.read.
+    """
+    if isinstance(error, RuntimeError):
+        return "invalid" in str(error).lower()
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code == 400
 
-    seq_start = info[0]["ChrStart"]
-    seq_stop = info[0]["ChrStop"]
 
-    return seq_start, seq_stop
+def entrez_params(params):
+    """Return the parameters of an Entrez call with the tool, email and API key of Bio.Entrez."""
+    params = dict(params, tool=Entrez.tool, email=Entrez.email, api_key=Entrez.api_key)
+    return {key: value for key, value in params.items() if value is not None}
 
 
-def upstream_gene_seq(id_gene, seq_length):
-    """Find the upstream sequence of a gene.
-    Return the promotor sequence of a gene.
+def entrez_call(utility, parse=Entrez.read, **params):
+    """Call an Entrez utility (e.g. "esummary") of ncbi_url under the NCBI rate limit and parse its result.
+
+    A list of ids is sent as repeated id parameters. Network errors, timeouts and HTTP 429 or 5xx answers are
+    retried up to max_retries times, with an exponential backoff, other errors are raised right away.
+    """
+    import requests
+
+    limiter = _limiters[bool(Entrez.api_key)]
+    for attempt in range(max_retries):
+        limiter.acquire()
+        try:
+            response = http_session().get(
+                f"{ncbi_url}{utility}.fcgi", params=entrez_params(params), timeout=ncbi_timeout
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            ENTREZ_CALLS.inc(utility=utility, outcome="error")
+            if attempt == max_retries - 1 or not transient(e):
+                raise
+            logger.warning("Entrez %s failed (%s), retrying...", utility, e)
+            time.sleep(retry_backoff * 2**attempt)
+        else:
+            ENTREZ_CALLS.inc(utility=utility, outcome="ok")
+            return parse(io.BytesIO(response.content))
+
+
+def batches(ids, size=None):
+    """Split a list of ids into lists of at most size (batch_size by default) ids."""
+    size = size or batch_size
+    return [ids[i : i + size] for i in range(0, len(ids), size)]
+
+
+def mrnas_to_genes(ids_mrna_list):
+    """Search for the gene ids of a list of mrna accession numbers, batch_size mrnas per request.
+
+    Returns a dictionnary {mrna: gene id}.
+    """
+    genes = dict()
+    for batch in batches(list(ids_mrna_list)):
+        # A list of ids gives one LinkSet per id, in the same order.
+        record = entrez_call("elink", dbfrom=dbfrom, db=db, id=batch)
+        if len(record) != len(batch):
+            # Some ids could not be linked, fall back to one request per id.
+            for id_mrna in batch:
+                genes[id_mrna] = mrna_to_gene(id_mrna)
+            continue
+        genes.update(genes_from_linksets(batch, record))
+    return genes
+
+
+def genes_from_linksets(batch, record):
+    """Return {mrna: gene id} from the elink result of a batch of mrnas, one LinkSet per mrna."""
+    genes = dict()
+    for id_mrna, linkset in zip(batch, record):
+        try:
+            genes[id_mrna] = linkset["LinkSetDb"][0]["Link"][0]["Id"]
+        except (IndexError, KeyError):
+            raise ValueError(f"No gene id found for {id_mrna}") from None
+    return genes
+
+
+def gene_summaries(gene_ids):
+    """Fetch the summaries of a list of genes, batch_size genes per request.
+
+    Returns a dictionnary {gene id: DocumentSummary}.
     """
+    summaries = dict()
+    for batch in batches([str(id_gene) for id_gene in gene_ids]):
+        record = entrez_call("esummary", db=db, id=",".join(batch))
+        summaries.update(summaries_from_record(record))
+    return summaries
 
-    seq_start, seq_stop = get_seq_start_stop(id_gene)
-    genom_accession = get_genom_id_accession(id_gene)
 
-    if seq_start < seq_stop:
-        handle = Entrez.efetch(
-            db=dbfrom,
-            id=genom_accession,
-            rettype="fasta",
-            strand=1,
-            retmode="text",
-            seq_start=str(int(seq_start) - seq_length),
-            seq_stop=seq_start,
-        )
-        genomic_record = SeqIO.read(handle, "fasta")
-    else:
-        handle = Entrez.efetch(
-            db=dbfrom,
-            id=genom_accession,
-            rettype="fasta",
-            strand=-1,
-            retmode="text",
-            seq_start=str(int(seq_start) + 2),
-            seq_stop=str(int(seq_start) + seq_length),
-        )
-        genomic_record = SeqIO.read(handle, "fasta")
+def summaries_from_record(record):
+    """Return {gene id: DocumentSummary} from an esummary result."""
+    return {
+        str(summary.attributes["uid"]): summary
+        for summary in record["DocumentSummarySet"]["DocumentSummary"]
+    }
 
-    handle.close()
 
-    return genomic_record
+def fetch_promotors(ids_mrna_list, seq_length):
+    """Fetch the promotor sequences of a list of MRNA from NCBI.
+
+    The gene ids and summaries are fetched in batches (each summary only once), then the sequences are fetched
+    concurrently by fetch_workers threads, all requests staying under the NCBI rate limit.
+
+    Returns a dictionnary {mrna: SeqRecord}.
+    """
+    genes = mrnas_to_genes(ids_mrna_list)
+    summaries = gene_summaries(sorted(set(genes.values())))
+
+    def fetch(id_mrna):
+        info = summaries[str(genes[id_mrna])]["GenomicInfo"][0]
+        return upstream_seq_from_info(info, seq_length)
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        records = list(executor.map(fetch, ids_mrna_list))
+    return dict(zip(ids_mrna_list, records))
 
 
 def download_motif(motif_id, out_put_dir):
     """Download a motif from the JASPAR API and save it in the JASPAR format."""
-    url = f"https://jaspar2020.genereg.net/api/v1/matrix/{motif_id}/"
-    response = requests.get(url)
+    response = http_session().get(f"{jaspar_url}matrix/{motif_id}/", timeout=jaspar_timeout)
     response.raise_for_status()
-    data = response.json()
+    write_motif(motif_id, response.json(), out_put_dir)
+
 
+def write_motif(motif_id, data, out_put_dir):
+    """Save the JSON description of a matrix by the JASPAR API in the JASPAR format."""
     pfm = data["pfm"]
     jaspar_format = f">{motif_id}\t{data['name']}\n"
     jaspar_format += "A  [ " + " ".join(f"{int(x):>5}" for x in pfm["A"]) + " ]\n"
@@ -141,31 +273,31 @@ def download_motif(motif_id, out_put_dir):
     filename = os.path.join(out_put_dir, motif_id + ".jaspar")
     with open(filename, "w") as f:
         f.write(jaspar_format)
-    print("Download done.")
+    logger.debug("Motif %s downloaded.", motif_id)
 
 
-def download_promotors(ids_mrna_list, seq_length, out_put_dir):
-    """Download promotors sequences for a list of MRNA as fasta files."""
-    print("Downloading files, please wait:")
-    for id_mrna in ids_mrna_list:
-        print("Fetching data for gene: " + id_mrna)
-        id_gene = mrna_to_gene(id_mrna)
-        seq = upstream_gene_seq(id_gene, seq_length)
-        filename = os.path.join(out_put_dir, id_mrna + "_" + str(seq_length) + ".fa")
-        SeqIO.write(seq, filename, "fasta")
-        print("Download done.")
+def list_collection_motifs(collection, tax_group=None):
+    """List the matrix ids of a JASPAR collection (e.g. CORE), optionally restricted to a taxonomic group.
 
-
-def Seq_obj_from_files(files_list):
-    """Take a list of promotor sequences from fasta files.
-
-    Return a list of SeqRecord objects.
+    Returns the ids of the latest version of each matrix.
     """
-
-    seq_obj_list = list()
-
-    for file in files_list:
-        seq_object = SeqIO.read(file, "fasta")
-        seq_obj_list.append(seq_object)
-
-    return seq_obj_list
+    url = f"{jaspar_url}matrix/"
+    params = collection_params(collection, tax_group)
+
+    motif_ids = []
+    while url:
+        response = http_session().get(url, params=params, timeout=jaspar_timeout)
+        response.raise_for_status()
+        data = response.json()
+        motif_ids.extend(matrix["matrix_id"] for matrix in data["results"])
+        # The next page url already carries the query parameters.
+        url, params = data.get("next"), None
+    return motif_ids
+
+
+def collection_params(collection, tax_group=None):
+    """Return the query parameters of the list of the matrices of a JASPAR collection."""
+    params = {"collection": collection, "version": "latest", "page_size": 1000, "format": "json"}
+    if tax_group:
+        params["tax_group"] = tax_group
+    return params
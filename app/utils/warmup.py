@@ -0,0 +1,151 @@
+"""Warm start of the API workers.
+
+The heavy modules that only some requests need (Bio.motifs, Bio.SeqIO, httpx, requests) are imported on
+first use, so that importing the app, and forking its workers, stays fast. The warm-up imports them, then
+preloads the motifs and promoter sets of a JSON file into the caches, so that the first requests after a
+scale-out are as fast as the next ones:
+
+    {
+        "motifs": ["MA0114.4", "MA0139.1"],
+        "pseudocounts": [0.8],
+        "backgrounds": ["uniform", "human"],
+        "distributions": true,
+        "promoters": [{"mrna": ["NM_001100", "NM_002469"], "promoter_length": 1000}]
+    }
+
+The PSSMs of every motif are computed for each pseudocount and background ("promoters" being the background
+of each promoter set), and with "distributions" their score distributions are loaded for p-value thresholds.
+Promoters missing from the store are downloaded.
+
+TFBS_WARMUP_FILE sets the file (./data/warmup.json by default, the warm-up only imports the modules without
+it) and TFBS_WARMUP the mode:
+
+- "startup" (default), each worker warms up in the background from the startup hook of the app, /health
+  reports it ready once done,
+- "import", the warm-up runs when the app is imported. With a pre-fork launcher that imports the app before
+  forking its workers, they share the warm state of the master copy-on-write:
+
+      TFBS_WARMUP=import gunicorn app:app --preload -w 4 -k uvicorn.workers.UvicornWorker
+
+- "off", no warm-up, the app is ready right away.
+"""
+
+import gc
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+
+WARMUP_MODE = os.environ.get("TFBS_WARMUP", "startup")
+WARMUP_FILE = os.environ.get("TFBS_WARMUP_FILE", "./data/warmup.json")
+HEAVY_MODULES = ("Bio.motifs", "Bio.SeqIO", "httpx", "requests")
+
+# Reported by /health.
+status = {
+    "ready": WARMUP_MODE == "off",
+    "phase": "off" if WARMUP_MODE == "off" else "cold",
+    "import_seconds": None,
+    "seconds": None,
+    "pssms": 0,
+    "promoter_sets": 0,
+    "errors": [],
+}
+_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def read_config(path=WARMUP_FILE):
+    """Return the content of the warm-up file, or an empty configuration if there is none."""
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def import_modules():
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+
+
+def preload_promoters(config):
+    """Read the promoter sets into the store, returns {(mrnas, promoter_length): their background}."""
+    from app.utils.background import promoter_background
+    from app.utils.result_cache import sequence_set_key
+    from app.utils.seq_store import get_store
+
+    backgrounds = dict()
+    for promoter_set in config.get("promoters", []):
+        mrna, promoter_length = promoter_set["mrna"], promoter_set["promoter_length"]
+        try:
+            sequences = get_store().fetch(mrna, promoter_length)
+            backgrounds[(tuple(mrna), promoter_length)] = promoter_background(
+                sequences, sequence_set_key(sequences)
+            )
+            status["promoter_sets"] += 1
+        except Exception as e:
+            status["errors"].append(f"promoters {promoter_length} {','.join(mrna[:3])}...: {e}")
+    return backgrounds
+
+
+def preload_motifs(config, promoter_backgrounds):
+    """Compute the PSSMs (and score distributions) of the motifs, the same way as the searches do."""
+    from app.utils.background import resolve_background
+    from app.utils.pwm import pwm2pssm
+    from app.utils.score_dist import get_distribution
+
+    backgrounds = []
+    for name in config.get("backgrounds", ["uniform"]):
+        if name == "promoters":
+            backgrounds.extend(promoter_backgrounds.values())
+        else:
+            backgrounds.append(resolve_background(name, None, None))
+    backgrounds = list(dict.fromkeys(backgrounds))
+
+    for motif_id in config.get("motifs", []):
+        for pseudocount in config.get("pseudocounts", []):
+            for background in backgrounds:
+                try:
+                    pwm2pssm(motif_id, pseudocount, background)
+                    if config.get("distributions"):
+                        get_distribution(motif_id, pseudocount, tuple(background))
+                    status["pssms"] += 1
+                except Exception as e:
+                    status["errors"].append(f"motif {motif_id} ({pseudocount}): {e}")
+
+
+def warm():
+    """Run the warm-up, once per process: a worker forked from a warm master finds it done."""
+    with _lock:
+        if status["phase"] != "cold":
+            return status
+        status["phase"] = "warming"
+    start = time.perf_counter()
+    try:
+        import_modules()
+        status["import_seconds"] = round(time.perf_counter() - start, 3)
+        config = read_config()
+        preload_motifs(config, preload_promoters(config))
+    except Exception as e:
+        status["errors"].append(str(e))
+    finally:
+        # The searches work without the warm state, a failed warm-up only makes them slower.
+        status.update(phase="warm", ready=True, seconds=round(time.perf_counter() - start, 3))
+        logger.info(
+            "Warm-up done in %s s (%d PSSMs, %d promoter sets, %d errors).",
+            status["seconds"],
+            status["pssms"],
+            status["promoter_sets"],
+            len(status["errors"]),
+        )
+    return status
+
+
+def freeze():
+    """Keep the objects created so far out of the garbage collections.
+
+    The collector would otherwise write to their pages in the forked workers, which copies them.
+    """
+    gc.freeze()
@@ -0,0 +1,132 @@
+"""Measure the throughput of the genome scan on a random genome, in FASTA and .2bit formats.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_genome [--size 20] [--chunk-size 1000000] [--threshold 3.0]
+
+Before any timing, the hits of a scan with small, odd-sized chunks are checked against a single-chunk scan
+of every chromosome, so that windows overlapping two chunks are found exactly once.
+"""
+
+import argparse
+import os
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from app.utils.genome import TWOBIT_SIGNATURE, FastaGenome, TwoBitGenome, scan_genome
+from app.utils.scan import BASES, pssm_matrix
+
+from benchmarks.bench_scan import load_data
+
+LINE_BASES = 60
+
+
+def random_genome(size, n_chromosomes=4, seed=0):
+    """Return {chromosome: sequence} of random bases, with a few runs of N."""
+    rng = np.random.default_rng(seed)
+    genome = dict()
+    for i in range(n_chromosomes):
+        seq = np.array(list(BASES), dtype="S1")[rng.integers(0, 4, size // n_chromosomes + 37 * i)]
+        for start in rng.integers(0, len(seq) - 500, 3):
+            seq[start : start + rng.integers(1, 500)] = b"N"
+        genome[f"chr{i + 1}"] = seq.tobytes().decode("ascii")
+    return genome
+
+
+def write_fasta(genome, path):
+    with open(path, "w") as fasta, open(path + ".fai", "w") as fai:
+        for name, seq in genome.items():
+            fasta.write(f">{name}\n")
+            offset = fasta.tell()
+            for i in range(0, len(seq), LINE_BASES):
+                fasta.write(seq[i : i + LINE_BASES] + "\n")
+            fai.write(f"{name}\t{len(seq)}\t{offset}\t{LINE_BASES}\t{LINE_BASES + 1}\n")
+
+
+def write_twobit(genome, path):
+    codes = {"T": 0, "C": 1, "A": 2, "G": 3, "N": 0}
+    records = []
+    for seq in genome.values():
+        bases = np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+        is_n = np.concatenate([[False], bases == ord("N"), [False]])
+        changes = np.flatnonzero(is_n[1:] != is_n[:-1])
+        n_starts, n_ends = changes[::2], changes[1::2]
+        values = np.zeros(256, dtype=np.uint8)
+        for base, code in codes.items():
+            values[ord(base)] = code
+        padded = np.zeros(-(-len(seq) // 4) * 4, dtype=np.uint8)
+        padded[: len(seq)] = values[bases]
+        packed = (padded[0::4] << 6) | (padded[1::4] << 4) | (padded[2::4] << 2) | padded[3::4]
+        header = struct.pack("<2I", len(seq), len(n_starts))
+        header += np.asarray(n_starts, dtype="<u4").tobytes()
+        header += np.asarray(n_ends - n_starts, dtype="<u4").tobytes()
+        header += struct.pack("<2I", 0, 0)
+        records.append(header + packed.astype(np.uint8).tobytes())
+
+    index_size = sum(1 + len(name) + 4 for name in genome)
+    offset = 16 + index_size
+    with open(path, "wb") as handle:
+        handle.write(struct.pack("<4I", TWOBIT_SIGNATURE, 0, len(genome), 0))
+        for name, record in zip(genome, records):
+            handle.write(bytes([len(name)]) + name.encode("ascii") + struct.pack("<I", offset))
+            offset += len(record)
+        for record in records:
+            handle.write(record)
+
+
+def collect(hits):
+    return [
+        (chrom, int(start), int(strand), float(score))
+        for chrom, starts, strands, scores in hits
+        for start, strand, score in zip(starts, strands, scores)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=20, help="genome size, in Mbp")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000)
+    parser.add_argument("--threshold", type=float, default=3.0)
+    parser.add_argument("--pseudocount", type=float, default=0.5)
+    args = parser.parse_args()
+
+    pssm, _ = load_data(args.pseudocount)
+    matrix = pssm_matrix(pssm)
+
+    with tempfile.TemporaryDirectory() as directory:
+        small = random_genome(200_000, seed=1)
+        write_fasta(small, os.path.join(directory, "small.fa"))
+        write_twobit(small, os.path.join(directory, "small.2bit"))
+        for genome in (
+            FastaGenome(os.path.join(directory, "small.fa")),
+            TwoBitGenome(os.path.join(directory, "small.2bit")),
+        ):
+            whole = collect(scan_genome(genome, matrix, args.threshold, chunk_size=10**9))
+            chunked = collect(scan_genome(genome, matrix, args.threshold, chunk_size=997))
+            genome.close()
+            if whole != chunked:
+                raise SystemExit(f"Chunk parity check failed for {type(genome).__name__}.")
+        print(f"Chunk parity OK: {len(whole)} hits.")
+
+        large = random_genome(int(args.size * 1e6))
+        n_bases = sum(len(seq) for seq in large.values())
+        write_fasta(large, os.path.join(directory, "large.fa"))
+        write_twobit(large, os.path.join(directory, "large.2bit"))
+        del large
+        for name, genome in (
+            ("FASTA", FastaGenome(os.path.join(directory, "large.fa"))),
+            (".2bit", TwoBitGenome(os.path.join(directory, "large.2bit"))),
+        ):
+            start = time.perf_counter()
+            hits = scan_genome(genome, matrix, args.threshold, chunk_size=args.chunk_size)
+            count = sum(len(starts) for _, starts, _, _ in hits)
+            elapsed = time.perf_counter() - start
+            genome.close()
+            print(f"{name:>6}: {elapsed:7.2f} s  {n_bases / elapsed / 1e6:6.2f} MB/s  ({count} hits)")
+
+
+if __name__ == "__main__":
+    main()
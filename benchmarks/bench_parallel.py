@@ -0,0 +1,57 @@
+"""Measure how the parallel scan scales with the number of worker processes on the bundled data.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_parallel [--repeat 400] [--motifs 8] [--workers 1 2 4 8]
+
+The hits of every parallel run are checked against the serial scan before any timing is reported.
+"""
+
+import argparse
+import os
+
+from app.utils import parallel
+from app.utils.scan import encode_sequences, pssm_matrix, scan_encoded_batch
+
+from benchmarks.bench_scan import load_data, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=400, help="times the sequence set is replicated")
+    parser.add_argument("--motifs", type=int, default=8, help="times the motif is replicated")
+    parser.add_argument("--threshold", type=float, default=3.0)
+    parser.add_argument("--pseudocount", type=float, default=0.5)
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="worker counts to benchmark"
+    )
+    args = parser.parse_args()
+
+    pssm, seqs = load_data(args.pseudocount)
+    codes, lengths = encode_sequences(seqs * args.repeat)
+    matrices = [pssm_matrix(pssm)] * args.motifs
+    n_cells = int(lengths.sum()) * len(matrices)
+    print(f"{codes.shape[0]} sequences, {len(matrices)} motifs, {os.cpu_count()} CPUs.")
+
+    expected = scan_encoded_batch(matrices, codes, lengths, args.threshold)
+    serial = timed(scan_encoded_batch, matrices, codes, lengths, args.threshold)
+    print(f"{'serial':>10}: {serial * 1000:8.1f} ms  {n_cells / serial / 1e6:7.2f} Mbp*motif/s")
+
+    try:
+        for workers in args.workers:
+            # Start the pool outside of the timed runs.
+            parallel.get_executor(workers)
+            got = parallel.parallel_scan(matrices, codes, lengths, args.threshold, workers)
+            if got != expected:
+                raise SystemExit(f"Parity check failed with {workers} workers.")
+            elapsed = timed(parallel.parallel_scan, matrices, codes, lengths, args.threshold, workers)
+            print(
+                f"{workers:>3} workers: {elapsed * 1000:8.1f} ms  {n_cells / elapsed / 1e6:7.2f} Mbp*motif/s"
+                f"  x{serial / elapsed:.2f}"
+            )
+    finally:
+        parallel.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""Benchmark and regression checks of the scan and window pipeline, fully offline.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline check [--update-golden]
+    python -m benchmarks.bench_pipeline sweep [--rounds 3]
+
+check runs the equivalence checks: the vectorized scan against Bio.motifs, the incremental window sweep
+against score_window, the window steps merged from two parts of a gene set against the steps swept over the
+whole set (scores compared bit for bit), a search over a gene set grown from a smaller one (through the gene
+and window state caches) against the same search from scratch, and the hits and windows of the bundled data
+(data/sequences, MA0114) and of a seeded synthetic case against the golden outputs of benchmarks/golden. A
+missing golden file fails the check. --update-golden rewrites these files with the reference implementation of
+the scan and window search (see benchmarks.reference), not with the pipeline under test.
+
+sweep generates synthetic promoter sets and motifs and varies, one at a time, the number of sequences, the
+promoter length, the motif length, the threshold and the window size. It reports the time, throughput and
+peak memory (tracemalloc) of each stage: the promoter store lookup, the scan and the window search.
+
+The Entrez and JASPAR calls are stubbed to fail, the promoters and motifs come from temporary stores.
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import numpy as np
+from Bio import SeqIO, motifs
+
+from app.utils import motif_store, seq_store
+from benchmarks import reference
+from app.utils.pwm import TFBSSearch, best_window, merge_steps, sweep_steps, sweep_windows
+from app.utils.result_cache import (
+    gene_cache,
+    scan_cache,
+    sequence_set_key,
+    window_cache,
+    window_state_cache,
+)
+from app.utils.hits import HitTable
+from app.utils.scan import BASES, encode_sequences, pssm_matrix, scan_encoded, score_encoded
+
+SEQUENCES_DIR = "./data/sequences"
+MOTIF_FILE = "./data/motifs/MA0114.jaspar"
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), "golden")
+
+DEFAULTS = dict(n_sequences=100, promoter_length=1000, motif_length=12, threshold=3.0, window_size=40)
+SWEEPS = dict(
+    n_sequences=[10, 100, 1000],
+    promoter_length=[500, 1000, 2000, 5000],
+    motif_length=[6, 12, 20],
+    threshold=[0.0, 3.0, 6.0],
+    window_size=[20, 40, 80],
+)
+PSEUDOCOUNT = 0.5
+WINDOW_THRESHOLD = 0.3
+# Low thresholds give hits of both strands at the same offsets, whose order must match too.
+BIO_THRESHOLDS = (-2.0, 0.0, 3.0)
+GOLDEN_THRESHOLD = -2.0
+
+
+def offline(*args, **kwargs):
+    raise RuntimeError("Network access is disabled in the benchmarks.")
+
+
+@contextlib.contextmanager
+def offline_stores(directory):
+    """Point the promoter and motif stores to a directory, with every NCBI and JASPAR call stubbed."""
+    with mock.patch.object(seq_store, "fetch_promotors", offline), mock.patch.object(
+        motif_store, "download_motif", offline
+    ), mock.patch.object(motif_store, "MOTIFS_DIR", directory), mock.patch.object(
+        motif_store, "_index", dict()
+    ), mock.patch.dict(
+        seq_store._stores, clear=True
+    ):
+        clear_caches()
+        # The searches read their promoters from the default store.
+        seq_store._stores[seq_store.SEQUENCES_DIR] = seq_store.get_store(directory)
+        try:
+            yield seq_store.get_store(directory)
+        finally:
+            seq_store.get_store(directory).close()
+            clear_caches()
+
+
+def clear_caches():
+    motif_store.get_pssm.cache_clear()
+    for cache in (scan_cache, window_cache, gene_cache, window_state_cache):
+        cache.clear()
+
+
+def synthetic_motif(motif_id, length, rng):
+    """Return a Bio.motifs Motif with random counts, peaked on one base per column."""
+    counts = rng.integers(0, 5, size=(4, length)).astype(float)
+    counts[rng.integers(0, 4, size=length), np.arange(length)] += 20
+    m = motifs.Motif(counts={base: counts[i].tolist() for i, base in enumerate(BASES)})
+    m.matrix_id = motif_id
+    m.name = f"SYN{length}"
+    return m
+
+
+def synthetic_promoters(n_sequences, promoter_length, rng):
+    """Return {accession: sequence} of random promoters, with a few N bases."""
+    bases = np.array(list(BASES + "N"), dtype="S1")
+    promoters = dict()
+    for i in range(n_sequences):
+        codes = rng.choice(5, size=promoter_length, p=[0.2475, 0.2475, 0.2475, 0.2475, 0.01])
+        promoters[f"NM_SYN{i:06d}"] = bases[codes].tobytes().decode("ascii")
+    return promoters
+
+
+def bundled_data():
+    """Return the bundled MA0114 motif and {accession: sequence} of the bundled promoters."""
+    with open(MOTIF_FILE) as handle:
+        m = motifs.read(handle, "jaspar")
+    m.matrix_id = "MA0114"
+    promoters = dict()
+    for path in sorted(glob.glob(os.path.join(SEQUENCES_DIR, "*.fa"))):
+        accession = "_".join(os.path.basename(path).split("_")[:-1])
+        promoters[accession] = str(SeqIO.read(path, "fasta").seq)
+    return m, promoters
+
+
+def fill_stores(store, motif, promoters, promoter_length):
+    motif_store.add_motifs([motif])
+    for accession, sequence in promoters.items():
+        store.add(seq_store.record_name(accession, promoter_length), sequence)
+
+
+def measure(func, *args):
+    """Run func(*args) and return its result, elapsed time and peak traced memory."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run_stages(search, motif_id):
+    """Run the stages of a search one by one, returns {stage: (elapsed, peak memory, result)}."""
+    stages = dict()
+    sequences, elapsed, peak = measure(search.sequences)
+    stages["store"] = (elapsed, peak, sequences)
+    seq_key = sequence_set_key(sequences)
+    scan_key = search.scan_key(motif_id, seq_key, search.background_model(sequences, seq_key))
+    (tf_name, dict_seq), elapsed, peak = measure(
+        search.scan, motif_id, sequences, scan_key, lambda phase: None
+    )
+    stages["scan"] = (elapsed, peak, dict_seq)
+    windows, elapsed, peak = measure(
+        best_window, dict_seq, search.window_size, search.prom_len, search.w_threshold
+    )
+    stages["window"] = (elapsed, peak, windows)
+    return stages
+
+
+def sweep(args):
+    rng = np.random.default_rng(args.seed)
+    print(
+        f"{'parameter':>16} {'value':>7} | {'store ms':>9} {'scan ms':>9} {'Mbp/s':>7} {'scan MB':>8} "
+        f"{'window ms':>9} {'hits':>8} {'windows':>7}"
+    )
+    for parameter, values in SWEEPS.items():
+        for value in values:
+            config = dict(DEFAULTS, **{parameter: value})
+            motif = synthetic_motif("SYN0001.1", config["motif_length"], rng)
+            promoters = synthetic_promoters(config["n_sequences"], config["promoter_length"], rng)
+            best = None
+            for _ in range(args.rounds):
+                with tempfile.TemporaryDirectory() as directory, offline_stores(directory) as store:
+                    fill_stores(store, motif, promoters, config["promoter_length"])
+                    search = TFBSSearch(
+                        list(promoters),
+                        PSEUDOCOUNT,
+                        config["threshold"],
+                        config["promoter_length"],
+                        config["window_size"],
+                        WINDOW_THRESHOLD,
+                    )
+                    stages = run_stages(search, motif.matrix_id)
+                if best is None or stages["scan"][0] < best["scan"][0]:
+                    best = stages
+            n_bases = config["n_sequences"] * config["promoter_length"]
+            n_hits = sum(len(hits) for hits in best["scan"][2].values())
+            print(
+                f"{parameter:>16} {value:>7} | {best['store'][0] * 1000:9.1f} {best['scan'][0] * 1000:9.1f} "
+                f"{n_bases / best['scan'][0] / 1e6:7.2f} {best['scan'][1] / 1e6:8.1f} "
+                f"{best['window'][0] * 1000:9.1f} {n_hits:8d} {len(best['window'][2]):7d}"
+            )
+
+
+def normalized_hits(dict_seq):
+    return {seq_id: [[int(p), round(float(s), 4)] for p, s in hits] for seq_id, hits in dict_seq.items()}
+
+
+def normalized_windows(windows):
+    return [
+        [
+            int(start),
+            int(end),
+            round(float(score), 6),
+            {seq_id: [int(p), round(float(s), 4)] for seq_id, (p, s) in info.items()},
+        ]
+        for start, end, score, info in windows.values()
+    ]
+
+
+def check_biopython(motif, promoters, thresholds=BIO_THRESHOLDS):
+    """Check the vectorized scan and the HitTable of its scores against Bio.motifs, hits in the same order."""
+    pssm = motif.counts.normalize(pseudocounts=PSEUDOCOUNT).log_odds()
+    codes, lengths = encode_sequences(list(promoters.values()))
+    matrix = pssm_matrix(pssm)
+    for threshold in thresholds:
+        got = scan_encoded(matrix, codes, lengths, threshold)
+        table = HitTable.from_scores(*score_encoded(matrix, codes), lengths, threshold)
+        for i, sequence in enumerate(promoters.values()):
+            hits = pssm.search(sequence, threshold=threshold, both=True)
+            expected = [(int(p), round(float(s), 3)) for p, s in hits]
+            for hits in (got[i], table[i]):
+                if [(int(p), round(float(s), 3)) for p, s in hits] != expected:
+                    return False
+    return True
+
+
+def check_sweep(dict_seq, window_size, promoter_length):
+    """Check the incremental window sweep against score_window, step by step."""
+    seuil = (window_size / 3) / 100
+    for start, end, score, info in sweep_windows(dict_seq, window_size, 7, promoter_length, seuil):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            _, _, expected_score, expected_info = reference.score_window(
+                dict_seq, start, end, promoter_length, seuil
+            )
+        if not np.isclose(score, expected_score, equal_nan=True) or info != expected_info:
+            return False
+    return True
+
+
+def check_merge(dict_seq, window_size, promoter_length, n_added=3):
+    """Check that the steps merged from two parts of the sequences are bitwise those swept over all of them."""
+    seuil = (window_size / 3) / 100
+    known = len(dict_seq.ids) - n_added
+    expected = list(sweep_steps(dict_seq, window_size, 7, promoter_length, seuil))
+    merged = merge_steps(
+        list(sweep_steps(dict_seq.sequences(0, known), window_size, 7, promoter_length, seuil)),
+        sweep_steps(dict_seq.sequences(known, len(dict_seq.ids)), window_size, 7, promoter_length, seuil),
+        seuil,
+    )
+    return len(merged) == len(expected) and all(
+        step[:2] == expected_step[:2]
+        and step[3] == expected_step[3]
+        and np.float64(step[2]).tobytes() == np.float64(expected_step[2]).tobytes()
+        for step, expected_step in zip(merged, expected)
+    )
+
+
+def check_incremental(promoters, motif_id, promoter_length, window_size, n_added=3):
+    """Check that the windows of a gene set grown from a smaller one are those of a search from scratch."""
+    clear_caches()
+    params = (PSEUDOCOUNT, 0.0, promoter_length, window_size, WINDOW_THRESHOLD)
+    TFBSSearch(list(promoters)[:-n_added], *params).run(motif_id)
+    _, grown = TFBSSearch(list(promoters), *params).run(motif_id)
+    clear_caches()
+    _, expected = TFBSSearch(list(promoters), *params).run(motif_id)
+    return normalized_windows(grown) == normalized_windows(expected)
+
+
+def golden_cases(seed):
+    rng = np.random.default_rng(seed)
+    motif, promoters = bundled_data()
+    yield "bundled_MA0114", motif, promoters, 1000, 40
+    yield "synthetic", synthetic_motif("SYN0001.1", 10, rng), synthetic_promoters(20, 800, rng), 800, 30
+
+def reference_output(motif, promoters, promoter_length, window_size):
+    """Return the golden output of a case, from the reference scan and window search."""
+    pssm = motif.counts.normalize(pseudocounts=PSEUDOCOUNT).log_odds()
+    dict_seq = reference.scan_sequences(pssm, promoters, GOLDEN_THRESHOLD)
+    windows = reference.best_window(dict_seq, window_size, promoter_length, WINDOW_THRESHOLD)
+    return {"hits": normalized_hits(dict_seq), "windows": normalized_windows(windows)}
+
+
+def check(args):
+    failures = 0
+    for name, motif, promoters, promoter_length, window_size in golden_cases(args.seed):
+        path = os.path.join(GOLDEN_DIR, f"{name}.json")
+        if args.update_golden:
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            golden = reference_output(motif, promoters, promoter_length, window_size)
+            with open(path, "w") as handle:
+                json.dump(golden, handle, indent=1, sort_keys=True)
+            print(f"{name}: golden output written to {path}.")
+
+        with tempfile.TemporaryDirectory() as directory, offline_stores(directory) as store:
+            fill_stores(store, motif, promoters, promoter_length)
+            incremental_ok = check_incremental(promoters, motif.matrix_id, promoter_length, window_size)
+            search = TFBSSearch(
+                list(promoters),
+                PSEUDOCOUNT,
+                GOLDEN_THRESHOLD,
+                promoter_length,
+                window_size,
+                WINDOW_THRESHOLD,
+            )
+            stages = run_stages(search, motif.matrix_id)
+        dict_seq, windows = stages["scan"][2], stages["window"][2]
+        output = {"hits": normalized_hits(dict_seq), "windows": normalized_windows(windows)}
+
+        results = {
+            "Bio.motifs parity": check_biopython(motif, promoters),
+            "sweep/score_window parity": check_sweep(dict_seq, window_size, promoter_length),
+            "merged/swept steps bitwise parity": check_merge(dict_seq, window_size, promoter_length),
+            "incremental/from scratch parity": incremental_ok,
+        }
+        if not os.path.exists(path):
+            print(f"{name}: no golden output in {path}, write it with --update-golden.")
+            results["golden output"] = False
+        else:
+            with open(path) as handle:
+                results["golden output"] = json.load(handle) == json.loads(json.dumps(output, sort_keys=True))
+
+        for check_name, ok in results.items():
+            print(f"{name}: {check_name} {'OK' if ok else 'FAILED'}")
+            failures += not ok
+    if failures:
+        raise SystemExit(f"{failures} check(s) failed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", type=int, default=0)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    check_parser = subparsers.add_parser("check", help="run the equivalence checks")
+    check_parser.add_argument("--update-golden", action="store_true", help="rewrite the golden outputs")
+    sweep_parser = subparsers.add_parser("sweep", help="benchmark the stages over synthetic data")
+    sweep_parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "check":
+        check(args)
+    else:
+        sweep(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Compare the Bio.motifs search with the vectorized scanning engine on the bundled data.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_scan [--repeat 40] [--threshold 3.0] [--lengths 6 8 10 12 16 20]
+
+The hits of both engines are checked for parity before any timing is reported. The k-mer table scoring of
+short motifs is then compared with the direct scoring, for motifs of each length made from the columns of
+the bundled motif.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+from Bio import SeqIO, motifs
+
+from app.utils.scan import LOOKUP_MAX_LENGTH, encode_sequences, pssm_matrix, scan_encoded, score_encoded
+
+SEQUENCES_DIR = "./data/sequences"
+MOTIF_FILE = "./data/motifs/MA0114.jaspar"
+
+
+def load_data(pseudocount):
+    with open(MOTIF_FILE) as handle:
+        m = motifs.read(handle, "jaspar")
+    pssm = m.counts.normalize(pseudocounts=pseudocount).log_odds()
+    files = sorted(glob.glob(os.path.join(SEQUENCES_DIR, "*.fa")))
+    seqs = [SeqIO.read(f, "fasta").seq for f in files]
+    return pssm, seqs
+
+
+def biopython_scan(pssm, seqs, threshold):
+    return [list(pssm.search(seq, threshold=threshold, both=True)) for seq in seqs]
+
+
+def vectorized_scan(pssm, seqs, threshold):
+    codes, lengths = encode_sequences(seqs)
+    return scan_encoded(pssm_matrix(pssm), codes, lengths, threshold)
+
+
+def normalized(hits):
+    # In order: the order of the hits at the same offset decides the hits kept by the window search.
+    return [[(int(p), round(float(s), 4)) for p, s in seq_hits] for seq_hits in hits]
+
+
+def timed(func, *args, rounds=5):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def lookup_benchmark(pssm, seqs, motif_lengths):
+    """Compare the k-mer table and the direct scoring of motifs of motif_lengths columns."""
+    codes, _ = encode_sequences(seqs)
+    n_bases = sum(len(s) for s in seqs)
+    matrix = pssm_matrix(pssm)
+    print(f"k-mer tables are used up to {LOOKUP_MAX_LENGTH} columns (TFBS_LOOKUP_MAX_LENGTH).")
+    for motif_length in motif_lengths:
+        # The columns of the motif are repeated for the lengths above its own.
+        sub_matrix = np.resize(matrix, (motif_length, 4))
+        direct = score_encoded(sub_matrix, codes, lookup=False)
+        lookup = score_encoded(sub_matrix, codes, lookup=True)
+        if not all(np.allclose(d, l, atol=1e-4, equal_nan=True) for d, l in zip(direct, lookup)):
+            raise SystemExit(f"Parity check failed: the k-mer table scores of length {motif_length} differ.")
+        timings = [timed(score_encoded, sub_matrix, codes, lookup) for lookup in (False, True)]
+        print(
+            f"{motif_length:>4} columns: direct {timings[0] * 1000:8.1f} ms, "
+            f"k-mer tables {timings[1] * 1000:8.1f} ms"
+            f"  ({n_bases / timings[1] / 1e6:6.2f} Mbp/s, x{timings[0] / timings[1]:.2f})"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=40, help="times the sequence set is replicated")
+    parser.add_argument("--threshold", type=float, default=3.0)
+    parser.add_argument("--pseudocount", type=float, default=0.5)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[6, 8, 10, 12, 16, 20])
+    args = parser.parse_args()
+
+    pssm, seqs = load_data(args.pseudocount)
+    expected = biopython_scan(pssm, seqs, args.threshold)
+    got = vectorized_scan(pssm, seqs, args.threshold)
+    if normalized(expected) != normalized(got):
+        raise SystemExit("Parity check failed: the engines returned different hits.")
+    print(f"Parity OK: {sum(len(h) for h in got)} hits on {len(seqs)} sequences.")
+
+    seqs = seqs * args.repeat
+    n_bases = sum(len(s) for s in seqs)
+    for name, func in (("Bio.motifs", biopython_scan), ("vectorized", vectorized_scan)):
+        elapsed = timed(func, pssm, seqs, args.threshold)
+        print(f"{name:>12}: {elapsed * 1000:8.1f} ms  {n_bases / elapsed / 1e6:6.2f} Mbp/s  ({len(seqs)} sequences)")
+
+    lookup_benchmark(pssm, seqs, args.lengths)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Measure the import time of the app and the time to the first good response of a fresh worker.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup [--rounds 5] [--modes off startup import]
+
+The import time of the app is measured in fresh interpreters, with each warm-up mode (see app.utils.warmup).
+Then, for each mode, a uvicorn worker is started on a copy of the bundled data (the bundled motif and
+promoters, listed in its warm-up file, no network access needed) and the benchmark reports the time until it
+listens (/health), until it is ready (/health/ready), the latency of its first /tfbs request once ready,
+and the latency of the next one.
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEQUENCES_DIR = os.path.join(ROOT, "data", "sequences")
+MOTIF_FILE = os.path.join(ROOT, "data", "motifs", "MA0114.jaspar")
+PROMOTER_LENGTH = 1000
+PSEUDOCOUNT = 0.8
+TIMEOUT = 60.0
+
+IMPORT_CODE = "import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)"
+
+
+def bundled_accessions():
+    paths = glob.glob(os.path.join(SEQUENCES_DIR, f"*_{PROMOTER_LENGTH}.fa"))
+    return sorted("_".join(os.path.basename(path).split("_")[:-1]) for path in paths)
+
+
+def make_workdir(directory, accessions):
+    """Copy the bundled data to a working directory, with a warm-up file listing it."""
+    os.makedirs(os.path.join(directory, "data", "motifs"))
+    shutil.copytree(SEQUENCES_DIR, os.path.join(directory, "data", "sequences"))
+    # Only the legacy files, the promoters are imported into a fresh store.
+    for name in ("promoters.fa", "promoters.fa.fai"):
+        path = os.path.join(directory, "data", "sequences", name)
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.copy(MOTIF_FILE, os.path.join(directory, "data", "motifs"))
+    config = {
+        "motifs": ["MA0114"],
+        "pseudocounts": [PSEUDOCOUNT],
+        "promoters": [{"mrna": accessions, "promoter_length": PROMOTER_LENGTH}],
+    }
+    with open(os.path.join(directory, "data", "warmup.json"), "w") as handle:
+        json.dump(config, handle)
+
+
+def environment(mode):
+    env = dict(os.environ, TFBS_WARMUP=mode, PYTHONPATH=ROOT)
+    # Single process scans, so that the pool start-up is not part of the first request.
+    env.setdefault("TFBS_WORKERS", "1")
+    return env
+
+
+def import_time(mode, directory):
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_CODE], cwd=directory, env=environment(mode), capture_output=True, check=True
+    )
+    return float(output.stdout.decode().split()[-1])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get(url):
+    """Return the status of a GET request, None if the server does not answer yet."""
+    try:
+        with urllib.request.urlopen(url, timeout=TIMEOUT) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def wait_for(url, start):
+    while time.perf_counter() - start < TIMEOUT:
+        if get(url) == 200:
+            return time.perf_counter() - start
+        time.sleep(0.01)
+    raise SystemExit(f"{url} did not answer within {TIMEOUT} s.")
+
+
+def search(base, accessions):
+    body = {
+        "email": "bench@example.com",
+        "m": "MA0114",
+        "t": 3.0,
+        "s": 0.3,
+        "promoter_length": PROMOTER_LENGTH,
+        "window_size": 40,
+        "pseudocount": PSEUDOCOUNT,
+        "mrna": accessions,
+    }
+    request = urllib.request.Request(
+        f"{base}/tfbs", data=json.dumps(body).encode(), headers={"Content-Type": "application/json"}
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+        response.read()
+        if response.status != 200:
+            raise SystemExit(f"/tfbs answered {response.status}.")
+    return time.perf_counter() - start
+
+
+def first_response(mode, accessions):
+    """Start a worker on a fresh copy of the data, returns its start-up timings in seconds."""
+    with tempfile.TemporaryDirectory() as directory:
+        make_workdir(directory, accessions)
+        port = free_port()
+        base = f"http://127.0.0.1:{port}"
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+            cwd=directory,
+            env=environment(mode),
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            listening = wait_for(f"{base}/health", start)
+            ready = wait_for(f"{base}/health/ready", start)
+            first = search(base, accessions)
+            second = search(base, accessions)
+        finally:
+            server.terminate()
+            server.wait()
+    return listening, ready, first, second
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=5, help="fresh interpreters per import time")
+    parser.add_argument("--modes", nargs="+", default=["off", "startup", "import"])
+    args = parser.parse_args()
+
+    accessions = bundled_accessions()
+    with tempfile.TemporaryDirectory() as directory:
+        make_workdir(directory, accessions)
+        for mode in args.modes:
+            times = sorted(import_time(mode, directory) for _ in range(args.rounds))
+            print(f"import app, TFBS_WARMUP={mode:<8}: {times[len(times) // 2] * 1000:7.1f} ms (median)")
+
+    print(f"{'mode':>8} | {'listening':>9} {'ready':>9} {'1st /tfbs':>9} {'2nd /tfbs':>9} (s)")
+    for mode in args.modes:
+        listening, ready, first, second = first_response(mode, accessions)
+        print(f"{mode:>8} | {listening:9.3f} {ready:9.3f} {first:9.3f} {second:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+"""Local mock of the NCBI E-utilities and of the JASPAR API, to run the async I/O layer offline.
+
+Run from the repository root:
+
+    python -m benchmarks.mock_upstream serve [--port 8081] [--latency 0.2]
+    python -m benchmarks.mock_upstream check [--latency 0.2] [--users 20]
+
+serve answers the elink, esummary and efetch calls of the promoter download and the JASPAR matrix and
+collection calls, after an optional latency. The promoters of the bundled data (data/sequences) and the
+bundled motifs (data/motifs) are returned as they are, other accessions and motifs get random, seeded,
+content. Point the API to it with:
+
+    TFBS_NCBI_URL=http://127.0.0.1:8081/entrez/eutils/ TFBS_JASPAR_URL=http://127.0.0.1:8081/api/v1/
+
+check starts the server in a thread, downloads the bundled promoters and motif through app.utils.upstream
+and compares them with the bundled files, then times concurrent users downloading the same promoters. It
+also checks the blocking Entrez client of app.utils.utils: the batching of elink, the one request per id
+fallback, the unknown accessions, the retries and the rate limiter. For these checks, the mock answers the
+accessions starting with SPLIT_ only when they are alone in an elink call, NOLINK_ without gene, BAD_ with an
+HTTP 400, FLAKY_ with an HTTP 503 twice and DOWN_ always with an HTTP 503.
+"""
+
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import numpy as np
+
+SEQUENCES_DIR = "./data/sequences"
+MOTIFS_DIR = "./data/motifs"
+CHR_START, CHR_STOP = 100000, 110000
+PAGE_SIZE = 1000
+N_COLLECTION_MOTIFS = 50
+
+ELINK_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8" ?>\n'
+    '<!DOCTYPE eLinkResult PUBLIC "-//NLM//DTD elink 20101123//EN" '
+    '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20101123/elink.dtd">\n'
+)
+ESUMMARY_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8" ?>\n'
+    '<!DOCTYPE eSummaryResult PUBLIC "-//NLM//DTD esummary gene 20130524//EN" '
+    '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20130524/esummary_gene.dtd">\n'
+)
+
+
+def seeded_rng(name):
+    return np.random.default_rng(int(hashlib.sha256(name.encode()).hexdigest()[:8], 16))
+
+
+def bundled_promoter(accession, length):
+    """Return the (header, sequence) of a bundled promoter, or None."""
+    path = os.path.join(SEQUENCES_DIR, f"{accession}_{length}.fa")
+    if not os.path.exists(path):
+        return None
+    with open(path) as handle:
+        lines = handle.read().split("\n")
+    return lines[0][1:], "".join(lines[1:])
+
+
+def read_pfm(lines):
+    """Return {base: counts} of the count lines of a .jaspar file."""
+    return {
+        line[0]: [int(x) for x in line[line.index("[") + 1 : line.index("]")].split()]
+        for line in lines
+        if line.strip()
+    }
+
+
+def bundled_motif(motif_id):
+    """Return (name, {base: counts}) of a bundled .jaspar motif, or None."""
+    for path in (
+        os.path.join(MOTIFS_DIR, f"{motif_id}.jaspar"),
+        os.path.join(MOTIFS_DIR, f"{motif_id.split('.')[0]}.jaspar"),
+    ):
+        if os.path.exists(path):
+            with open(path) as handle:
+                lines = handle.read().split("\n")
+            name = lines[0].split("\t")[1] if "\t" in lines[0] else motif_id
+            return name, read_pfm(lines[1:])
+    return None
+
+
+def synthetic_motif(motif_id):
+    rng = seeded_rng(motif_id)
+    length = int(rng.integers(6, 20))
+    counts = rng.integers(0, 5, size=(4, length))
+    counts[rng.integers(0, 4, size=length), np.arange(length)] += 20
+    return f"MOCK_{motif_id}", {base: counts[i].tolist() for i, base in enumerate("ACGT")}
+
+
+class MockUpstreamHandler(BaseHTTPRequestHandler):
+    """Answers the NCBI and JASPAR calls of app.utils.utils and app.utils.upstream."""
+
+    # Keep-alive connections, as the real services.
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    genes = dict()  # gene id -> accession, filled by elink.
+    genes_lock = threading.Lock()
+    calls = []  # (route, ids, arrival time) of the NCBI calls.
+    failures = Counter()  # HTTP 503 answered to each FLAKY_ accession.
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, content_type):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        routes = {
+            "/entrez/eutils/elink.fcgi": self.elink,
+            "/entrez/eutils/esummary.fcgi": self.esummary,
+            "/entrez/eutils/efetch.fcgi": self.efetch,
+            "/api/v1/matrix/": self.collection,
+        }
+        if url.path in routes:
+            if url.path.startswith("/entrez/"):
+                ids = [i for value in query.get("id", []) for i in value.split(",")]
+                with self.genes_lock:
+                    self.calls.append((url.path.split("/")[-1][: -len(".fcgi")], ids, time.monotonic()))
+            routes[url.path](query)
+        elif url.path.startswith("/api/v1/matrix/"):
+            self.matrix(url.path.split("/")[-2])
+        else:
+            self.send_error(404)
+
+    def failing(self, ids):
+        """Return the HTTP error code of an elink call with the test accessions of check, or None."""
+        if any(accession.startswith("BAD_") for accession in ids):
+            return 400
+        if any(accession.startswith("DOWN_") for accession in ids):
+            return 503
+        with self.genes_lock:
+            flaky = [accession for accession in ids if accession.startswith("FLAKY_")]
+            if any(self.failures[accession] < 2 for accession in flaky):
+                self.failures.update(flaky)
+                return 503
+        return None
+
+    def elink(self, query):
+        ids = [i for value in query["id"] for i in value.split(",")]
+        code = self.failing(ids)
+        if code is not None:
+            self.send_error(code)
+            return
+        linksets = []
+        for accession in ids:
+            if accession.startswith("SPLIT_") and len(ids) > 1:
+                continue
+            gene_id = str(int(hashlib.sha256(accession.encode()).hexdigest()[:7], 16))
+            with self.genes_lock:
+                self.genes[gene_id] = accession
+            links = (
+                f"<LinkSetDb><DbTo>gene</DbTo><LinkName>nuccore_gene</LinkName>"
+                f"<Link><Id>{gene_id}</Id></Link></LinkSetDb>"
+            )
+            if accession.startswith("NOLINK_"):
+                links = ""
+            linksets.append(
+                f"<LinkSet><DbFrom>nuccore</DbFrom><IdList><Id>{accession}</Id></IdList>{links}</LinkSet>"
+            )
+        self.send(ELINK_HEADER + "<eLinkResult>" + "".join(linksets) + "</eLinkResult>\n", "text/xml")
+
+    def esummary(self, query):
+        summaries = []
+        for gene_id in query["id"][0].split(","):
+            with self.genes_lock:
+                accession = self.genes.get(gene_id, gene_id)
+            summaries.append(
+                f'<DocumentSummary uid="{gene_id}"><Name>MOCK{gene_id}</Name><GenomicInfo><GenomicInfoType>'
+                f"<ChrLoc>1</ChrLoc><ChrAccVer>MOCK_{accession}</ChrAccVer><ChrStart>{CHR_START}</ChrStart>"
+                f"<ChrStop>{CHR_STOP}</ChrStop><ExonCount>1</ExonCount></GenomicInfoType></GenomicInfo>"
+                "</DocumentSummary>"
+            )
+        self.send(
+            ESUMMARY_HEADER
+            + '<eSummaryResult><DocumentSummarySet status="OK">'
+            + "".join(summaries)
+            + "</DocumentSummarySet></eSummaryResult>\n",
+            "text/xml",
+        )
+
+    def efetch(self, query):
+        accession = query["id"][0][len("MOCK_") :]
+        start, stop = int(query["seq_start"][0]), int(query["seq_stop"][0])
+        bundled = bundled_promoter(accession, stop - start)
+        if bundled is None:
+            sequence = "".join(seeded_rng(accession).choice(list("ACGT"), size=stop - start + 1))
+            bundled = f"MOCK_{accession}:{start}-{stop} mock sequence", sequence
+        header, sequence = bundled
+        lines = [sequence[i : i + 70] for i in range(0, len(sequence), 70)]
+        self.send(f">{header}\n" + "\n".join(lines) + "\n\n", "text/plain")
+
+    def matrix(self, motif_id):
+        name, pfm = bundled_motif(motif_id) or synthetic_motif(motif_id)
+        self.send(json.dumps({"matrix_id": motif_id, "name": name, "pfm": pfm}), "application/json")
+
+    def collection(self, query):
+        paths = glob.glob(os.path.join(MOTIFS_DIR, "*.jaspar"))
+        motif_ids = sorted(os.path.basename(path)[: -len(".jaspar")] for path in paths)
+        motif_ids += [f"MOCK{i:04d}.1" for i in range(N_COLLECTION_MOTIFS)]
+        page_size = int(query.get("page_size", [PAGE_SIZE])[0])
+        page = int(query.get("page", ["1"])[0])
+        page_ids = motif_ids[(page - 1) * page_size : page * page_size]
+        results = [{"matrix_id": motif_id} for motif_id in page_ids]
+        next_url = None
+        if page * page_size < len(motif_ids):
+            params = {key: values[0] for key, values in query.items()}
+            params["page"] = page + 1
+            next_url = f"http://{self.headers['Host']}/api/v1/matrix/?{urlencode(params)}"
+        data = {"count": len(motif_ids), "next": next_url, "results": results}
+        self.send(json.dumps(data), "application/json")
+
+
+def start_server(port=0, latency=0.0):
+    """Start the mock server in a daemon thread, returns the server (server.server_port is its port)."""
+    handler = type(
+        "Handler",
+        (MockUpstreamHandler,),
+        {"latency": latency, "genes": dict(), "calls": [], "failures": Counter()},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def raises(exception, func, *args):
+    """Return whether func(*args) raises exception."""
+    try:
+        func(*args)
+    except exception:
+        return True
+    return False
+
+
+def check_blocking():
+    """Check the blocking Entrez client of app.utils.utils against a mock server without latency.
+
+    Returns {check name: passed}.
+    """
+    import requests
+
+    from app.utils import utils
+
+    server = start_server()
+    calls = server.RequestHandlerClass.calls
+
+    def elink_sizes():
+        sizes = [len(ids) for route, ids, _ in calls if route == "elink"]
+        calls.clear()
+        return sizes
+
+    unlimited = {False: utils.RateLimiter(1e6, 1e6), True: utils.RateLimiter(1e6, 1e6)}
+    results = dict()
+    with mock.patch.object(utils, "ncbi_url", f"http://127.0.0.1:{server.server_port}/entrez/eutils/"):
+        with mock.patch.dict(utils._limiters, unlimited), mock.patch.object(utils, "retry_backoff", 0.01):
+            accessions = [f"NM_{i:06d}" for i in range(2 * utils.batch_size + 50)]
+            genes = utils.mrnas_to_genes(accessions)
+            results["elink batches"] = len(genes) == len(accessions) and elink_sizes() == [
+                utils.batch_size,
+                utils.batch_size,
+                50,
+            ]
+
+            genes = utils.mrnas_to_genes(["NM_1", "SPLIT_2", "NM_3"])
+            fallback = elink_sizes() == [3, 1, 1, 1]
+            results["one elink per id fallback"] = fallback and list(genes) == ["NM_1", "SPLIT_2", "NM_3"]
+
+            unknown = raises(ValueError, utils.mrna_to_gene, "BAD_1") and raises(
+                ValueError, utils.mrna_to_gene, "NOLINK_1"
+            )
+            # The HTTP 400 is not retried.
+            results["unknown accessions"] = unknown and elink_sizes() == [1, 1]
+
+            gene = utils.mrna_to_gene("FLAKY_1")
+            results["retry of HTTP 503"] = gene is not None and elink_sizes() == [1, 1, 1]
+            outage = raises(requests.HTTPError, utils.mrna_to_gene, "DOWN_1")
+            outage = outage and len(elink_sizes()) == utils.max_retries
+            results["NCBI outage is not an unknown accession"] = outage
+
+        # Tokens are served in the order they are reserved, 1 / rate seconds apart.
+        rate = 20
+        limiter = utils.RateLimiter(rate)
+        waits = [limiter.reserve() for _ in range(5)]
+        ordered = all(abs(b - a - 1 / rate) < 0.01 for a, b in zip(waits, waits[1:]))
+        limiter = utils.RateLimiter(rate)
+        with mock.patch.dict(utils._limiters, {False: limiter, True: limiter}):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(utils.mrna_to_gene, [f"NM_{i}" for i in range(10)]))
+        arrivals = sorted(arrival for _, _, arrival in calls)
+        spaced = all(b - a > 0.8 / rate for a, b in zip(arrivals, arrivals[1:]))
+        results["rate limiter"] = ordered and spaced and len(arrivals) == 10
+    server.shutdown()
+    return results
+
+
+def check(args):
+    from app.utils import upstream, utils
+
+    server = start_server(latency=args.latency)
+    base = f"http://127.0.0.1:{server.server_port}"
+    paths = glob.glob(os.path.join(SEQUENCES_DIR, "*.fa"))
+    accessions = sorted("_".join(os.path.basename(path).split("_")[:-1]) for path in paths)
+    # The mock has no rate limit, the NCBI limit would only measure the limiter.
+    unlimited = {False: utils.RateLimiter(1e6, 1e6), True: utils.RateLimiter(1e6, 1e6)}
+
+    async def run():
+        records = await upstream.fetch_promotors(accessions, 1000)
+        promoters_ok = all(str(records[a].seq) == bundled_promoter(a, 1000)[1] for a in accessions)
+        print(f"Promoters of the bundled data: {'OK' if promoters_ok else 'FAILED'}")
+
+        with tempfile.TemporaryDirectory() as directory:
+            await upstream.download_motif("MA0114", directory)
+            with open(os.path.join(directory, "MA0114.jaspar")) as handle:
+                lines = handle.read().split("\n")
+        motif_ok = read_pfm(lines[1:]) == bundled_motif("MA0114")[1]
+        print(f"Bundled motif: {'OK' if motif_ok else 'FAILED'}")
+
+        collection = await upstream.list_collection_motifs("CORE")
+        print(f"Collection: {len(collection)} motifs.")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(upstream.fetch_promotors(accessions, 1000) for _ in range(args.users)))
+        elapsed = time.perf_counter() - start
+        calls = args.users * (len(accessions) + 2)
+        print(
+            f"{args.users} users, {calls} NCBI calls of {args.latency * 1000:.0f} ms: {elapsed:.2f} s "
+            f"({calls / elapsed:.1f} calls/s, {upstream.ncbi.concurrency} concurrent connections)"
+        )
+        await upstream.close()
+        return promoters_ok and motif_ok
+
+    with mock.patch.object(upstream.ncbi, "base_url", f"{base}/entrez/eutils/"), mock.patch.object(
+        upstream.jaspar, "base_url", f"{base}/api/v1/"
+    ), mock.patch.dict(utils._limiters, unlimited):
+        ok = asyncio.run(run())
+    server.shutdown()
+
+    for name, passed in check_blocking().items():
+        print(f"Blocking Entrez client, {name}: {'OK' if passed else 'FAILED'}")
+        ok = ok and passed
+    if not ok:
+        raise SystemExit("Check failed.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="run the mock server")
+    serve_parser.add_argument("--port", type=int, default=8081)
+    check_parser = subparsers.add_parser("check", help="check the upstream clients against the mock server")
+    for subparser in (serve_parser, check_parser):
+        subparser.add_argument("--latency", type=float, default=0.0, help="seconds before each answer")
+    check_parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = start_server(args.port, args.latency)
+        print(f"Mock NCBI and JASPAR on http://127.0.0.1:{server.server_port}, Ctrl-C to stop.")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+    else:
+        check(args)
+
+
+if __name__ == "__main__":
+    main()
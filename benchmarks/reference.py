@@ -0,0 +1,69 @@
+"""Reference implementation of the scan and window search, as they were before the vectorized pipeline.
+
+The hits come from Bio.motifs search and the windows from the original score_window and best_window, with
+their module globals (prom_len, seuil, w_threshold) turned into arguments. bench_pipeline writes its golden
+outputs with these functions and checks the incremental window sweep against score_window.
+"""
+
+import numpy as np
+
+
+def scan_sequences(pssm, promoters, scorethreshold):
+    """Return {accession: [(position, score), ...]} of the hits of a PSSM, in the Bio.motifs search order."""
+    return {
+        accession: list(pssm.search(sequence, threshold=scorethreshold, both=True))
+        for accession, sequence in promoters.items()
+    }
+
+
+def score_window(sas, start, end, prom_len, seuil):
+    """Return start, end, the proximity score of the hits in [start, end) and the window info."""
+    samples = []  # List to hold samples from each sequence.
+    window_info = {}  # Last hit of each sequence in the window.
+
+    for item in sas:
+        row = []
+        for position, score in sas[item]:
+            adjusted_position = prom_len + position + 1 if position < 0 else position
+            if start <= adjusted_position < end:
+                row.append(adjusted_position)
+                window_info[item] = (position, score)
+        if row:
+            samples.append(row)
+
+    if not samples:
+        return start, end, 0, window_info
+
+    samples = [np.array(row) for row in samples]
+    scores = []
+    for i in range(len(samples) - 1):
+        curr_row = samples[i]
+        next_row = samples[i + 1]
+        diff_matrix = np.abs(curr_row[:, None] - next_row)
+        percentage_matrix = diff_matrix / next_row
+        valid_scores = percentage_matrix[percentage_matrix < seuil]
+        scores.extend(valid_scores)
+
+    return start, end, np.sum(scores), window_info
+
+
+def best_window(sas, window_size, prom_len, w_threshold, slide_step=7):
+    """Return {window index: (start, end, score, window info)} of the windows scoring under w_threshold."""
+    seuil = (window_size / 3) / 100
+    start = 0
+    end = window_size
+    tmp = 0
+    window_index = 1
+    windows_info = dict()
+
+    while start < (prom_len - window_size):
+        start_curr, end_curr, curr_bws, window_info = score_window(sas, start, end, prom_len, seuil)
+        if curr_bws > 0 and w_threshold > curr_bws:
+            # To get rid of the same value.
+            if tmp != curr_bws:
+                windows_info[window_index] = (start_curr, end_curr, curr_bws, window_info)
+                window_index += 1
+            tmp = curr_bws
+        start += slide_step
+        end += slide_step
+    return windows_info